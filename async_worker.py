@@ -0,0 +1,40 @@
+"""
+Асинхронный режим воркера: агенты выполняются корутинами в одном event loop процесса.
+
+Агент почти все время ждет LLM и браузер, поэтому один такой процесс заменяет десятки
+prefork-процессов. Воркер выполняет задачи агента universal и слушает только их очереди
+(agents.universal.*), обычный воркер — очереди агента magnitude, так что оба режима можно
+запускать одновременно.
+
+Запуск:
+    python async_worker.py
+"""
+import os
+from worker import celery_app
+from shared.celery_app import UNIVERSAL_TASK_QUEUES
+from universal_agent.runtime import enable_runtime, AGENT_CONCURRENCY
+from shared.llm_client import llm_client
+from shared import services
+
+
+def main():
+    enable_runtime(AGENT_CONCURRENCY)
+    # Клиент LLM и его соединение с RunPod готовятся в фоне, пока Celery подключается к брокеру
+    services.warm_up(llm_client)
+    # Потоки пула Celery только передают агентов в event loop и ждут их завершения.
+    # prefetch-multiplier=1: процесс не забирает из очереди больше задач, чем может выполнять,
+    # и не отнимает их у других воркеров.
+    celery_app.worker_main([
+        "worker",
+        "--pool=threads",
+        f"--concurrency={AGENT_CONCURRENCY}",
+        "--prefetch-multiplier=1",
+        # Порядок очередей задает порядок обслуживания приоритетов
+        f"--queues={','.join(UNIVERSAL_TASK_QUEUES.values())}",
+        f"--hostname=async-{os.getpid()}@%h",
+        f"--loglevel={os.getenv('CELERY_LOG_LEVEL', 'info')}",
+    ])
+
+
+if __name__ == "__main__":
+    main()
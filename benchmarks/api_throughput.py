@@ -0,0 +1,56 @@
+"""
+Нагрузочный замер создания задач через API оркестратора.
+
+Запуск (API должно быть поднято, например `uvicorn orchestrator.main:app`):
+    python benchmarks/api_throughput.py --url http://localhost:8000 --requests 2000 --concurrency 100
+"""
+import argparse
+import asyncio
+import time
+import httpx
+
+
+async def run(url: str, total: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def create(i: int):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post("/tasks", json={"goal": f"benchmark goal {i}"})
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+                except httpx.HTTPError:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(create(i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "tasks_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер пропускной способности POST /tasks")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+    print(asyncio.run(run(args.url, args.requests, args.concurrency)))
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
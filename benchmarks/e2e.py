@@ -0,0 +1,434 @@
+"""
+Офлайн сквозной бенчмарк: API оркестратора -> run_agent_task -> UniversalAgent -> LLM и RAG-память,
+без RunPod, ChromaDB и браузеров. Внешние сервисы заменяются локальными заглушками
+(benchmarks/stubs.py), Redis — временным redis-server, ChromaDB — in-memory клиентом.
+
+Сценарии:
+    api     — POST /tasks через orchestrator.main:app (задачи ставятся в Celery и в хранилище)
+    worker  — созданные задачи выполняет worker.run_agent_task в асинхронном режиме
+    memory  — массовая запись и поиск сценариев в RAGMemory (нужен пакет chromadb)
+    replay  — те же цели дважды: второй проход повторяет сохраненные сценарии без LLM (нужен пакет chromadb)
+
+Отчет: задачи/сек, p50/p99 времени шага (по событиям задач), прирост памяти на агента,
+доля задач, повторивших сценарий, и сэкономленные запросы к LLM.
+
+Запуск:
+    python benchmarks/e2e.py --tasks 200 --concurrency 50 --steps 5 --profile realistic --save-baseline
+    python benchmarks/e2e.py --tasks 200 --concurrency 50 --steps 5 --profile realistic --compare
+Выход с кодом 1, если метрики хуже базовых сильнее порога --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import PROFILES, StubServer, FakeBrowserPool, bench_goal, create_runpod_stub
+
+BASELINES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+# Какие метрики сравнивать с базовыми и в какую сторону они ухудшаются
+_HIGHER_IS_BETTER = {"tasks_per_sec", "ops_per_sec", "hit_rate"}
+_LOWER_IS_BETTER = {"p50_ms", "p99_ms", "step_p50_ms", "step_p99_ms", "rss_per_agent_mb", "prompt_tokens_per_step"}
+# Параметры нагрузки: сравнивать имеет смысл только прогоны с одинаковыми значениями
+_WORKLOAD_PARAMS = ("tasks", "concurrency", "steps", "stream", "browser", "documents", "queries")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(len(values) * q), len(values) - 1)], 1)
+
+
+def _rss_mb() -> float:
+    """
+    Текущий RSS процесса. Пиковый ru_maxrss не годится: его задает самый тяжелый из уже
+    прошедших сценариев, и прирост памяти следующего сценария в нем не виден.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        # Без /proc (macOS) остается только пик: ru_maxrss там в байтах
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+
+class RSSSampler:
+    """Наибольший текущий RSS за время блока with, с опросом раз в interval секунд."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0.0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, _rss_mb())
+            if self._stopped.wait(self.interval):
+                return
+
+    def __enter__(self) -> "RSSSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_mb())
+
+
+class EphemeralRedis:
+    """redis-server без сохранения на диск на свободном порту."""
+
+    def __init__(self):
+        self.port = _free_port()
+        self.dir = tempfile.mkdtemp(prefix="ornold-bench-")
+        self.process: subprocess.Popen | None = None
+
+    def start(self) -> int:
+        binary = shutil.which("redis-server")
+        if binary is None:
+            raise SystemExit("Для бенчмарка нужен redis-server в PATH")
+        self.process = subprocess.Popen(
+            [binary, "--port", str(self.port), "--save", "", "--appendonly", "no", "--dir", self.dir],
+            stdout=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.2).close()
+                return self.port
+            except OSError:
+                time.sleep(0.05)
+        raise SystemExit("redis-server не запустился")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def configure_environment(redis_port: int, runpod_url: str, args):
+    """Переменные окружения задаются до импорта модулей проекта: они читаются при импорте."""
+    os.environ.update({
+        "REDIS_HOST": "127.0.0.1",
+        "REDIS_PORT": str(redis_port),
+        "RUNPOD_API_BASE": runpod_url,
+        "RUNPOD_API_KEY": "bench",
+        "RUNPOD_ENDPOINT_ID_GEMMA": "bench-llm",
+        "RUNPOD_ENDPOINT_ID_EMBEDDING": "bench-embedding",
+        "AGENT_MAX_STEPS": str(args.steps + 5),
+        "AGENT_CONCURRENCY": str(args.concurrency),
+        "WORKER_METRICS_PORT": "0",
+        "GEMMA_POLL_INITIAL_DELAY": "0.05",
+        # Сценарий worker меряет путь через LLM; повтор сценариев включает только сценарий replay
+        "REPLAY_ENABLED": "false",
+    })
+    if args.stream:
+        os.environ["LLM_STREAM_METHODS"] = "get_next_action_universal"
+
+
+async def bench_api(tasks: int, concurrency: int, steps: int) -> tuple[dict, list[str]]:
+    """Создание задач через API (в процессе, через ASGI) — отдает метрики и ID задач."""
+    import httpx
+    from orchestrator.main import app
+
+    latencies: list[float] = []
+    task_ids: list[str] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://api", timeout=60) as client:
+        async def create(i: int):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/tasks", json={"goal": bench_goal(i, steps), "agent": "universal"})
+                if response.status_code != 200:
+                    errors += 1
+                    return
+                latencies.append((time.perf_counter() - started) * 1000)
+                task_ids.append(response.json()["id"])
+
+        # Прогрев: подключения к Redis и брокеру Celery открываются на первых запросах
+        for _ in range(min(concurrency, 10)):
+            (await client.post("/tasks", json={"goal": "Прогрев", "agent": "universal"})).raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(create(i) for i in range(tasks)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "tasks": tasks,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "tasks_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": _percentile(latencies, 0.5),
+        "p99_ms": _percentile(latencies, 0.99),
+    }, task_ids
+
+
+def _step_latencies(redis_client, task_ids: list[str]) -> list[float]:
+    """Время шагов по ID событий потока задачи (миллисекунды Redis): от подключения браузера до каждого шага."""
+    from shared.task_events import task_stream_key
+
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.xrange(task_stream_key(task_id))
+    latencies = []
+    for events in pipe.execute():
+        previous = None
+        for event_id, fields in events:
+            step = json.loads(fields.get("data", "{}")).get("step")
+            if step not in ("browser_connected", "action"):
+                continue
+            ts = int(event_id.split("-")[0])
+            if previous is not None:
+                latencies.append(ts - previous)
+            previous = ts
+    return latencies
+
+
+def _prompt_tokens(redis_client, task_ids: list[str]) -> list[int]:
+    """Оценка токенов страницы в промптах шагов, решенных LLM (поле prompt_tokens событий шагов)."""
+    from shared.task_events import task_stream_key
+
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.xrange(task_stream_key(task_id))
+    tokens = []
+    for events in pipe.execute():
+        for _, fields in events:
+            data = json.loads(fields.get("data", "{}"))
+            if data.get("step") == "action" and data.get("source") == "llm" and data.get("prompt_tokens") is not None:
+                tokens.append(data["prompt_tokens"])
+    return tokens
+
+
+def bench_worker(task_ids: list[str], concurrency: int, steps: int, profile, browser: str) -> dict:
+    """Выполнение созданных задач через worker.run_agent_task в асинхронном режиме воркера."""
+    import redis
+    from worker import run_agent_task
+    from universal_agent.runtime import enable_runtime
+    from shared.task_store import TaskStore
+
+    runtime = enable_runtime(concurrency)
+    if browser == "stub":
+        runtime.browser_pool = FakeBrowserPool(profile)
+    redis_client = redis.Redis(host="127.0.0.1", port=int(os.environ["REDIS_PORT"]), decode_responses=True)
+    store = TaskStore(redis_client)
+    goals = {task_id: (store.get(task_id) or {}).get("goal", "") for task_id in task_ids}
+
+    rss_before = _rss_mb()
+    started = time.perf_counter()
+    with RSSSampler() as rss, ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="celery-task") as executor:
+        list(executor.map(lambda task_id: run_agent_task.apply(args=(task_id, goals[task_id]), kwargs={"agent": "universal"}), task_ids))
+    elapsed = time.perf_counter() - started
+
+    statuses: dict[str, int] = {}
+    for task_id in task_ids:
+        status = (store.get(task_id) or {}).get("status", "missing")
+        statuses[status] = statuses.get(status, 0) + 1
+    step_latencies = _step_latencies(redis_client, task_ids)
+    prompt_tokens = _prompt_tokens(redis_client, task_ids)
+
+    return {
+        "tasks": len(task_ids),
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "tasks_per_sec": round(statuses.get("completed", 0) / elapsed, 1),
+        "steps": len(step_latencies),
+        "step_p50_ms": _percentile(step_latencies, 0.5),
+        "step_p99_ms": _percentile(step_latencies, 0.99),
+        "prompt_tokens_per_step": round(sum(prompt_tokens) / len(prompt_tokens), 1) if prompt_tokens else 0.0,
+        "rss_per_agent_mb": round(max(rss.peak - rss_before, 0) / min(concurrency, len(task_ids) or 1), 3),
+    }
+
+
+def bench_replay(
+    api_loop: asyncio.AbstractEventLoop, tasks: int, concurrency: int, steps: int, profile, browser: str, runpod_stats: dict
+) -> dict:
+    """Два прохода с одинаковыми целями: первый записывает сценарии, второй повторяет их без LLM."""
+    try:
+        import chromadb
+    except ImportError:
+        return {"skipped": "пакет chromadb не установлен"}
+
+    from shared.memory import RAGMemory
+    from universal_agent.replay import ReplayEngine
+    from universal_agent.runtime import enable_runtime
+
+    runtime = enable_runtime(concurrency)
+    runtime.replay = ReplayEngine(memory=RAGMemory(client=chromadb.EphemeralClient()), enabled=True)
+
+    def llm_requests() -> int:
+        # Потоковые задания тоже запускаются через /run и уже учтены в "run"
+        return runpod_stats["run"] + runpod_stats["runsync"]
+
+    passes = []
+    for _ in range(2):
+        _, task_ids = api_loop.run_until_complete(bench_api(tasks, concurrency, steps))
+        before = llm_requests()
+        result = bench_worker(task_ids, concurrency, steps, profile, browser)
+        passes.append({**result, "llm_requests": llm_requests() - before})
+    cold, warm = passes
+    stats = runtime.replay.stats()
+    return {
+        "tasks": tasks,
+        "statuses": warm["statuses"],
+        "cold_tasks_per_sec": cold["tasks_per_sec"],
+        "tasks_per_sec": warm["tasks_per_sec"],
+        "llm_requests_cold": cold["llm_requests"],
+        "llm_requests_replay": warm["llm_requests"],
+        "hit_rate": round(stats["hits"] / tasks, 3),
+        "steps_replayed": stats["steps_replayed"],
+        "llm_calls_avoided": stats["llm_calls_avoided"],
+    }
+
+
+async def bench_memory(documents: int, queries: int, concurrency: int) -> dict:
+    """Массовая запись сценариев и конкурентный поиск в RAGMemory поверх in-memory ChromaDB."""
+    try:
+        import chromadb
+    except ImportError:
+        return {"skipped": "пакет chromadb не установлен"}
+
+    from shared.memory import RAGMemory
+
+    memory = RAGMemory(client=chromadb.EphemeralClient())
+    scenarios = [
+        {"goal": bench_goal(i, i % 10 + 1), "actions": [{"action": "click", "element_id": str(k)} for k in range(i % 5 + 1)]}
+        for i in range(documents)
+    ]
+    started = time.perf_counter()
+    ingest = await memory.add_scenarios(scenarios)
+    ingest_elapsed = time.perf_counter() - started
+
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def search(i: int):
+        async with semaphore:
+            query_started = time.perf_counter()
+            await memory.search_similar_scenarios(bench_goal(i % documents, i % 10 + 1))
+            latencies.append((time.perf_counter() - query_started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(search(i) for i in range(queries)))
+    elapsed = time.perf_counter() - started
+    return {
+        "documents": documents,
+        "ingest_failed": ingest["failed"],
+        "ingest_docs_per_sec": round(documents / ingest_elapsed, 1),
+        "queries": queries,
+        "ops_per_sec": round(queries / elapsed, 1),
+        "p50_ms": _percentile(latencies, 0.5),
+        "p99_ms": _percentile(latencies, 0.99),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Регрессии относительно базовых значений (доля tolerance — допустимое ухудшение)."""
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(scenario, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(base, (int, float)) or not base:
+                continue
+            if metric in _HIGHER_IS_BETTER and value < base * (1 - tolerance):
+                regressions.append(f"{scenario}.{metric}: {value} < {base} (база)")
+            elif metric in _LOWER_IS_BETTER and value > base * (1 + tolerance):
+                regressions.append(f"{scenario}.{metric}: {value} > {base} (база)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн сквозной бенчмарк API, воркера и RAG-памяти")
+    parser.add_argument("--scenarios", default="api,worker,memory", help="Через запятую: api, worker, memory, replay")
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--steps", type=int, default=5, help="Сколько страниц проходит агент в каждой задаче")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="realistic", help="Задержки и отказы заглушек")
+    parser.add_argument("--stream", action="store_true", help="Решения агента через потоковые ответы LLM")
+    parser.add_argument("--browser", choices=["stub", "chromium"], default="stub",
+                        help="stub — модельная страница, chromium — локальный headless-браузер playwright")
+    parser.add_argument("--documents", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--save-baseline", action="store_true", help="Сохранить результат как базовый для профиля")
+    parser.add_argument("--compare", action="store_true", help="Сравнить с базовым результатом профиля")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+    scenarios = {name.strip() for name in args.scenarios.split(",")}
+    if "worker" in scenarios:
+        # Воркеру нужны задачи, созданные через API
+        scenarios.add("api")
+    profile = PROFILES[args.profile]
+
+    redis_server = EphemeralRedis()
+    runpod = StubServer(create_runpod_stub(profile))
+    results: dict[str, dict] = {}
+    # Клиенты API (Redis оркестратора) привязаны к event loop: все запросы к API идут через один loop
+    api_loop = asyncio.new_event_loop()
+    try:
+        configure_environment(redis_server.start(), runpod.start(), args)
+        if "api" in scenarios:
+            results["api"], task_ids = api_loop.run_until_complete(bench_api(args.tasks, args.concurrency, args.steps))
+            if "worker" in scenarios:
+                results["worker"] = bench_worker(task_ids, args.concurrency, args.steps, profile, args.browser)
+        if "replay" in scenarios:
+            results["replay"] = bench_replay(
+                api_loop, args.tasks, args.concurrency, args.steps, profile, args.browser, runpod.app.state.stats
+            )
+        if "memory" in scenarios:
+            results["memory"] = asyncio.run(bench_memory(args.documents, args.queries, args.concurrency))
+        results["stub_requests"] = dict(runpod.app.state.stats)
+    finally:
+        runtime = sys.modules.get("universal_agent.runtime")
+        if runtime is not None and runtime.get_runtime() is not None:
+            runtime.get_runtime().shutdown()
+        api_loop.close()
+        runpod.stop()
+        redis_server.stop()
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    baseline_path = os.path.join(BASELINES_DIR, f"{args.profile}.json")
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            params = {name: getattr(args, name) for name in _WORKLOAD_PARAMS}
+            json.dump({"params": params, **results}, f, ensure_ascii=False, indent=2)
+        print(f"Базовые значения сохранены в {baseline_path}")
+    if args.compare:
+        if not os.path.exists(baseline_path):
+            raise SystemExit(f"Нет базовых значений: {baseline_path}")
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        differs = [name for name in _WORKLOAD_PARAMS if baseline.get("params", {}).get(name) != getattr(args, name)]
+        if differs:
+            print(f"Внимание: параметры нагрузки отличаются от базовых ({', '.join(differs)}), сравнение неточное")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Регрессии:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
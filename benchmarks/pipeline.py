@@ -0,0 +1,102 @@
+"""
+Конвейер шагов агента (universal_agent/pipeline.py) против последовательных шагов на модельной странице.
+
+Задача идет по модельному сайту (benchmarks/stubs.py): LLM отвечает через --llm-ms, снимок
+страницы стоит --capture-ms, проверка версии документа — --probe-ms, учет шага — --record-ms.
+Каждое --noop-every-е действие страницу не меняет (think, неудачный клик): только на таких
+шагах prefetch-снимок годится, на остальных он устаревает и снимается заново.
+
+Отчет: время задачи (медиана по --repeat прогонам) в обоих режимах и статистика конвейера
+(prefetch_hits, prefetch_stale, overlap_saved_ms).
+
+Запуск:
+    python benchmarks/pipeline.py
+    python benchmarks/pipeline.py --steps 6 --llm-ms 150 --capture-ms 65 --probe-ms 5 --record-ms 20 --noop-every 2
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import FakePage, StubProfile, bench_goal
+from universal_agent import perception
+from universal_agent.pipeline import PipelinedStepExecutor
+
+SITE_URL = "http://bench.local"
+
+
+class TimedPage(FakePage):
+    """Модельная страница, где снимок и проверка версии стоят разное время."""
+
+    def __init__(self, profile: StubProfile, capture_ms: float, probe_ms: float):
+        super().__init__(profile)
+        self.capture_ms = capture_ms
+        self.probe_ms = probe_ms
+
+    async def evaluate(self, script: str, arg=None):
+        version = f"{self._doc}:{self._version}"
+        if script is perception._MARK_ELEMENTS_JS:
+            await asyncio.sleep(self.capture_ms / 1000)
+            return {**self._page, "version": version}
+        if script is perception._PAGE_VERSION_JS:
+            await asyncio.sleep(self.probe_ms / 1000)
+            return version
+        return None
+
+
+async def run_task(args, enabled: bool) -> tuple[float, dict]:
+    profile = StubProfile(browser_ms=args.probe_ms, navigation_ms=args.navigation_ms, jitter=0)
+    page = TimedPage(profile, args.capture_ms, args.probe_ms)
+    await page.goto(f"{SITE_URL}/{args.steps + 1}/step/1")
+    pipeline = PipelinedStepExecutor(page, bench_goal(0, args.steps), enabled=enabled, warm_links=0)
+
+    async def llm() -> dict:
+        await asyncio.sleep(args.llm_ms / 1000)
+        return {}
+
+    async def perform(noop: bool) -> str:
+        if noop:
+            return "ok"
+        await page.click(perception.element_selector("1"))
+        return "ok"
+
+    started = time.perf_counter()
+    for step in range(1, args.steps + 1):
+        snapshot = await pipeline.perceive()
+        await pipeline.decide(llm, snapshot)
+        await pipeline.act(perform(args.noop_every > 0 and step % args.noop_every == 0))
+        await pipeline.defer(asyncio.sleep(args.record_ms / 1000))
+        pipeline.timing()
+    await pipeline.drain()
+    elapsed = time.perf_counter() - started
+    await pipeline.abort()
+    return elapsed, pipeline.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Конвейер шагов агента против последовательных шагов")
+    parser.add_argument("--steps", type=int, default=6)
+    parser.add_argument("--llm-ms", type=float, default=150)
+    parser.add_argument("--capture-ms", type=float, default=65)
+    parser.add_argument("--probe-ms", type=float, default=5)
+    parser.add_argument("--record-ms", type=float, default=20)
+    parser.add_argument("--navigation-ms", type=float, default=50)
+    parser.add_argument("--noop-every", type=int, default=2, help="Каждое N-е действие не меняет страницу (0 — все меняют)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    report = {}
+    for name, enabled in (("sequential", False), ("pipelined", True)):
+        runs = [asyncio.run(run_task(args, enabled)) for _ in range(args.repeat)]
+        report[name] = {"task_s": round(statistics.median(elapsed for elapsed, _ in runs), 3), **runs[-1][1]}
+    report["saved_ratio"] = round(1 - report["pipelined"]["task_s"] / report["sequential"]["task_s"], 3)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Время импорта и память процесса при старте API и воркеров.
+
+Каждый модуль импортируется в отдельном чистом интерпретаторе: замеряется время импорта,
+прирост RSS и то, какие тяжелые пакеты (браузерный стек, клиенты ChromaDB и LLM) попали в процесс.
+
+Запуск:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --modules orchestrator.main --repeat 5
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULES = ["orchestrator.main", "worker", "async_worker"]
+# Пакеты, которые API не должен загружать
+HEAVY_MODULES = [
+    "magnitude", "playwright", "chromadb", "universal_agent.agent", "universal_agent.async_agent",
+    "universal_agent.browser_pool", "shared.llm_client", "shared.memory",
+]
+
+_PROBE = """
+import sys, time, json, resource, importlib
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+before = rss_mb()
+started = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    "import_ms": elapsed * 1000,
+    "rss_mb": rss_mb() - before,
+    "loaded": [name for name in json.loads(sys.argv[2]) if name in sys.modules],
+}))
+"""
+
+
+def probe(module: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", _PROBE, module, json.dumps(HEAVY_MODULES)],
+        cwd=ROOT, capture_output=True, text=True, env={**os.environ, "WORKER_METRICS_PORT": "0"}
+    )
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "exit code"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта и память при старте процессов")
+    parser.add_argument("--modules", default=",".join(DEFAULT_MODULES))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    report = {}
+    for module in args.modules.split(","):
+        runs = [probe(module) for _ in range(args.repeat)]
+        failed = [run for run in runs if "error" in run]
+        if failed:
+            report[module] = failed[0]
+            continue
+        report[module] = {
+            "import_ms": round(statistics.median(run["import_ms"] for run in runs), 1),
+            "rss_mb": round(statistics.median(run["rss_mb"] for run in runs), 1),
+            "heavy_modules": runs[0]["loaded"],
+        }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Локальные заменители внешних сервисов для офлайн-бенчмарков (см. benchmarks/e2e.py):
+RunPod (/run, /status, /runsync, OpenAI-совместимые completions и embeddings) и браузер
+для асинхронных агентов. Задержки и доля ошибок задаются профилем.
+"""
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import threading
+import urllib.parse
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse
+from playwright.async_api import Error as PlaywrightError
+from universal_agent import perception
+
+
+@dataclass
+class StubProfile:
+    """Задержки (миллисекунды) и доли отказов заглушек."""
+    queue_ms: float = 50           # ожидание задачи в очереди RunPod (delayTime)
+    execution_ms: float = 300      # генерация ответа LLM (executionTime)
+    token_ms: float = 5            # пауза между токенами в потоковом ответе
+    embedding_ms: float = 20       # запрос эмбеддингов
+    browser_ms: float = 30         # вызов в страницу (снимок, проверка версии)
+    navigation_ms: float = 150     # переход по ссылке
+    jitter: float = 0.2            # случайное отклонение задержек (доля)
+    http_error_rate: float = 0.0   # доля ответов 503 на /run, /runsync и embeddings
+    job_failure_rate: float = 0.0  # доля задач RunPod, завершающихся статусом FAILED
+
+
+PROFILES = {
+    "fast": StubProfile(queue_ms=5, execution_ms=20, token_ms=0, embedding_ms=2, browser_ms=2, navigation_ms=5),
+    "realistic": StubProfile(),
+    "slow": StubProfile(queue_ms=400, execution_ms=1500, token_ms=20, embedding_ms=80, browser_ms=60, navigation_ms=600),
+    "flaky": StubProfile(http_error_rate=0.05, job_failure_rate=0.05),
+}
+
+# Модельный сайт бенчмарка: <site>/<n>/step/<k> — страница k из n со ссылкой "Дальше" на следующую.
+# Его отдает сервер заглушки (для настоящего браузера) и имитирует FakePage.
+NEXT_LINK_TEXT = "Дальше"
+_GOAL_RE = re.compile(r"пройти (\d+) страниц")
+_STEP_RE = re.compile(r"Шаг (\d+) из (\d+)")
+_NEXT_LINK_RE = re.compile(r'"id": "([^"]+)", "tag": "\w+", "text": "' + NEXT_LINK_TEXT + '"')
+_SITE_URL_RE = re.compile(r"/(\d+)/step/(\d+)")
+
+
+def _delay(ms: float, profile: StubProfile) -> float:
+    return max(ms * (1 + random.uniform(-profile.jitter, profile.jitter)), 0) / 1000
+
+
+def bench_goal(index: int, steps: int) -> str:
+    return f"Бенчмарк {index}: пройти {steps} страниц"
+
+
+def decide(prompt: str, site_url: str) -> str:
+    """
+    Ответ модельной LLM: открыть первую страницу сайта, затем идти по ссылке "Дальше",
+    пока не пройдены все страницы цели. Номер страницы берется максимальный — в промпте
+    может быть и полный снимок, и дифф к странице предыдущего шага.
+    """
+    goal = _GOAL_RE.search(prompt)
+    steps = [int(k) for k, _ in _STEP_RE.findall(prompt)]
+    link = _NEXT_LINK_RE.search(prompt)
+    if not steps and goal:
+        action = {"action": "browse", "url": f"{site_url}/{goal.group(1)}/step/1", "reasoning": "Начало"}
+    elif steps and goal and max(steps) < int(goal.group(1)) and link is not None:
+        action = {"action": "click", "element_id": link.group(1), "reasoning": "Следующая страница"}
+    else:
+        action = {"action": "finish", "result": "Пройдены все страницы", "reasoning": "Последняя страница"}
+    return json.dumps(action, ensure_ascii=False)
+
+
+def site_page(total: int, step: int) -> dict:
+    """Содержимое страницы модельного сайта в форме снимка perception."""
+    elements = []
+    if step < total:
+        elements.append({"id": "1", "tag": "a", "text": NEXT_LINK_TEXT, "href": f"../step/{step + 1}"})
+    return {"title": f"Бенчмарк {step}", "text": f"Шаг {step} из {total}", "elements": elements}
+
+
+def embed(text: str, dimensions: int = 64) -> list[float]:
+    """Детерминированный единичный вектор текста: одинаковые тексты дают одинаковые эмбеддинги."""
+    digest = hashlib.sha512(text.encode("utf-8")).digest()
+    vector = [digest[i % len(digest)] / 255 - 0.5 for i in range(dimensions)]
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+def _completions(job_input: dict, site_url: str) -> list:
+    """Выход воркера vLLM для одиночного промпта или пачки (input.openai_input.prompt — список)."""
+    prompts = (job_input.get("openai_input") or {}).get("prompt", job_input.get("prompt", ""))
+    if isinstance(prompts, list):
+        return [{"choices": [{"index": i, "text": decide(p, site_url)} for i, p in enumerate(prompts)]}]
+    return [{"choices": [{"text": decide(prompts, site_url)}]}]
+
+
+def create_runpod_stub(profile: StubProfile) -> FastAPI:
+    app = FastAPI(title="RunPod stub")
+    # Адрес модельного сайта становится известен после запуска сервера (StubServer.start)
+    app.state.site_url = "http://127.0.0.1/site"
+    jobs: dict[str, dict] = {}
+    app.state.stats = {"run": 0, "runsync": 0, "status": 0, "cancel": 0, "stream": 0, "embeddings": 0, "errors": 0}
+
+    def maybe_fail():
+        if random.random() < profile.http_error_rate:
+            app.state.stats["errors"] += 1
+            raise HTTPException(status_code=503, detail="stub: endpoint throttled")
+
+    def new_job(job_input: dict) -> dict:
+        queue, execution = _delay(profile.queue_ms, profile), _delay(profile.execution_ms, profile)
+        openai_input = job_input.get("openai_input") or {}
+        if openai_input.get("stream"):
+            return new_stream_job(openai_input.get("prompt", ""), queue)
+        job = {
+            "id": str(uuid.uuid4()),
+            "ready_at": time.monotonic() + queue + execution,
+            "delayTime": int(queue * 1000),
+            "executionTime": int(execution * 1000),
+            "failed": random.random() < profile.job_failure_rate,
+            "input": job_input,
+        }
+        jobs[job["id"]] = job
+        return job
+
+    def new_stream_job(prompt: str, queue: float) -> dict:
+        # Модель "дописывает" пояснение после JSON — клиент должен отменить задание раньше
+        text = decide(prompt, app.state.site_url) + "\nГотово, действие выбрано."
+        ready_at, tokens = time.monotonic() + queue, []
+        for token in re.findall(r".{1,4}", text, re.S):
+            ready_at += _delay(profile.token_ms, profile)
+            tokens.append((ready_at, token))
+        job = {"id": str(uuid.uuid4()), "tokens": tokens, "sent": 0}
+        jobs[job["id"]] = job
+        app.state.stats["stream"] += 1
+        return job
+
+    def job_status(job: dict) -> dict:
+        if time.monotonic() < job["ready_at"]:
+            return {"id": job["id"], "status": "IN_PROGRESS"}
+        jobs.pop(job["id"], None)
+        if job["failed"]:
+            return {"id": job["id"], "status": "FAILED", "error": "stub: job failed"}
+        return {
+            "id": job["id"], "status": "COMPLETED", "delayTime": job["delayTime"],
+            "executionTime": job["executionTime"], "output": _completions(job["input"], app.state.site_url)
+        }
+
+    @app.post("/{endpoint_id}/run")
+    async def run(endpoint_id: str, body: dict):
+        app.state.stats["run"] += 1
+        maybe_fail()
+        return {"id": new_job(body.get("input", {}))["id"], "status": "IN_QUEUE"}
+
+    @app.post("/{endpoint_id}/runsync")
+    async def runsync(endpoint_id: str, body: dict, wait: int = 10000):
+        app.state.stats["runsync"] += 1
+        maybe_fail()
+        job = new_job(body.get("input", {}))
+        await asyncio.sleep(min(max(job["ready_at"] - time.monotonic(), 0), wait / 1000))
+        return job_status(job)
+
+    @app.get("/{endpoint_id}/health")
+    async def health(endpoint_id: str):
+        return {"jobs": {"inQueue": 0, "inProgress": len(jobs)}, "workers": {"idle": 1, "running": 0}}
+
+    @app.get("/{endpoint_id}/status/{job_id}")
+    async def status(endpoint_id: str, job_id: str):
+        app.state.stats["status"] += 1
+        job = jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="stub: unknown job")
+        return job_status(job)
+
+    @app.get("/{endpoint_id}/stream/{job_id}")
+    async def stream(endpoint_id: str, job_id: str):
+        job = jobs.get(job_id)
+        if job is None or "tokens" not in job:
+            raise HTTPException(status_code=404, detail="stub: unknown stream job")
+        now = time.monotonic()
+        ready = [token for ready_at, token in job["tokens"][job["sent"]:] if ready_at <= now]
+        job["sent"] += len(ready)
+        finished = job["sent"] == len(job["tokens"])
+        if finished:
+            jobs.pop(job_id, None)
+        chunks = [
+            {"output": {"choices": [{"text": token, "finish_reason": "stop" if finished and i == len(ready) - 1 else None}]}}
+            for i, token in enumerate(ready)
+        ]
+        return {"id": job_id, "status": "COMPLETED" if finished else "IN_PROGRESS", "stream": chunks}
+
+    @app.post("/{endpoint_id}/cancel/{job_id}")
+    async def cancel(endpoint_id: str, job_id: str):
+        app.state.stats["cancel"] += 1
+        if jobs.pop(job_id, None) is None:
+            raise HTTPException(status_code=404, detail="stub: unknown job")
+        return {"id": job_id, "status": "CANCELLED"}
+
+    @app.post("/{endpoint_id}/openai/v1/completions")
+    async def completions(endpoint_id: str, body: dict):
+        maybe_fail()
+        await asyncio.sleep(_delay(profile.queue_ms, profile))
+        text = decide(body.get("prompt", ""), app.state.site_url)
+        await asyncio.sleep(_delay(profile.execution_ms, profile))
+        return {"choices": [{"text": text, "finish_reason": "stop"}]}
+
+    @app.post("/{endpoint_id}/openai/v1/embeddings")
+    async def embeddings(endpoint_id: str, request: Request):
+        app.state.stats["embeddings"] += 1
+        maybe_fail()
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(_delay(profile.embedding_ms, profile))
+        return {"data": [{"index": i, "embedding": embed(text)} for i, text in enumerate(texts)]}
+
+    @app.get("/site/{total}/step/{step}", response_class=HTMLResponse)
+    async def site(total: int, step: int):
+        await asyncio.sleep(_delay(profile.navigation_ms, profile))
+        page = site_page(total, step)
+        links = "".join(f'<a href="{el["href"]}">{el["text"]}</a>' for el in page["elements"])
+        return f"<html><head><title>{page['title']}</title></head><body><p>{page['text']}</p>{links}</body></html>"
+
+    return app
+
+
+class StubServer:
+    """uvicorn в фоновом потоке на свободном порту."""
+
+    def __init__(self, app: FastAPI, host: str = "127.0.0.1", port: int = 0):
+        self.app = app
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="off"))
+        self._thread = threading.Thread(target=self.server.run, name="runpod-stub", daemon=True)
+
+    def start(self) -> str:
+        self._thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        base_url = f"http://{host}:{port}"
+        self.app.state.site_url = f"{base_url}/site"
+        return base_url
+
+    def stop(self):
+        self.server.should_exit = True
+        self._thread.join(timeout=10)
+
+
+class FakePage:
+    """
+    Страница модельного сайта с интерфейсом playwright, который использует UniversalAgent:
+    evaluate() отвечает на скрипты universal_agent.perception так же, как браузер.
+    """
+
+    def __init__(self, profile: StubProfile):
+        self.profile = profile
+        self.url = "about:blank"
+        self._page = {"title": "", "text": "", "elements": []}
+        self._doc = uuid.uuid4().hex[:8]
+        self._version = 0
+
+    def set_default_timeout(self, timeout: float):
+        pass
+
+    async def evaluate(self, script: str, arg=None):
+        await asyncio.sleep(_delay(self.profile.browser_ms, self.profile))
+        version = f"{self._doc}:{self._version}"
+        if script is perception._MARK_ELEMENTS_JS:
+            return {**self._page, "version": version}
+        if script is perception._PAGE_VERSION_JS:
+            return version
+        return None
+
+    async def wait_for_load_state(self, state: str = "load", timeout: float | None = None):
+        await asyncio.sleep(_delay(self.profile.browser_ms, self.profile))
+
+    async def goto(self, url: str, wait_until: str | None = None):
+        match = _SITE_URL_RE.search(url)
+        if match is None:
+            raise PlaywrightError(f"net::ERR_NAME_NOT_RESOLVED at {url}")
+        await asyncio.sleep(_delay(self.profile.navigation_ms, self.profile))
+        self.url = url
+        self._page = site_page(int(match.group(1)), int(match.group(2)))
+        self._doc = uuid.uuid4().hex[:8]
+        self._version = 0
+
+    async def click(self, selector: str):
+        for element in self._page["elements"]:
+            if selector == perception.element_selector(element["id"]):
+                return await self.goto(urllib.parse.urljoin(self.url, element["href"]))
+        raise PlaywrightError(f"Timeout: элемент {selector} не найден")
+
+    async def fill(self, selector: str, text: str):
+        await asyncio.sleep(_delay(self.profile.browser_ms, self.profile))
+        self._version += 1
+
+
+class FakeContext:
+    def __init__(self, profile: StubProfile):
+        self.profile = profile
+
+    async def new_page(self) -> FakePage:
+        return FakePage(self.profile)
+
+    async def close(self):
+        pass
+
+
+class FakeBrowserPool:
+    """Заменитель AsyncBrowserPool: та же аренда контекста, но без браузера и CDP."""
+
+    def __init__(self, profile: StubProfile):
+        self.profile = profile
+        self.stats = {"connected": 0, "leases": 0, "disconnected": 0}
+
+    @asynccontextmanager
+    async def lease(self, endpoint: str | None = None):
+        self.stats["leases"] += 1
+        yield FakeContext(self.profile)
+
+    async def close_all(self):
+        pass
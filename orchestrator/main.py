@@ -1,22 +1,76 @@
 import shared.logging_config
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Header
+from fastapi.responses import StreamingResponse, Response
 import uuid
 import json
-from typing import List
-import redis
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Union
+from contextlib import asynccontextmanager
+import redis.asyncio as aioredis
 import os
-from .schemas import Task, TaskCreate, ResumeTaskRequest
+from .schemas import (
+    Task, TaskCreate, TaskPage, TaskBatchCreate, TaskBatchResponse, CampaignStopResponse,
+    EndpointRegistration, EndpointStatus, ResumeTaskRequest
+)
 from .orchestrator import orchestrator_instance
-from worker import run_agent_task
+from shared.task_store import InvalidCursorError, TERMINAL_STATUSES
+from shared.task_events import task_stream_key, read_events, format_sse, stream_last_id, ALL_EVENTS_STREAM
+from shared.metrics import HTTP_REQUEST_SECONDS, render_metrics
+from shared.tracing import bind_task
+from shared.celery_app import DEFAULT_PRIORITY, CAMPAIGN_DEFAULT_PRIORITY
 import logging
+from shared.config import REDIS_HOST, REDIS_PORT
 
-# Получаем хост Redis из переменной окружения
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-redis_client = redis.Redis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
+# Максимум задач в одном запросе POST /tasks/batch
+TASK_BATCH_MAX_SIZE = int(os.getenv("TASK_BATCH_MAX_SIZE", "10000"))
+# Сколько задач GET /tasks возвращает без явного limit: хранилище не читается целиком
+TASK_LIST_DEFAULT_LIMIT = int(os.getenv("TASK_LIST_DEFAULT_LIMIT", "100"))
+
+# Хранилище задач на общем асинхронном пуле соединений оркестратора
+task_store = orchestrator_instance.task_store
+# Отдельный клиент для долгих блокирующих чтений потоков событий, чтобы SSE-подписчики
+# не занимали соединения пула, нужные обычным запросам
+async_redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Web Agent Orchestrator")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Неподтвержденные остановки эскалирует любой экземпляр API, в том числе после перезапуска
+    escalations = asyncio.create_task(orchestrator_instance.run_escalations())
+    try:
+        yield
+    finally:
+        escalations.cancel()
+        try:
+            await escalations
+        except asyncio.CancelledError:
+            pass
+
+
+app = FastAPI(title="Web Agent Orchestrator", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Маршрут берем шаблоном (/tasks/{task_id}), а не фактическим путем, чтобы не плодить серии
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.labels(
+        method=request.method,
+        route=route.path if route is not None else "unmatched",
+        status=response.status_code
+    ).observe(time.perf_counter() - started)
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 
 @app.get("/")
@@ -26,40 +80,180 @@ def read_root():
 @app.post("/tasks", response_model=Task)
 async def create_task(task_create: TaskCreate):
     task_id = str(uuid.uuid4())
-    task = Task(id=task_id, **task_create.model_dump())
+    bind_task(task_id)
+    created_at = datetime.now(timezone.utc)
+    task = Task(id=task_id, created_at=created_at, **task_create.model_dump())
+    task.priority = task.priority or DEFAULT_PRIORITY
     
-    task = await orchestrator_instance.start_task(task)
-
-    # Сохраняем задачу в Redis
-    redis_client.set(f"task:{task_id}", task.model_dump_json())
+    # Сохраняем задачу в Redis (с регистрацией в индексах) и отправляем ее в Celery
+    try:
+        task = await orchestrator_instance.start_task(task)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Не удалось поставить задачу в очередь: {e}")
     
     return task
 
-@app.get("/tasks", response_model=List[Task])
-def get_tasks():
-    task_keys = redis_client.keys("task:*")
+@app.post("/tasks/batch", response_model=TaskBatchResponse)
+async def create_tasks_batch(batch: TaskBatchCreate):
+    """
+    Создает пачку задач одной кампании: записи сохраняются пачками через pipeline,
+    а задачи отправляются в Celery группами. ID кампании годится для фильтрации
+    списка задач и для остановки всей кампании.
+    """
+    if len(batch.items) > TASK_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Слишком много задач в запросе (максимум {TASK_BATCH_MAX_SIZE})")
+
+    campaign_id = batch.campaign_id or str(uuid.uuid4())
+    created_at = datetime.now(timezone.utc)
+    tasks = [
+        Task(id=str(uuid.uuid4()), created_at=created_at, **item.model_dump())
+        for item in batch.items
+    ]
+    for task in tasks:
+        task.priority = task.priority or CAMPAIGN_DEFAULT_PRIORITY
+    try:
+        await orchestrator_instance.start_tasks(tasks, campaign_id)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Не удалось поставить кампанию в очередь: {e}")
+
+    return TaskBatchResponse(campaign_id=campaign_id, task_ids=[task.id for task in tasks])
+
+# Размер страницы, которой читается полный список задач (all=true)
+TASK_LIST_CHUNK_SIZE = 500
+
+
+def _validate_tasks(task_dicts: list[dict]) -> List[Task]:
     tasks = []
-    for key in task_keys:
-        task_json = redis_client.get(key)
-        if not task_json:
-            continue
+    for task_data in task_dicts:
         try:
-            # Пытаемся валидировать JSON. Если не получается - пропускаем.
-            tasks.append(Task.model_validate_json(task_json))
+            # Пытаемся валидировать запись. Если не получается - пропускаем.
+            tasks.append(Task.model_validate(task_data))
         except Exception:
-            # Логируем ошибку, чтобы знать о проблемных ключах.
-            # В проде можно убрать, если будет слишком "шумно".
-            logger.warning(f"Не удалось распарсить JSON для ключа '{key}'. Значение: '{task_json}'")
-            continue
+            logger.warning(f"Не удалось провалидировать задачу '{task_data.get('id')}'. Значение: '{task_data}'")
     return tasks
 
+@app.get("/tasks", response_model=Union[List[Task], TaskPage])
+async def get_tasks(
+    response: Response,
+    status: Optional[str] = None,
+    campaign_id: Optional[str] = None,
+    paginate: bool = False,
+    all_tasks: bool = Query(False, alias="all"),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None
+):
+    """
+    Список задач (новые первыми) с фильтром по статусу и кампании.
+    По умолчанию возвращается массив из limit (TASK_LIST_DEFAULT_LIMIT) самых новых задач;
+    курсор следующей порции — в заголовке X-Next-Cursor. С paginate=true ответ — страница
+    {"items", "next_cursor"}. Весь список целиком читается только с явным all=true.
+    """
+    try:
+        if all_tasks:
+            tasks = []
+            while True:
+                task_dicts, cursor = await task_store.list_page(
+                    status=status, limit=TASK_LIST_CHUNK_SIZE, cursor=cursor, campaign_id=campaign_id
+                )
+                tasks.extend(_validate_tasks(task_dicts))
+                if cursor is None:
+                    return tasks
+
+        task_dicts, next_cursor = await task_store.list_page(
+            status=status, limit=limit or TASK_LIST_DEFAULT_LIMIT, cursor=cursor, campaign_id=campaign_id
+        )
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if paginate:
+        return TaskPage(items=_validate_tasks(task_dicts), next_cursor=next_cursor)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return _validate_tasks(task_dicts)
+
 @app.get("/tasks/{task_id}", response_model=Task)
-def get_task(task_id: str):
-    task_json = redis_client.get(f"task:{task_id}")
-    if not task_json:
-        # Тут можно добавить обработку ошибки 404
+async def get_task(task_id: str):
+    task_data = await task_store.get(task_id)
+    if not task_data:
         raise HTTPException(status_code=404, detail="Task not found")
-    return Task.model_validate_json(task_json)
+    return Task.model_validate(task_data)
+
+
+def _sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/tasks/{task_id}/events")
+async def stream_task_events(
+    task_id: str,
+    request: Request,
+    last_event_id: Optional[str] = Query(None, description="Продолжить после этого ID события"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Server-Sent Events: смены статуса и шаги задачи.
+    Без ID события отдает всю историю задачи, затем новые события.
+    Поток закрывается после перехода задачи в финальный статус, а также если задача уже
+    завершена или ее поток событий истек (TASK_STREAM_TTL) и новых событий не будет.
+    """
+    if not await task_store.get(task_id):
+        raise HTTPException(status_code=404, detail="Task not found")
+    stream = task_stream_key(task_id)
+    cursor = last_event_id_header or last_event_id or "0"
+
+    async def events():
+        nonlocal cursor
+        while not await request.is_disconnected():
+            entries = await read_events(async_redis_client, stream, cursor)
+            if not entries:
+                # Событие финального статуса уже отдано или вытеснено из потока — ждать нечего
+                if not await async_redis_client.exists(stream):
+                    return
+                task_data = await task_store.get(task_id)
+                if not task_data or task_data.get("status") in TERMINAL_STATUSES:
+                    return
+                yield ": ping\n\n"
+                continue
+            for event_id, fields in entries:
+                cursor = event_id
+                yield format_sse(event_id, fields)
+                if fields.get("type") == "status" and json.loads(fields["data"]).get("status") in TERMINAL_STATUSES:
+                    return
+
+    return _sse_response(events())
+
+
+@app.get("/events")
+async def stream_events(
+    request: Request,
+    task_id: Optional[List[str]] = Query(None, description="Фильтр по задачам (можно несколько)"),
+    last_event_id: Optional[str] = Query(None, description="Продолжить после этого ID события"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Server-Sent Events: общий поток событий многих задач в одном соединении.
+    Без ID события отдает только новые события.
+    """
+    task_ids = set(task_id or [])
+    # Точка отсчета фиксируется при подключении: события между чтениями не теряются
+    cursor = last_event_id_header or last_event_id or await stream_last_id(async_redis_client, ALL_EVENTS_STREAM)
+
+    async def events():
+        nonlocal cursor
+        while not await request.is_disconnected():
+            entries = await read_events(async_redis_client, ALL_EVENTS_STREAM, cursor)
+            if not entries:
+                yield ": ping\n\n"
+                continue
+            for event_id, fields in entries:
+                cursor = event_id
+                if not task_ids or fields.get("task_id") in task_ids:
+                    yield format_sse(event_id, fields)
+
+    return _sse_response(events())
 
 
 @app.post("/tasks/{task_id}/stop", response_model=Task)
@@ -68,22 +262,58 @@ async def stop_task(task_id: str):
     Принудительно останавливает выполнение задачи.
     """
     logger.info(f"Получен запрос на остановку задачи {task_id}")
-    stopped_task_data = orchestrator_instance.stop_task(task_id)
+    stopped_task_data = await orchestrator_instance.stop_task(task_id)
     if stopped_task_data is None:
         raise HTTPException(status_code=404, detail=f"Задача с ID {task_id} не найдена для остановки")
-    return Task(**stopped_task_data, id=task_id)
+    return Task.model_validate(stopped_task_data)
+
+
+@app.post("/campaigns/{campaign_id}/stop", response_model=CampaignStopResponse)
+async def stop_campaign(campaign_id: str):
+    """
+    Принудительно останавливает все еще активные задачи кампании.
+    """
+    logger.info(f"Получен запрос на остановку кампании {campaign_id}")
+    stopped_ids = await orchestrator_instance.stop_campaign(campaign_id)
+    if stopped_ids is None:
+        raise HTTPException(status_code=404, detail=f"Кампания {campaign_id} не найдена")
+    return CampaignStopResponse(campaign_id=campaign_id, stopped_task_ids=stopped_ids)
+
+
+@app.put("/endpoints", response_model=EndpointRegistration)
+async def register_endpoint(registration: EndpointRegistration):
+    """
+    Регистрирует эндпоинт браузера (или обновляет его емкость и группы).
+    Перерегистрация возвращает выведенный из ротации эндпоинт обратно.
+    """
+    await orchestrator_instance.endpoint_registry.register(registration.url, registration.capacity, registration.groups)
+    return registration
+
+
+@app.get("/endpoints", response_model=List[EndpointStatus])
+async def list_endpoints():
+    """Зарегистрированные эндпоинты с текущей загрузкой и состоянием."""
+    return [EndpointStatus(**item) for item in await orchestrator_instance.endpoint_registry.list_endpoints()]
+
+
+@app.delete("/endpoints")
+async def remove_endpoint(url: str):
+    """Убирает эндпоинт из реестра и всех групп. Уже идущие на нем задачи не прерываются."""
+    if not await orchestrator_instance.endpoint_registry.remove(url):
+        raise HTTPException(status_code=404, detail=f"Эндпоинт {url} не зарегистрирован")
+    return {"removed": url}
 
 
 @app.post("/tasks/{task_id}/resume", response_model=Task)
-def resume_task(task_id: str, resume_request: ResumeTaskRequest):
+async def resume_task(task_id: str, resume_request: ResumeTaskRequest):
     """
     Возобновляет задачу, застрявшую на этапе Human Intervention.
     """
-    task_json = redis_client.get(f"task:{task_id}")
-    if not task_json:
+    task_data = await task_store.get(task_id)
+    if not task_data:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    task = Task.model_validate_json(task_json)
+    task = Task.model_validate(task_data)
     if task.status != 'human_intervention_required':
         raise HTTPException(status_code=400, detail=f"Task status is '{task.status}', not 'human_intervention_required'")
 
@@ -96,19 +326,52 @@ def resume_task(task_id: str, resume_request: ResumeTaskRequest):
     if not browser_endpoint_url:
         raise HTTPException(status_code=400, detail="Не удалось найти browser_endpoint_url в контексте ошибки для возобновления.")
 
-    # Создаем новый, простой план из одного действия, предоставленного оператором.
-    # В новой архитектуре агент не использует "план", а действует по шагам.
-    # Мы можем передать ему новую цель.
-    new_goal = f"Возобновляю работу. Следующее действие, продиктованное человеком: {resume_request.action}"
+    # Compare-and-set защищает от двойного возобновления параллельными запросами
+    if not await task_store.update(task.id, expected_status="human_intervention_required", status="queued"):
+        raise HTTPException(status_code=409, detail="Задача уже возобновлена или изменила статус")
 
     logger.info(f"Отправляю задачу на возобновление для эндпоинта: {browser_endpoint_url}")
-    run_agent_task.delay(
-        task_id=task.id,
-        goal=new_goal, 
-        initial_browser_endpoints=[browser_endpoint_url]
-    )
+    # Цель остается прежней: агент восстановит историю по контрольным точкам и первым шагом
+    # выполнит действие оператора. Оператор ждет результата — задача идет впереди фоновых.
+    try:
+        await orchestrator_instance.dispatch_agent_task(
+            task.id, task.goal, [browser_endpoint_url],
+            priority="interactive", tenant=task.tenant, operator_action=resume_request.action, agent=task.agent
+        )
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Не удалось поставить задачу в очередь: {e}")
 
     task.status = "queued"
-    redis_client.set(f"task:{task.id}", task.model_dump_json())
-    
+    return task
+
+
+@app.post("/tasks/{task_id}/retry", response_model=Task)
+async def retry_task(task_id: str):
+    """
+    Перезапускает задачу, завершившуюся ошибкой. Агент продолжит с последнего сохраненного
+    шага, если контрольные точки задачи еще не истекли (CHECKPOINT_RETENTION_SECONDS).
+    """
+    task_data = await task_store.get(task_id)
+    if not task_data:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    task = Task.model_validate(task_data)
+    if task.status != "error":
+        raise HTTPException(status_code=400, detail=f"Task status is '{task.status}', not 'error'")
+
+    reason = f"Перезапуск после ошибки: {task.status_reason}"
+    if not await task_store.update(task.id, expected_status="error", status="queued", status_reason=reason):
+        raise HTTPException(status_code=409, detail="Задача уже перезапущена или изменила статус")
+
+    logger.info(f"Перезапускаю задачу {task_id} после ошибки: {task.status_reason}")
+    try:
+        await orchestrator_instance.dispatch_agent_task(
+            task.id, task.goal, task.browser_endpoints or [], task.endpoint_group, task.priority, task.tenant,
+            agent=task.agent
+        )
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Не удалось поставить задачу в очередь: {e}")
+
+    task.status = "queued"
+    task.status_reason = reason
     return task 
\ No newline at end of file
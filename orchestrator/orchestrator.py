@@ -1,60 +1,302 @@
 from .schemas import Task
 # Мы больше не импортируем SessionAgent напрямую
 # from session_agent.agent import SessionAgent 
-from worker import run_agent_task, celery_app
+from shared.celery_app import celery_app, queue_for, RUN_AGENT_TASK, DEFAULT_AGENT
+from shared.endpoint_scheduler import EndpointRegistry
+from shared.task_store import AsyncTaskStore, CELERY_ID_KEY, TERMINAL_STATUSES, TASK_STATUSES
+from shared.task_cancel import (
+    arequest_cancel, apending_cancels, aclaim_due_escalations, ESCALATION_KEY,
+    TASK_STOP_ESCALATION_SECONDS, TASK_STOP_SWEEP_INTERVAL
+)
+from shared.metrics import TASK_CANCELLATIONS
+from concurrent.futures import ThreadPoolExecutor
+from celery import group
+import asyncio
+import time
+import uuid
 import logging
-import redis
+import redis.asyncio as aioredis
 import os
+from shared.config import REDIS_HOST, REDIS_PORT
 
 logger = logging.getLogger(__name__)
 
+# Размер общего пула соединений API с Redis (запросы ждут свободное соединение, а не падают)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+# Потоки для отправки задач в Celery: клиент брокера блокирующий, держим его вне event loop
+CELERY_DISPATCH_THREADS = int(os.getenv("CELERY_DISPATCH_THREADS", "16"))
+# По сколько задач кампании писать в Redis одной транзакцией и отправлять одной группой Celery
+TASK_BATCH_CHUNK_SIZE = int(os.getenv("TASK_BATCH_CHUNK_SIZE", "500"))
+
 class Orchestrator:
     def __init__(self):
-        self.redis_client = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=6379, db=0)
+        self.redis_pool = aioredis.BlockingConnectionPool(
+            host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS
+        )
+        self.redis_client = aioredis.Redis(connection_pool=self.redis_pool)
+        self.task_store = AsyncTaskStore(self.redis_client)
+        self.endpoint_registry = EndpointRegistry(self.redis_client)
         self.celery_app = celery_app
+        self._dispatch_executor = ThreadPoolExecutor(max_workers=CELERY_DISPATCH_THREADS, thread_name_prefix="celery-dispatch")
+
+    async def _run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._dispatch_executor, lambda: func(*args, **kwargs))
+
+    async def _send_to_celery(
+        self,
+        task_id: str,
+        goal: str,
+        browser_endpoints: list[str],
+        endpoint_group: str | None = None,
+        priority: str | None = None,
+        tenant: str | None = None,
+        operator_action: dict | None = None,
+        celery_task_id: str | None = None,
+        agent: str = DEFAULT_AGENT
+    ) -> str:
+        """
+        Ставит задачу агента в очередь ее приоритета и агента, не блокируя event loop.
+        celery_task_id задают, когда запись задачи сохраняется до отправки.
+        """
+        kwargs = self._task_kwargs(task_id, goal, browser_endpoints, endpoint_group, priority, tenant, agent)
+        if operator_action is not None:
+            kwargs["operator_action"] = operator_action
+        async_result = await self._run_blocking(
+            self.celery_app.send_task,
+            RUN_AGENT_TASK,
+            kwargs=kwargs,
+            queue=queue_for(priority, agent),
+            task_id=celery_task_id
+        )
+        return async_result.id
+
+    @staticmethod
+    def _task_kwargs(
+        task_id: str,
+        goal: str,
+        browser_endpoints: list[str],
+        endpoint_group: str | None,
+        priority: str | None,
+        tenant: str | None,
+        agent: str
+    ) -> dict:
+        return {
+            "task_id": task_id,
+            "goal": goal,
+            "initial_browser_endpoints": browser_endpoints,
+            "endpoint_group": endpoint_group,
+            "priority": priority,
+            "tenant": tenant,
+            "agent": agent,
+            # Воркер считает по этой отметке время ожидания в очереди
+            "enqueued_at": time.time()
+        }
+
+    async def dispatch_agent_task(
+        self,
+        task_id: str,
+        goal: str,
+        browser_endpoints: list[str],
+        endpoint_group: str | None = None,
+        priority: str | None = None,
+        tenant: str | None = None,
+        operator_action: dict | None = None,
+        agent: str = DEFAULT_AGENT
+    ) -> str:
+        """
+        Повторно отправляет существующую задачу агенту (возобновление, перезапуск).
+        Агент продолжит с последней контрольной точки задачи. Вызывающий уже перевел
+        задачу в 'queued'; если отправить ее не удалось, она переводится в 'error'.
+        """
+        try:
+            celery_task_id = await self._send_to_celery(
+                task_id, goal, browser_endpoints, endpoint_group, priority, tenant, operator_action, agent=agent
+            )
+        except Exception as e:
+            await self._mark_unsent(task_id, e)
+            raise
+        await self.redis_client.set(CELERY_ID_KEY.format(task_id=task_id), celery_task_id)
+        return celery_task_id
+
+    async def _mark_unsent(self, task_id: str, error: Exception):
+        # Неотправленная задача не должна навсегда остаться в 'queued': ее не выполнит ни один воркер
+        logger.error(f"Ошибка отправки задачи {task_id} в Celery: {error}")
+        await self.task_store.update(
+            task_id,
+            expected_status="queued",
+            status="error",
+            status_reason=f"Не удалось поставить задачу в очередь: {error}"
+        )
 
     async def start_task(self, task: Task):
+        """
+        Сохраняет новую задачу вместе с Celery ID за один round trip и отправляет ее в Celery.
+        Celery ID генерируется заранее, чтобы запись появилась до отправки: иначе воркер мог
+        взять задачу раньше, чем она сохранена, а сохранение — перезаписать его статус.
+        """
         logger.info(f"Запуск задачи '{task.goal}' (ID: {task.id})")
-        
-        async_result = run_agent_task.delay(
-            task_id=task.id,
-            goal=task.goal,
-            initial_browser_endpoints=task.browser_endpoints or []
-        )
-        
-        celery_task_id = async_result.id
-        self.redis_client.set(f"task:celery_id:{task.id}", celery_task_id)
-        logger.info(f"Задача {task.id} запущена в Celery с ID {celery_task_id}")
+        celery_task_id = str(uuid.uuid4())
 
         task.status = "queued"
+        await self.task_store.save(
+            task.model_dump(mode="json"),
+            created_at=task.created_at.timestamp() if task.created_at else None,
+            new=True,
+            celery_task_id=celery_task_id
+        )
+
+        try:
+            await self._send_to_celery(
+                task.id, task.goal, task.browser_endpoints or [], task.endpoint_group, task.priority, task.tenant,
+                celery_task_id=celery_task_id, agent=task.agent
+            )
+        except Exception as e:
+            await self._mark_unsent(task.id, e)
+            raise
+        logger.info(f"Задача {task.id} запущена в Celery с ID {celery_task_id}")
         return task
 
-    def get_task_status(self, task_id: str) -> dict | None:
-        task_data_bytes = self.redis_client.hgetall(f"task:{task_id}")
-        if not task_data_bytes:
-            return None
-        return {key.decode(): value.decode() for key, value in task_data_bytes.items()}
+    async def start_tasks(self, tasks: list[Task], campaign_id: str) -> list[Task]:
+        """
+        Запускает пачку задач одной кампании.
+        Celery ID генерируются заранее, поэтому задачи сохраняются (пачками в pipeline)
+        до отправки и воркер гарантированно находит свою запись. Отправка — группами Celery.
+        """
+        logger.info(f"Запуск кампании {campaign_id}: {len(tasks)} задач")
+        pairs = [(task, str(uuid.uuid4())) for task in tasks]
+        for task in tasks:
+            task.status = "queued"
+            task.campaign_id = campaign_id
+
+        created_at = tasks[0].created_at.timestamp() if tasks[0].created_at else None
+        await self.task_store.save_many(
+            [(task.model_dump(mode="json"), celery_id) for task, celery_id in pairs],
+            created_at=created_at,
+            chunk_size=TASK_BATCH_CHUNK_SIZE
+        )
+
+        for start in range(0, len(tasks), TASK_BATCH_CHUNK_SIZE):
+            signatures = group(
+                self.celery_app.signature(RUN_AGENT_TASK, kwargs=self._task_kwargs(
+                    task.id, task.goal, task.browser_endpoints or [], task.endpoint_group, task.priority, task.tenant,
+                    task.agent
+                )).set(task_id=celery_id, queue=queue_for(task.priority, task.agent))
+                for task, celery_id in pairs[start:start + TASK_BATCH_CHUNK_SIZE]
+            )
+            try:
+                await self._run_blocking(signatures.apply_async)
+            except Exception as e:
+                # Неотправленные задачи не должны навсегда остаться в 'queued'
+                failed_ids = [task.id for task in tasks[start:]]
+                logger.error(f"Ошибка отправки кампании {campaign_id} в Celery: {e}. Не отправлено задач: {len(failed_ids)}")
+                await self.task_store.update_many(
+                    failed_ids,
+                    expected_status="queued",
+                    chunk_size=TASK_BATCH_CHUNK_SIZE,
+                    status="error",
+                    status_reason=f"Не удалось поставить задачу в очередь: {e}"
+                )
+                raise
+
+        logger.info(f"Кампания {campaign_id} отправлена в Celery")
+        return tasks
+
+    async def get_task_status(self, task_id: str) -> dict | None:
+        return await self.task_store.get(task_id)
 
-    def stop_task(self, task_id: str) -> dict | None:
+    async def stop_task(self, task_id: str) -> dict | None:
         """Принудительно останавливает задачу."""
-        task_data = self.get_task_status(task_id)
-        if not task_data:
+        # Compare-and-set: завершенную задачу не перезаписываем и не трогаем ее воркер
+        active_statuses = [status for status in TASK_STATUSES if status not in TERMINAL_STATUSES]
+        updated = await self.task_store.update(
+            task_id,
+            expected_status=active_statuses,
+            status="stopped",
+            status_reason="Принудительно остановлена пользователем."
+        )
+        if updated is None:
             logger.warning(f"Попытка остановить несуществующую задачу: {task_id}")
             return None
+        if not updated:
+            logger.info(f"Задача {task_id} уже завершена, остановка не требуется.")
+            return await self.get_task_status(task_id)
 
-        celery_task_id_bytes = self.redis_client.get(f"task:celery_id:{task_id}")
+        celery_task_id = await self.redis_client.get(CELERY_ID_KEY.format(task_id=task_id))
 
-        if celery_task_id_bytes:
-            celery_task_id = celery_task_id_bytes.decode()
-            logger.info(f"Отправка команды на остановку для Celery задачи {celery_task_id} (наша задача {task_id})")
-            self.celery_app.control.revoke(celery_task_id, terminate=True, signal='SIGKILL')
+        if celery_task_id:
+            logger.info(f"Запрашиваю остановку Celery задачи {celery_task_id} (наша задача {task_id})")
+            await self._request_cancel({task_id: celery_task_id}, "Остановлена пользователем")
         else:
-            logger.warning(f"Не найден Celery ID для задачи {task_id}. Возможно, она уже завершена. Статус будет обновлен на 'stopped'.")
+            logger.warning(f"Не найден Celery ID для задачи {task_id}. Возможно, она уже завершена. Статус обновлен на 'stopped'.")
 
-        self.redis_client.hset(f"task:{task_id}", "status", "stopped")
-        self.redis_client.hset(f"task:{task_id}", "status_reason", "Принудительно остановлена пользователем.")
-        
         logger.info(f"Статус задачи {task_id} обновлен на 'stopped'.")
-        return self.get_task_status(task_id)
+        return await self.get_task_status(task_id)
+
+    async def stop_campaign(self, campaign_id: str) -> list[str] | None:
+        """Останавливает все активные задачи кампании. Возвращает ID остановленных задач."""
+        task_ids = await self.task_store.campaign_task_ids(campaign_id)
+        if not task_ids:
+            return None
+
+        active_statuses = [status for status in TASK_STATUSES if status not in TERMINAL_STATUSES]
+        outcomes = await self.task_store.update_many(
+            task_ids,
+            expected_status=active_statuses,
+            chunk_size=TASK_BATCH_CHUNK_SIZE,
+            status="stopped",
+            status_reason="Кампания принудительно остановлена пользователем."
+        )
+        stopped_ids = [task_id for task_id, updated in zip(task_ids, outcomes) if updated]
+
+        celery_ids = await self.task_store.get_celery_ids(stopped_ids)
+        targets = {task_id: celery_id for task_id, celery_id in zip(stopped_ids, celery_ids) if celery_id}
+        if targets:
+            await self._request_cancel(targets, f"Кампания {campaign_id} остановлена пользователем")
+
+        logger.info(f"Кампания {campaign_id}: остановлено задач {len(stopped_ids)} из {len(task_ids)}")
+        return stopped_ids
+
+    async def _request_cancel(self, targets: dict[str, str], reason: str):
+        """
+        Кооперативная остановка: флаг в Redis и сообщение воркерам, агент выходит сам
+        и освобождает браузер, процесс воркера продолжает работу. Задачи, отмену которых
+        воркер не подтвердил за TASK_STOP_ESCALATION_SECONDS, снимает SIGKILL периодическая
+        проверка (run_escalations): срок хранится в Redis, а не в памяти процесса API.
+        """
+        await arequest_cancel(self.redis_client, targets, reason, escalate_after=TASK_STOP_ESCALATION_SECONDS)
+
+    async def escalate_due_stops(self) -> list[str]:
+        """Снимает SIGKILL задачи с истекшим сроком подтверждения остановки. Возвращает их ID."""
+        due = await aclaim_due_escalations(self.redis_client)
+        pending = await apending_cancels(self.redis_client, due)
+        if not pending:
+            return []
+        celery_ids = await self.task_store.get_celery_ids(pending)
+        targets = {task_id: celery_id for task_id, celery_id in zip(pending, celery_ids) if celery_id}
+        logger.warning(
+            f"Воркеры не подтвердили остановку {len(pending)} задач за {TASK_STOP_ESCALATION_SECONDS:g} с, "
+            f"отправляю SIGKILL: {pending[:10]}"
+        )
+        TASK_CANCELLATIONS.labels(outcome="escalated").inc(len(pending))
+        if targets:
+            # revoke принимает список: одно широковещательное сообщение на все задачи.
+            # Задача, которая еще ждет в очереди, будет просто отброшена воркером.
+            try:
+                await self._run_blocking(self.celery_app.control.revoke, list(targets.values()), terminate=True, signal='SIGKILL')
+            except Exception:
+                # Брокер недоступен: возвращаем задачи в очередь эскалаций до следующей проверки
+                await self.redis_client.zadd(ESCALATION_KEY, {task_id: time.time() for task_id in targets})
+                raise
+        return pending
+
+    async def run_escalations(self, interval: float = TASK_STOP_SWEEP_INTERVAL):
+        """Фоновая проверка остановок на время жизни API; сбои Redis и брокера не прерывают ее."""
+        while True:
+            try:
+                await self.escalate_due_stops()
+            except Exception as e:
+                logger.error(f"Не удалось завершить остановку задач: {e}")
+            await asyncio.sleep(interval)
 
-orchestrator_instance = Orchestrator() 
\ No newline at end of file
+orchestrator_instance = Orchestrator() 
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Literal, Optional
+from datetime import datetime
 
 class TaskCreate(BaseModel):
     goal: str
@@ -8,6 +9,19 @@ class TaskCreate(BaseModel):
         description="(Опционально) Список URL-адресов эндпоинтов браузеров для предоставления агенту",
         examples=[["wss://your-tunnel-1.ngrok.io"]]
     )
+    endpoint_group: Optional[str] = Field(
+        None,
+        description="(Опционально) Группа зарегистрированных эндпоинтов, из которой планировщик выберет наименее загруженный"
+    )
+    priority: Optional[Literal["interactive", "normal", "bulk"]] = Field(
+        None,
+        description="(Опционально) Приоритет очереди. По умолчанию normal, для задач кампании — bulk"
+    )
+    tenant: Optional[str] = Field(None, description="(Опционально) Клиент, от имени которого создана задача")
+    agent: Literal["magnitude", "universal"] = Field(
+        "magnitude",
+        description="Агент: magnitude (обычный воркер) или universal (асинхронный воркер, async_worker.py)"
+    )
 
 class Task(TaskCreate):
     id: str
@@ -18,9 +32,48 @@ class Task(TaskCreate):
         description="Контекст для Human-in-the-Loop"
     )
     result: Optional[Any] = Field(None, description="Финальный результат выполнения задачи")
+    created_at: Optional[datetime] = Field(None, description="Время создания задачи")
+    steps_completed: int = Field(0, description="Сколько шагов агент уже выполнил")
+    campaign_id: Optional[str] = Field(None, description="Кампания, в составе которой задача была создана")
+
+class TaskPage(BaseModel):
+    items: List[Task]
+    next_cursor: Optional[str] = Field(
+        None,
+        description="Курсор для запроса следующей страницы (None, если страница последняя)"
+    )
+
+class TaskBatchCreate(BaseModel):
+    items: List[TaskCreate] = Field(..., min_length=1, description="Задачи кампании")
+    campaign_id: Optional[str] = Field(
+        None,
+        description="(Опционально) Общий ID кампании. Если не задан, будет сгенерирован"
+    )
+
+class TaskBatchResponse(BaseModel):
+    campaign_id: str
+    task_ids: List[str] = Field(..., description="ID созданных задач в порядке items")
+
+class CampaignStopResponse(BaseModel):
+    campaign_id: str
+    stopped_task_ids: List[str] = Field(..., description="Задачи, остановленные этим запросом")
+
+class EndpointRegistration(BaseModel):
+    url: str = Field(..., description="URL эндпоинта браузера (как в browser_endpoints)")
+    capacity: int = Field(1, ge=1, description="Сколько задач эндпоинт выполняет одновременно")
+    groups: List[str] = Field(default_factory=list, description="Группы, в которые входит эндпоинт")
+
+class EndpointStatus(EndpointRegistration):
+    active_leases: int = 0
+    consecutive_failures: int = 0
+    quarantined_until: Optional[float] = Field(None, description="До какого момента (unix time) эндпоинт выведен из ротации")
 
 class ResumeTaskRequest(BaseModel):
     action: Dict[str, Any] = Field(
         ...,
+        description=(
+            "Действие, которое агент выполнит первым шагом. element_id (или selector) — CSS-селектор, "
+            "он передается в браузер как есть"
+        ),
         example={"action": "click", "element_id": "#new_selector_provided_by_human"}
     ) 
\ No newline at end of file
@@ -0,0 +1,47 @@
+from celery import Celery
+from kombu import Queue
+from shared.config import REDIS_HOST, REDIS_PORT
+
+# Имя задачи агента: API ставит ее в очередь по имени, не импортируя worker
+# (и вместе с ним агентов, браузерный стек и клиент LLM)
+RUN_AGENT_TASK = "worker.run_agent_task"
+
+# Приоритеты задач в порядке обслуживания: у каждого своя очередь Celery
+TASK_PRIORITIES = ("interactive", "normal", "bulk")
+TASK_QUEUES = {priority: f"agents.{priority}" for priority in TASK_PRIORITIES}
+DEFAULT_PRIORITY = "normal"
+
+# Агенты: magnitude выполняет обычный (prefork) воркер, universal — асинхронный (async_worker.py).
+# Агент выбирается при создании задачи, и у каждого свои очереди: задачу берет только воркер,
+# который умеет выполнять ее агента
+AGENT_TYPES = ("magnitude", "universal")
+DEFAULT_AGENT = "magnitude"
+UNIVERSAL_TASK_QUEUES = {priority: f"agents.universal.{priority}" for priority in TASK_PRIORITIES}
+# Задачи кампаний без явного приоритета идут фоном и не задерживают интерактивные
+CAMPAIGN_DEFAULT_PRIORITY = "bulk"
+# Очередь по умолчанию прежних версий: воркеры дочитывают задачи, поставленные до перехода на приоритеты
+LEGACY_QUEUE = "celery"
+
+
+def queue_for(priority: str | None, agent: str | None = None) -> str:
+    queues = UNIVERSAL_TASK_QUEUES if agent == "universal" else TASK_QUEUES
+    return queues.get(priority or DEFAULT_PRIORITY, queues[DEFAULT_PRIORITY])
+
+
+# Настраиваем Celery
+celery_app = Celery(
+    'tasks',
+    broker=f'redis://{REDIS_HOST}:{REDIS_PORT}/0',
+    backend=f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
+)
+celery_app.conf.update(
+    # Очереди, которые воркер слушает по умолчанию (prefork, агент magnitude);
+    # асинхронный воркер передает свои очереди через -Q
+    task_queues=[Queue(name) for name in (*TASK_QUEUES.values(), LEGACY_QUEUE)],
+    task_default_queue=TASK_QUEUES[DEFAULT_PRIORITY],
+    # Воркер опрашивает очереди строго в порядке task_queues: задачу bulk он возьмет,
+    # только когда в interactive и normal пусто
+    broker_transport_options={"queue_order_strategy": "priority"},
+    # Без запаса заранее взятых задач: иначе пачка bulk ждала бы в процессе воркера впереди новых interactive
+    worker_prefetch_multiplier=1,
+)
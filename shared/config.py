@@ -0,0 +1,11 @@
+import os
+from dotenv import load_dotenv
+
+# Общие адреса внешних сервисов для всех процессов. Значения из .env не перекрывают
+# уже заданные переменные окружения (docker-compose, бенчмарки)
+load_dotenv()
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# Базовый адрес API RunPod (переопределяется для локальных заглушек в бенчмарках)
+RUNPOD_API_BASE = os.getenv("RUNPOD_API_BASE", "https://api.runpod.ai/v2")
@@ -0,0 +1,214 @@
+import os
+import json
+import logging
+from bs4 import BeautifulSoup, Comment, Tag
+import redis.asyncio as aioredis
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Бюджет токенов на содержимое страницы в промпте (HTML или perception)
+PROMPT_PAGE_TOKEN_BUDGET = int(os.getenv("PROMPT_PAGE_TOKEN_BUDGET", "3000"))
+# Грубая оценка длины токена в символах (русский текст и разметка — около 3-4 символов)
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", "3.5"))
+
+# Теги, которые никогда не несут полезного для агента содержимого
+_DROP_TAGS = ["script", "style", "noscript", "svg", "canvas", "template", "iframe", "head", "meta", "link", "object", "embed"]
+# Блоки текста, которые оставляем как контекст (по убыванию важности)
+_HEADING_TAGS = ["h1", "h2", "h3", "h4", "h5", "h6", "label", "legend", "th"]
+_TEXT_TAGS = ["p", "li", "td", "dt", "dd", "caption", "summary", "span", "div"]
+_KEPT_ATTRS = ["type", "name", "role", "href", "placeholder", "aria-label", "title", "value", "alt"]
+_MAX_LINE_CHARS = 160
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / PROMPT_CHARS_PER_TOKEN) + 1 if text else 0
+
+
+def _report(original: str, distilled: str) -> dict:
+    original_tokens = estimate_tokens(original)
+    tokens = estimate_tokens(distilled)
+    return {"original_tokens": original_tokens, "tokens": tokens, "saved_tokens": max(original_tokens - tokens, 0)}
+
+
+def _clip(text: str, limit: int = _MAX_LINE_CHARS) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _is_hidden(element: Tag) -> bool:
+    style = (element.get("style") or "").replace(" ", "").lower()
+    return (
+        element.has_attr("hidden")
+        or element.get("aria-hidden") == "true"
+        or element.get("type") == "hidden"
+        or "display:none" in style
+        or "visibility:hidden" in style
+    )
+
+
+def _nearby_label(element: Tag, labels: dict[str, str]) -> str:
+    """Подпись элемента: <label for>, обертывающий <label> или ближайший предшествующий текст."""
+    if element.get("id") in labels:
+        return labels[element["id"]]
+    wrapping = element.find_parent("label")
+    if wrapping:
+        return wrapping.get_text(" ", strip=True)
+    previous = element.find_previous(string=lambda s: s.strip() and not isinstance(s, Comment))
+    if previous and previous.parent is not None and previous.parent.name not in ("script", "style"):
+        return previous.strip()
+    return ""
+
+
+def _ancestors_of(elements: list[Tag]) -> set[int]:
+    """id() всех предков данных элементов — чтобы за один проход знать, что содержит блок."""
+    ancestors: set[int] = set()
+    for element in elements:
+        for parent in element.parents:
+            if id(parent) in ancestors:
+                break
+            ancestors.add(id(parent))
+    return ancestors
+
+
+def _describe_interactive(element: Tag, labels: dict[str, str]) -> str:
+    attrs = " ".join(
+        f'{attr}="{_clip(str(element[attr]), 80)}"' for attr in _KEPT_ATTRS if element.has_attr(attr)
+    )
+    text = _clip(element.get_text(" ", strip=True), 100)
+    line = f'[{element["data-ornold-id"]}] <{element.name}{" " + attrs if attrs else ""}>'
+    if text:
+        line += f" {text}"
+    elif element.name in ("input", "textarea", "select"):
+        label = _clip(_nearby_label(element, labels), 80)
+        if label:
+            line += f" (подпись: {label})"
+    return line
+
+
+def distill_html(marked_html: str, token_budget: int = PROMPT_PAGE_TOKEN_BUDGET) -> tuple[str, dict]:
+    """
+    Сжимает размеченный HTML до компактного списка строк в пределах бюджета токенов.
+
+    Интерактивные элементы с data-ornold-id сохраняются всегда (в первую очередь) вместе
+    с атрибутами и подписями; затем заголовки и подписи, затем прочий текст. Скрипты,
+    стили, скрытые элементы и повторяющиеся фрагменты отбрасываются. Порядок строк — как в документе.
+    Возвращает (текст, отчет об экономии токенов).
+    """
+    if not marked_html:
+        return "", _report("", "")
+    if estimate_tokens(marked_html) <= token_budget:
+        return marked_html, _report(marked_html, marked_html)
+
+    soup = BeautifulSoup(marked_html, "html.parser")
+    for tag in soup(_DROP_TAGS):
+        tag.decompose()
+    for comment in soup.find_all(string=lambda s: isinstance(s, Comment)):
+        comment.extract()
+    for tag in soup.find_all(_is_hidden):
+        if tag.decomposed:
+            continue
+        if tag.get("type") == "hidden" or not tag.find(attrs={"data-ornold-id": True}):
+            tag.decompose()
+
+    elements = soup.find_all(True)
+    labels = {
+        label["for"]: label.get_text(" ", strip=True) for label in soup.find_all("label", attrs={"for": True})
+    }
+    contains_interactive = _ancestors_of([el for el in elements if el.has_attr("data-ornold-id")])
+    contains_block = _ancestors_of([el for el in elements if el.name in _HEADING_TAGS or el.name in _TEXT_TAGS])
+
+    # (позиция в документе, приоритет, строка): 0 — интерактивные, 1 — заголовки, 2 — текст
+    candidates: list[tuple[int, int, str]] = []
+    seen_text: set[str] = set()
+    for position, element in enumerate(elements):
+        if element.has_attr("data-ornold-id"):
+            candidates.append((position, 0, _describe_interactive(element, labels)))
+            continue
+        priority = 1 if element.name in _HEADING_TAGS else 2 if element.name in _TEXT_TAGS else None
+        # Текст берем только у "листовых" блоков без интерактивных элементов, чтобы не дублировать
+        if priority is None or id(element) in contains_interactive or id(element) in contains_block:
+            continue
+        text = _clip(element.get_text(" ", strip=True))
+        if len(text) < 2 or text in seen_text:
+            continue
+        seen_text.add(text)
+        candidates.append((position, priority, f"{element.name}: {text}" if priority == 1 else text))
+
+    # Запас под строку о том, что часть страницы не поместилась
+    budget_chars = int(token_budget * PROMPT_CHARS_PER_TOKEN) - 64
+    selected, used, dropped = [], 0, 0
+    for candidate in sorted(candidates, key=lambda item: (item[1], item[0])):
+        cost = len(candidate[2]) + 1
+        if used + cost > budget_chars:
+            dropped += 1
+            continue
+        selected.append(candidate)
+        used += cost
+
+    lines = [line for _, _, line in sorted(selected)]
+    if dropped:
+        lines.append(f"... (не поместилось в бюджет: {dropped} фрагментов)")
+    distilled = "\n".join(lines)
+    return distilled, _report(marked_html, distilled)
+
+
+def distill_perception(perception: dict, token_budget: int = PROMPT_PAGE_TOKEN_BUDGET) -> tuple[dict, dict]:
+    """
+    Уменьшает perception до бюджета токенов: сначала сокращает видимый текст,
+    затем список элементов (элементы ценнее текста — по ним выбирается действие).
+    Если в perception есть "html", он сжимается через distill_html.
+    """
+    original = json.dumps(perception, ensure_ascii=False)
+    if estimate_tokens(original) <= token_budget:
+        return perception, _report(original, original)
+
+    distilled = dict(perception)
+    if isinstance(distilled.get("html"), str):
+        distilled["html"], _ = distill_html(distilled["html"], token_budget // 2)
+
+    def overflow() -> int:
+        return len(json.dumps(distilled, ensure_ascii=False)) - int(token_budget * PROMPT_CHARS_PER_TOKEN)
+
+    if overflow() > 0 and isinstance(distilled.get("text"), str):
+        text = distilled["text"]
+        distilled["text"] = text[:max(len(text) - overflow(), 0)]
+    if overflow() > 0 and isinstance(distilled.get("elements"), list):
+        elements = list(distilled["elements"])
+        while elements and overflow() > 0:
+            elements.pop()
+            distilled["elements"] = elements
+        distilled["elements_truncated"] = len(perception["elements"]) - len(elements)
+
+    return distilled, _report(original, json.dumps(distilled, ensure_ascii=False))
+
+
+class DistillationStats:
+    """Сколько токенов промптов сэкономило сжатие страниц — счетчики по методам в Redis."""
+
+    def __init__(self, namespace: str = "llm_prompt"):
+        self.stats_key = f"{namespace}:stats"
+        self._redis: aioredis.Redis | None = None
+
+    def _get_redis(self) -> aioredis.Redis:
+        if self._redis is None:
+            self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+        return self._redis
+
+    async def record(self, method: str, report: dict):
+        try:
+            pipe = self._get_redis().pipeline(transaction=False)
+            pipe.hincrby(self.stats_key, f"{method}:calls", 1)
+            pipe.hincrby(self.stats_key, f"{method}:original_tokens", report["original_tokens"])
+            pipe.hincrby(self.stats_key, f"{method}:saved_tokens", report["saved_tokens"])
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Не удалось записать статистику сжатия промпта: {e}")
+
+    async def stats(self) -> dict:
+        raw = await self._get_redis().hgetall(self.stats_key)
+        methods: dict[str, dict] = {}
+        for field, value in raw.items():
+            method, counter = field.rsplit(":", 1)
+            methods.setdefault(method, {})[counter] = int(value)
+        return methods
@@ -0,0 +1,111 @@
+import os
+import array
+import asyncio
+import hashlib
+import logging
+import sqlite3
+from contextlib import closing
+import redis.asyncio as aioredis
+from shared.services import LoopBound
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Где хранить кэш эмбеддингов: "redis", "disk" (SQLite-файл) или "none"
+EMBEDDING_CACHE_BACKEND = os.getenv("EMBEDDING_CACHE_BACKEND", "redis")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", str(30 * 24 * 3600)))
+
+
+class _RedisStore:
+    def __init__(self, namespace: str, ttl: int):
+        self.namespace = namespace
+        self.ttl = ttl
+        # Клиент redis.asyncio привязан к event loop: свой в каждом loop, закрывается вместе с ним
+        self._redis = LoopBound(lambda: aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0))
+
+    def _get_redis(self) -> aioredis.Redis:
+        return self._redis.get()
+
+    async def get_many(self, keys: list[str]) -> list[bytes | None]:
+        return await self._get_redis().mget([f"{self.namespace}:{key}" for key in keys])
+
+    async def set_many(self, items: dict[str, bytes]):
+        pipe = self._get_redis().pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(f"{self.namespace}:{key}", value, ex=self.ttl)
+        await pipe.execute()
+
+
+class _SqliteStore:
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    def _connect(self) -> closing[sqlite3.Connection]:
+        # "with sqlite3.connect()" только завершает транзакцию, соединение закрывает closing
+        return closing(sqlite3.connect(self.path))
+
+    def _get_many(self, keys: list[str]) -> list[bytes | None]:
+        with self._connect() as conn:
+            placeholders = ",".join("?" * len(keys))
+            rows = dict(conn.execute(f"SELECT key, value FROM embeddings WHERE key IN ({placeholders})", keys))
+        return [rows.get(key) for key in keys]
+
+    def _set_many(self, items: dict[str, bytes]):
+        with self._connect() as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, value) VALUES (?, ?)", items.items())
+
+    async def get_many(self, keys: list[str]) -> list[bytes | None]:
+        return await asyncio.to_thread(self._get_many, keys)
+
+    async def set_many(self, items: dict[str, bytes]):
+        await asyncio.to_thread(self._set_many, items)
+
+
+class EmbeddingCache:
+    """
+    Постоянный кэш эмбеддингов с ключом sha256(модель, текст).
+    Векторы хранятся компактно, как массив float32.
+    """
+
+    def __init__(self, backend: str = EMBEDDING_CACHE_BACKEND, namespace: str = "emb_cache"):
+        self.backend = backend
+        if backend == "redis":
+            self._store = _RedisStore(namespace, EMBEDDING_CACHE_TTL)
+        elif backend == "disk":
+            self._store = _SqliteStore(EMBEDDING_CACHE_PATH)
+        elif backend == "none":
+            self._store = None
+        else:
+            raise ValueError(f"Неизвестный EMBEDDING_CACHE_BACKEND: {backend}")
+        logger.info(f"Кэш эмбеддингов: {backend}")
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+    async def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        if self._store is None or not texts:
+            return [None] * len(texts)
+        try:
+            raw_values = await self._store.get_many([self.make_key(model, text) for text in texts])
+        except Exception as e:
+            # Кэш — оптимизация: при его недоступности просто идем в API
+            logger.warning(f"Кэш эмбеддингов недоступен: {e}")
+            return [None] * len(texts)
+        return [array.array("f", raw).tolist() if raw else None for raw in raw_values]
+
+    async def set_many(self, model: str, embeddings: dict[str, list[float]]):
+        if self._store is None or not embeddings:
+            return
+        items = {
+            self.make_key(model, text): array.array("f", embedding).tobytes()
+            for text, embedding in embeddings.items()
+        }
+        try:
+            await self._store.set_many(items)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить эмбеддинги в кэш: {e}")
\ No newline at end of file
@@ -0,0 +1,294 @@
+import os
+import json
+import random
+import logging
+import redis
+import redis.asyncio as aioredis
+from shared.metrics import redis_op
+
+logger = logging.getLogger(__name__)
+
+# --- Схема ключей ---
+# endpoints:registry          — HASH url -> JSON {capacity, groups}
+# endpoints:group:{group}     — SET эндпоинтов группы
+# endpoints:leases:{url}      — ZSET task_id -> время истечения аренды
+# endpoints:failures:{url}    — счетчик ошибок подключения подряд
+# endpoints:quarantine        — ZSET url -> до какого времени эндпоинт выведен из ротации
+REGISTRY_KEY = "endpoints:registry"
+GROUP_KEY = "endpoints:group:{group}"
+LEASES_PREFIX = "endpoints:leases:"
+FAILURES_KEY = "endpoints:failures:{endpoint}"
+QUARANTINE_KEY = "endpoints:quarantine"
+
+# Сколько задач одновременно держит незарегистрированный эндпоинт (0 — без ограничения)
+ENDPOINT_DEFAULT_CAPACITY = int(os.getenv("ENDPOINT_DEFAULT_CAPACITY", "0"))
+# Аренда истекает сама, если воркер умер, не вернув эндпоинт (секунды).
+# Пока задача выполняется, воркер продлевает аренду каждые ENDPOINT_LEASE_TTL / 3 секунд
+ENDPOINT_LEASE_TTL = int(os.getenv("ENDPOINT_LEASE_TTL", "120"))
+# Сколько ошибок подключения подряд выводят эндпоинт из ротации и на сколько секунд
+ENDPOINT_FAILURE_THRESHOLD = int(os.getenv("ENDPOINT_FAILURE_THRESHOLD", "3"))
+ENDPOINT_QUARANTINE_SECONDS = int(os.getenv("ENDPOINT_QUARANTINE_SECONDS", "300"))
+
+# Время аренд и карантина — по часам Redis: они общие для всех воркеров, и воркер с ушедшими
+# часами не должен досрочно освобождать чужие аренды или возвращать эндпоинт в ротацию
+_NOW = """
+local t = redis.call('time')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+"""
+
+# Выбор наименее загруженного (доля занятой емкости) здорового эндпоинта и его аренда
+# одним атомарным вызовом. Если задача уже держит аренду одного из кандидатов
+# (повторный запуск), возвращается он же. Возвращает URL или false.
+_ACQUIRE_SCRIPT = _NOW + """
+local ttl = tonumber(ARGV[1])
+local task_id = ARGV[3]
+
+for i = 5, #ARGV do
+    local lease_key = ARGV[4] .. ARGV[i]
+    if redis.call('zscore', lease_key, task_id) then
+        redis.call('zadd', lease_key, now + ttl, task_id)
+        return ARGV[i]
+    end
+end
+
+local best, best_load = false, nil
+for i = 5, #ARGV do
+    local endpoint = ARGV[i]
+    local quarantined_until = redis.call('zscore', KEYS[2], endpoint)
+    if not quarantined_until or tonumber(quarantined_until) <= now then
+        local lease_key = ARGV[4] .. endpoint
+        redis.call('zremrangebyscore', lease_key, '-inf', now)
+        local capacity = tonumber(ARGV[2])
+        local info = redis.call('hget', KEYS[1], endpoint)
+        if info then capacity = tonumber(cjson.decode(info).capacity) or capacity end
+        local active = redis.call('zcard', lease_key)
+        -- Емкость 0 — эндпоинт без ограничения, всегда свободен
+        if capacity <= 0 or active < capacity then
+            local load = 0
+            if capacity > 0 then load = active / capacity end
+            if best_load == nil or load < best_load then
+                best, best_load = endpoint, load
+            end
+        end
+    end
+end
+
+if best then
+    redis.call('zadd', ARGV[4] .. best, now + ttl, task_id)
+    redis.call('expire', ARGV[4] .. best, ttl)
+end
+return best
+"""
+
+# Продление аренды выполняющейся задачи; истекшую аренду (ее мог занять другой) не восстанавливает
+_RENEW_SCRIPT = _NOW + """
+local ttl = tonumber(ARGV[2])
+local expires_at = redis.call('zscore', KEYS[1], ARGV[1])
+if not expires_at or tonumber(expires_at) <= now then return 0 end
+redis.call('zadd', KEYS[1], now + ttl, ARGV[1])
+redis.call('expire', KEYS[1], ttl)
+return 1
+"""
+
+# Учет ошибки подключения: после ARGV[1] ошибок подряд эндпоинт уходит в карантин на ARGV[2] секунд.
+# Возвращает число ошибок подряд (0 — эндпоинт только что выведен из ротации)
+_FAILURE_SCRIPT = _NOW + """
+local failures = redis.call('incr', KEYS[1])
+redis.call('expire', KEYS[1], ARGV[2])
+if failures < tonumber(ARGV[1]) then return failures end
+redis.call('zadd', KEYS[2], now + tonumber(ARGV[2]), ARGV[3])
+redis.call('del', KEYS[1])
+return 0
+"""
+
+
+class NoEndpointAvailableError(RuntimeError):
+    """Все подходящие эндпоинты заняты или выведены из ротации."""
+
+
+class _EndpointSchedulerBase:
+    """Общая для синхронного и асинхронного планировщиков логика."""
+
+    @staticmethod
+    def _merge_candidates(endpoints: list[str] | None, group_members: list[str]) -> list[str]:
+        # Дубликаты убираем, порядок перемешиваем, чтобы равная загрузка делилась поровну
+        candidates = list(dict.fromkeys([*(endpoints or []), *sorted(group_members)]))
+        random.shuffle(candidates)
+        return candidates
+
+    @staticmethod
+    def _acquire_call(task_id: str, candidates: list[str]) -> dict:
+        return {
+            "keys": [REGISTRY_KEY, QUARANTINE_KEY],
+            "args": [ENDPOINT_LEASE_TTL, ENDPOINT_DEFAULT_CAPACITY, task_id, LEASES_PREFIX, *candidates]
+        }
+
+    @staticmethod
+    def _renew_call(task_id: str, endpoint: str) -> dict:
+        return {"keys": [f"{LEASES_PREFIX}{endpoint}"], "args": [task_id, ENDPOINT_LEASE_TTL]}
+
+    @staticmethod
+    def _failure_call(endpoint: str) -> dict:
+        return {
+            "keys": [FAILURES_KEY.format(endpoint=endpoint), QUARANTINE_KEY],
+            "args": [ENDPOINT_FAILURE_THRESHOLD, ENDPOINT_QUARANTINE_SECONDS, endpoint]
+        }
+
+    @staticmethod
+    def _renewed(task_id: str, endpoint: str, renewed: int) -> bool:
+        if not renewed:
+            logger.warning(f"Аренда эндпоинта {endpoint} задачей {task_id} уже истекла")
+        return bool(renewed)
+
+    @staticmethod
+    def _acquired(task_id: str, candidates: list[str], endpoint: str | None) -> str:
+        if not endpoint:
+            raise NoEndpointAvailableError(f"Нет свободных эндпоинтов среди {len(candidates)} кандидатов")
+        logger.info(f"Задаче {task_id} назначен эндпоинт {endpoint}")
+        return endpoint
+
+    @staticmethod
+    def _reported(endpoint: str, failures: int):
+        if failures == 0:
+            logger.warning(
+                f"Эндпоинт {endpoint} выведен из ротации на {ENDPOINT_QUARANTINE_SECONDS} с "
+                f"после {ENDPOINT_FAILURE_THRESHOLD} ошибок подключения подряд"
+            )
+
+
+class EndpointScheduler(_EndpointSchedulerBase):
+    """
+    Распределение задач по парку браузерных эндпоинтов (сторона воркера).
+
+    Емкость эндпоинтов и текущие аренды хранятся в Redis, поэтому решения согласованы
+    между всеми воркерами. Задача получает наименее загруженный здоровый эндпоинт из своих
+    browser_endpoints и эндпоинтов своей группы; эндпоинт, на котором подряд падают
+    подключения, временно выводится из ротации.
+    """
+
+    def __init__(self, redis_client: redis.Redis):
+        # Клиент должен быть создан с decode_responses=True
+        self.redis = redis_client
+        self._acquire_script = self.redis.register_script(_ACQUIRE_SCRIPT)
+        self._renew_script = self.redis.register_script(_RENEW_SCRIPT)
+        self._failure_script = self.redis.register_script(_FAILURE_SCRIPT)
+
+    def candidates(self, endpoints: list[str] | None = None, group: str | None = None) -> list[str]:
+        group_members = self.redis.smembers(GROUP_KEY.format(group=group)) if group else []
+        return self._merge_candidates(endpoints, list(group_members))
+
+    @redis_op("endpoint_scheduler.acquire")
+    def acquire(self, task_id: str, candidates: list[str]) -> str:
+        endpoint = self._acquire_script(**self._acquire_call(task_id, candidates))
+        return self._acquired(task_id, candidates, endpoint)
+
+    @redis_op("endpoint_scheduler.renew")
+    def renew(self, task_id: str, endpoint: str) -> bool:
+        """Продлевает аренду эндпоинта задачей на ENDPOINT_LEASE_TTL. False, если аренда уже истекла."""
+        return self._renewed(task_id, endpoint, self._renew_script(**self._renew_call(task_id, endpoint)))
+
+    @redis_op("endpoint_scheduler.release")
+    def release(self, task_id: str, endpoint: str):
+        self.redis.zrem(f"{LEASES_PREFIX}{endpoint}", task_id)
+
+    def report_success(self, endpoint: str):
+        self.redis.delete(FAILURES_KEY.format(endpoint=endpoint))
+
+    def report_failure(self, endpoint: str):
+        self._reported(endpoint, self._failure_script(**self._failure_call(endpoint)))
+
+
+class AsyncEndpointScheduler(_EndpointSchedulerBase):
+    """Вариант EndpointScheduler поверх redis.asyncio для асинхронного режима воркера."""
+
+    def __init__(self, redis_client: aioredis.Redis):
+        # Клиент должен быть создан с decode_responses=True
+        self.redis = redis_client
+        self._acquire_script = self.redis.register_script(_ACQUIRE_SCRIPT)
+        self._renew_script = self.redis.register_script(_RENEW_SCRIPT)
+        self._failure_script = self.redis.register_script(_FAILURE_SCRIPT)
+
+    async def candidates(self, endpoints: list[str] | None = None, group: str | None = None) -> list[str]:
+        group_members = await self.redis.smembers(GROUP_KEY.format(group=group)) if group else []
+        return self._merge_candidates(endpoints, list(group_members))
+
+    @redis_op("endpoint_scheduler.acquire")
+    async def acquire(self, task_id: str, candidates: list[str]) -> str:
+        endpoint = await self._acquire_script(**self._acquire_call(task_id, candidates))
+        return self._acquired(task_id, candidates, endpoint)
+
+    @redis_op("endpoint_scheduler.renew")
+    async def renew(self, task_id: str, endpoint: str) -> bool:
+        return self._renewed(task_id, endpoint, await self._renew_script(**self._renew_call(task_id, endpoint)))
+
+    @redis_op("endpoint_scheduler.release")
+    async def release(self, task_id: str, endpoint: str):
+        await self.redis.zrem(f"{LEASES_PREFIX}{endpoint}", task_id)
+
+    async def report_success(self, endpoint: str):
+        await self.redis.delete(FAILURES_KEY.format(endpoint=endpoint))
+
+    async def report_failure(self, endpoint: str):
+        self._reported(endpoint, await self._failure_script(**self._failure_call(endpoint)))
+
+
+class EndpointRegistry:
+    """Управление парком эндпоинтов из API оркестратора: регистрация, группы, состояние."""
+
+    def __init__(self, redis_client: aioredis.Redis):
+        # Клиент должен быть создан с decode_responses=True
+        self.redis = redis_client
+
+    async def register(self, endpoint: str, capacity: int, groups: list[str]):
+        previous = await self.redis.hget(REGISTRY_KEY, endpoint)
+        pipe = self.redis.pipeline()
+        if previous:
+            for group in set(json.loads(previous).get("groups", [])) - set(groups):
+                pipe.srem(GROUP_KEY.format(group=group), endpoint)
+        pipe.hset(REGISTRY_KEY, endpoint, json.dumps({"capacity": capacity, "groups": groups}))
+        for group in groups:
+            pipe.sadd(GROUP_KEY.format(group=group), endpoint)
+        # Перерегистрация возвращает эндпоинт в ротацию
+        pipe.zrem(QUARANTINE_KEY, endpoint)
+        pipe.delete(FAILURES_KEY.format(endpoint=endpoint))
+        await pipe.execute()
+
+    async def remove(self, endpoint: str) -> bool:
+        previous = await self.redis.hget(REGISTRY_KEY, endpoint)
+        if previous is None:
+            return False
+        pipe = self.redis.pipeline()
+        for group in json.loads(previous).get("groups", []):
+            pipe.srem(GROUP_KEY.format(group=group), endpoint)
+        pipe.hdel(REGISTRY_KEY, endpoint)
+        pipe.zrem(QUARANTINE_KEY, endpoint)
+        pipe.delete(FAILURES_KEY.format(endpoint=endpoint))
+        await pipe.execute()
+        return True
+
+    async def list_endpoints(self) -> list[dict]:
+        registry = await self.redis.hgetall(REGISTRY_KEY)
+        endpoints = sorted(registry)
+        # Сроки аренд и карантина записаны по часам Redis
+        seconds, microseconds = await self.redis.time()
+        now = seconds + microseconds / 1_000_000
+        pipe = self.redis.pipeline(transaction=False)
+        for endpoint in endpoints:
+            pipe.zcount(f"{LEASES_PREFIX}{endpoint}", now, "+inf")
+            pipe.get(FAILURES_KEY.format(endpoint=endpoint))
+            pipe.zscore(QUARANTINE_KEY, endpoint)
+        results = await pipe.execute()
+
+        items = []
+        for i, endpoint in enumerate(endpoints):
+            info = json.loads(registry[endpoint])
+            active, failures, quarantined_until = results[i * 3:i * 3 + 3]
+            items.append({
+                "url": endpoint,
+                "capacity": info.get("capacity", ENDPOINT_DEFAULT_CAPACITY),
+                "groups": info.get("groups", []),
+                "active_leases": active,
+                "consecutive_failures": int(failures or 0),
+                "quarantined_until": quarantined_until if quarantined_until and quarantined_until > now else None
+            })
+        return items
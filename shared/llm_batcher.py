@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import redis.asyncio as aioredis
+from typing import Awaitable, Callable
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+LLM_BATCH_ENABLED = os.getenv("LLM_BATCH_ENABLED", "false").lower() == "true"
+LLM_BATCH_MAX_SIZE = int(os.getenv("LLM_BATCH_MAX_SIZE", "8"))
+LLM_BATCH_WINDOW_MS = int(os.getenv("LLM_BATCH_WINDOW_MS", "25"))
+# Аренда отправленной пачки (секунды): лидер продлевает ее, пока ждет ответ LLM. Если лидер умер,
+# аренда истекает и следующий лидер возвращает запросы пачки в очередь
+LLM_BATCH_LEASE_SECONDS = float(os.getenv("LLM_BATCH_LEASE_SECONDS", "15"))
+# Имя модели для OpenAI-совместимого маршрута vLLM-воркера RunPod
+GEMMA_MODEL_NAME = os.getenv("GEMMA_MODEL_NAME", "google/gemma-3-12b-it")
+
+# Атомарно снимаем лидерство, только если оно все еще наше
+_RELEASE_LEADER_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Время во всех скриптах — часы Redis, а не хостов: окна батчинга не сдвигаются
+# из-за расхождения часов между воркерами
+_NOW = """
+local t = redis.call('time')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+"""
+
+# Ставит запрос в очередь с временем постановки по часам Redis
+_ENQUEUE_SCRIPT = _NOW + """
+local item = cjson.decode(ARGV[1])
+item['enqueued_at'] = now
+redis.call('rpush', KEYS[1], cjson.encode(item))
+return tostring(now)
+"""
+
+# Забирает пачку из очереди и переносит ее в отправленные с арендой.
+# KEYS: очередь, отправленные (HASH id -> запрос), сроки аренды (ZSET id -> срок)
+_CLAIM_SCRIPT = _NOW + """
+local items = redis.call('lpop', KEYS[1], ARGV[1])
+if not items then
+    return {}
+end
+for _, raw in ipairs(items) do
+    local id = cjson.decode(raw)['id']
+    redis.call('hset', KEYS[2], id, raw)
+    redis.call('zadd', KEYS[3], now + tonumber(ARGV[2]), id)
+end
+return items
+"""
+
+# Продлевает аренду запросов пачки, которые еще числятся отправленными
+_RENEW_SCRIPT = _NOW + """
+local renewed = 0
+for i = 2, #ARGV do
+    renewed = renewed + redis.call('zadd', KEYS[1], 'XX', 'CH', now + tonumber(ARGV[1]), ARGV[i])
+end
+return renewed
+"""
+
+# Возвращает в начало очереди запросы, аренда которых истекла (лидер умер, не ответив)
+_RECLAIM_SCRIPT = _NOW + """
+local expired = redis.call('zrangebyscore', KEYS[3], '-inf', now)
+for i = #expired, 1, -1 do
+    local raw = redis.call('hget', KEYS[2], expired[i])
+    if raw then
+        redis.call('lpush', KEYS[1], raw)
+    end
+    redis.call('hdel', KEYS[2], expired[i])
+    redis.call('zrem', KEYS[3], expired[i])
+end
+return #expired
+"""
+
+
+class LLMBatcher:
+    """
+    Собирает промпты от разных процессов/задач в общую очередь Redis и
+    отправляет их в RunPod одной пачкой.
+
+    Отдельного демона нет: каждый ожидающий вызов пытается стать лидером.
+    Лидер ждет окно батчинга (или пока очередь не наберет max_batch_size),
+    забирает пачку из очереди, отправляет ее одним заданием и раскладывает
+    ответы по персональным ключам вызывающих.
+
+    И лидерство, и отправленная пачка держатся по аренде: если процесс лидера умер
+    во время окна или в ожидании LLM, аренда истекает, и запросы пачки забирает
+    следующий лидер, а не ждут таймаута вызывающих.
+    """
+
+    def __init__(
+        self,
+        dispatch: Callable[[dict | str], Awaitable[dict | list]],
+        max_batch_size: int = LLM_BATCH_MAX_SIZE,
+        window_ms: int = LLM_BATCH_WINDOW_MS,
+        timeout: float = 120,
+        namespace: str = "llm_batch",
+        lease_seconds: float = LLM_BATCH_LEASE_SECONDS
+    ):
+        self.dispatch = dispatch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.timeout = timeout
+        self.lease_seconds = lease_seconds
+        self.queue_key = f"{namespace}:queue"
+        self.leader_key = f"{namespace}:leader"
+        self.stats_key = f"{namespace}:stats"
+        self.inflight_key = f"{namespace}:inflight"
+        self.deadlines_key = f"{namespace}:inflight_deadlines"
+        self.result_prefix = f"{namespace}:result:"
+        self._redis: aioredis.Redis | None = None
+        self._scripts: dict = {}
+
+    def _get_redis(self) -> aioredis.Redis:
+        if self._redis is None:
+            self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+        if not self._scripts:
+            self._scripts = {
+                name: self._redis.register_script(script)
+                for name, script in (
+                    ("enqueue", _ENQUEUE_SCRIPT), ("claim", _CLAIM_SCRIPT),
+                    ("renew", _RENEW_SCRIPT), ("reclaim", _RECLAIM_SCRIPT)
+                )
+            }
+        return self._redis
+
+    async def _now(self) -> float:
+        seconds, microseconds = await self._get_redis().time()
+        return seconds + microseconds / 1_000_000
+
+    async def submit(self, prompt: str) -> dict | list:
+        """Ставит промпт в общую очередь и ждет свой ответ."""
+        r = self._get_redis()
+        request_id = uuid.uuid4().hex
+        item = {"id": request_id, "prompt": prompt}
+        await self._scripts["enqueue"](keys=[self.queue_key], args=[json.dumps(item, ensure_ascii=False)])
+
+        result_key = f"{self.result_prefix}{request_id}"
+        deadline = time.monotonic() + self.timeout + self.window
+        while time.monotonic() < deadline:
+            leader_token = await self._try_lead()
+            if leader_token:
+                # Пачка общая: отмена задачи лидера не должна оставить остальных без ответа
+                await asyncio.shield(self._flush(leader_token))
+            reply = await r.blpop([result_key], timeout=max(self.window, 0.01))
+            if reply:
+                return json.loads(reply[1])
+
+        logger.error(f"Таймаут ожидания ответа из пачки для запроса {request_id}.")
+        return {"error": "Таймаут ожидания ответа от LLM"}
+
+    async def _try_lead(self) -> str | None:
+        """Пытается стать лидером. Возвращает токен лидерства или None."""
+        r = self._get_redis()
+        token = uuid.uuid4().hex
+        # Лидерство держим только на время сбора пачки, а не на время ее выполнения
+        ttl_ms = int(self.window * 1000) * 4 + 1000
+        if await r.set(self.leader_key, token, nx=True, px=ttl_ms):
+            return token
+        return None
+
+    async def _flush(self, leader_token: str):
+        r = self._get_redis()
+        inflight_keys = [self.queue_key, self.inflight_key, self.deadlines_key]
+        try:
+            reclaimed = await self._scripts["reclaim"](keys=inflight_keys)
+            if reclaimed:
+                logger.warning(f"Возвращено в очередь {reclaimed} запросов из пачки, лидер которой не ответил.")
+            oldest = await r.lindex(self.queue_key, 0)
+            if oldest is None:
+                return
+            # Ждем остаток окна, отсчитанного от самого старого запроса, если пачка еще не полная
+            waited = await self._now() - json.loads(oldest)["enqueued_at"]
+            if waited < self.window and await r.llen(self.queue_key) < self.max_batch_size:
+                await asyncio.sleep(self.window - waited)
+            raw_items = await self._scripts["claim"](keys=inflight_keys, args=[self.max_batch_size, self.lease_seconds])
+        finally:
+            await r.eval(_RELEASE_LEADER_SCRIPT, 1, self.leader_key, leader_token)
+
+        if not raw_items:
+            return
+        items = [json.loads(raw) for raw in raw_items]
+        ids = [item["id"] for item in items]
+        dispatched_at = await self._now()
+        queue_wait_ms = sum((dispatched_at - item["enqueued_at"]) * 1000 for item in items)
+        logger.info(f"Отправляю пачку из {len(items)} промптов в LLM (заполнение {len(items)}/{self.max_batch_size}).")
+
+        heartbeat = asyncio.create_task(self._renew_lease(ids))
+        try:
+            outputs = await self._dispatch_batch([item["prompt"] for item in items])
+        except Exception as e:
+            logger.error(f"Пачка из {len(items)} промптов не отправлена: {e}")
+            outputs = [{"error": f"Ошибка отправки пачки в LLM: {e}"}] * len(items)
+        finally:
+            heartbeat.cancel()
+
+        pipe = r.pipeline()
+        for item, output in zip(items, outputs):
+            result_key = f"{self.result_prefix}{item['id']}"
+            pipe.rpush(result_key, json.dumps(output, ensure_ascii=False))
+            pipe.expire(result_key, 60)
+        pipe.hdel(self.inflight_key, *ids)
+        pipe.zrem(self.deadlines_key, *ids)
+        pipe.hincrby(self.stats_key, "batches", 1)
+        pipe.hincrby(self.stats_key, "items", len(items))
+        pipe.hincrby(self.stats_key, "capacity", self.max_batch_size)
+        pipe.hincrbyfloat(self.stats_key, "queue_wait_ms_total", queue_wait_ms)
+        await pipe.execute()
+
+    async def _renew_lease(self, ids: list[str]):
+        """Продлевает аренду пачки, пока лидер ждет ответ LLM."""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self._scripts["renew"](keys=[self.deadlines_key], args=[self.lease_seconds, *ids])
+            except Exception as e:
+                logger.warning(f"Не удалось продлить аренду пачки: {e}")
+
+    async def _dispatch_batch(self, prompts: list[str]) -> list[dict | list]:
+        """Отправляет пачку одним заданием и возвращает ответы в порядке промптов."""
+        if len(prompts) == 1:
+            return [await self.dispatch(prompts[0])]
+
+        # vLLM-воркер RunPod принимает список промптов через OpenAI-совместимый маршрут
+        payload = {
+            "input": {
+                "openai_route": "/v1/completions",
+                "openai_input": {"model": GEMMA_MODEL_NAME, "prompt": prompts}
+            }
+        }
+        output = await self.dispatch(payload)
+        if isinstance(output, dict) and "error" in output:
+            return [output] * len(prompts)
+
+        response = output[0] if isinstance(output, list) and output else output
+        choices = response.get("choices", []) if isinstance(response, dict) else []
+        by_index = {choice.get("index", i): choice for i, choice in enumerate(choices)}
+
+        results = []
+        for i in range(len(prompts)):
+            if i in by_index:
+                # Возвращаем ответ в той же форме, что и одиночное задание
+                results.append([{"choices": [by_index[i]]}])
+            else:
+                logger.error(f"В ответе на пачку нет completion для промпта #{i}: {output}")
+                results.append({"error": "LLM не вернул ответ для промпта из пачки"})
+        return results
+
+    async def stats(self) -> dict:
+        """Статистика батчинга: средний размер и заполнение пачек, задержка на очередь."""
+        raw = await self._get_redis().hgetall(self.stats_key)
+        batches = int(raw.get("batches", 0))
+        items = int(raw.get("items", 0))
+        capacity = int(raw.get("capacity", 0))
+        queue_wait_ms_total = float(raw.get("queue_wait_ms_total", 0))
+        return {
+            "batches": batches,
+            "items": items,
+            "avg_batch_size": items / batches if batches else 0.0,
+            "fill_ratio": items / capacity if capacity else 0.0,
+            "avg_queue_wait_ms": queue_wait_ms_total / items if items else 0.0,
+        }
\ No newline at end of file
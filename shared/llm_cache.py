@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import redis.asyncio as aioredis
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Методы GemmaClient, ответы которых разрешено кэшировать (через запятую),
+# например: "get_next_action_universal,classify_error"
+LLM_CACHE_METHODS = {m.strip() for m in os.getenv("LLM_CACHE_METHODS", "").split(",") if m.strip()}
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Схлопывает пробельные символы, чтобы отличия в отступах не ломали кэш."""
+    return " ".join(prompt.split())
+
+
+def is_deterministic(payload) -> bool:
+    """Промпт без явных параметров сэмплирования или с temperature=0 считаем детерминированным."""
+    if isinstance(payload, str):
+        return True
+    params = payload.get("input", {}).get("sampling_params", {})
+    return not params.get("temperature")
+
+
+class LLMResponseCache:
+    """
+    Кэш ответов LLM в Redis с ключом по хэшу нормализованного промпта и параметров модели.
+    Записи живут LLM_CACHE_TTL секунд; при превышении LLM_CACHE_MAX_ENTRIES вытесняются
+    давно не использованные (LRU по sorted set с временем последнего обращения).
+    """
+
+    def __init__(
+        self,
+        model_key: str,
+        methods: set[str] = LLM_CACHE_METHODS,
+        ttl: int = LLM_CACHE_TTL,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+        namespace: str = "llm_cache"
+    ):
+        self.model_key = model_key
+        self.methods = methods
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self.lru_key = f"{namespace}:lru"
+        self.stats_key = f"{namespace}:stats"
+        self._redis: aioredis.Redis | None = None
+
+    def _get_redis(self) -> aioredis.Redis:
+        if self._redis is None:
+            self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+        return self._redis
+
+    def enabled_for(self, method: str | None, payload) -> bool:
+        return method in self.methods and is_deterministic(payload)
+
+    def make_key(self, payload) -> str:
+        if isinstance(payload, str):
+            material = {"prompt": normalize_prompt(payload)}
+        else:
+            material = dict(payload.get("input", {}))
+            if isinstance(material.get("prompt"), str):
+                material["prompt"] = normalize_prompt(material["prompt"])
+        material["model"] = self.model_key
+        digest = hashlib.sha256(json.dumps(material, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+        return f"{self.namespace}:{digest}"
+
+    async def get(self, method: str, key: str):
+        r = self._get_redis()
+        cached = await r.get(key)
+        pipe = r.pipeline()
+        if cached is None:
+            pipe.hincrby(self.stats_key, f"{method}:misses", 1)
+        else:
+            pipe.hincrby(self.stats_key, f"{method}:hits", 1)
+            pipe.zadd(self.lru_key, {key: time.time()})
+        await pipe.execute()
+        if cached is None:
+            return None
+        logger.info(f"Ответ LLM для '{method}' взят из кэша.")
+        return json.loads(cached)
+
+    async def set(self, key: str, response):
+        r = self._get_redis()
+        pipe = r.pipeline()
+        pipe.set(key, json.dumps(response, ensure_ascii=False), ex=self.ttl)
+        pipe.zadd(self.lru_key, {key: time.time()})
+        pipe.zcard(self.lru_key)
+        size = (await pipe.execute())[-1]
+
+        overflow = size - self.max_entries
+        if overflow > 0:
+            evicted = [member for member, _ in await r.zpopmin(self.lru_key, overflow)]
+            if evicted:
+                await r.delete(*evicted)
+                logger.debug(f"Из кэша LLM вытеснено {len(evicted)} записей.")
+
+    async def stats(self) -> dict:
+        """Попадания и промахи кэша по методам."""
+        raw = await self._get_redis().hgetall(self.stats_key)
+        per_method: dict[str, dict] = {}
+        for field, value in raw.items():
+            method, kind = field.rsplit(":", 1)
+            per_method.setdefault(method, {"hits": 0, "misses": 0})[kind] = int(value)
+        for counters in per_method.values():
+            total = counters["hits"] + counters["misses"]
+            counters["hit_rate"] = counters["hits"] / total if total else 0.0
+        return per_method
\ No newline at end of file
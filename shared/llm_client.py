@@ -1,40 +1,227 @@
 import os
-import requests
+import httpx
 import json
+import asyncio
 import time
+import threading
+import contextvars
 from dotenv import load_dotenv
 import logging
+import redis
+from shared.llm_batcher import LLMBatcher, LLM_BATCH_ENABLED, GEMMA_MODEL_NAME
+from shared.llm_cache import LLMResponseCache
+from shared.llm_stream import LLMStreamer, LLM_STREAM_METHODS
+from shared.metrics import LLM_QUEUE_SECONDS, LLM_EXECUTION_SECONDS, LLM_REQUEST_SECONDS
+from shared.tracing import span, trace_context, in_trace_context
+from shared.dom_distiller import distill_html, distill_perception, estimate_tokens, DistillationStats
+from shared import services
+from shared.rate_limiter import llm_rate_limiter, RateLimitTimeout
+from shared.config import RUNPOD_API_BASE
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# --- Настройки опроса RunPod ---
+# Первый опрос статуса делается почти сразу, затем пауза растет до POLL_MAX_DELAY.
+POLL_INITIAL_DELAY = float(os.getenv("GEMMA_POLL_INITIAL_DELAY", "0.25"))
+POLL_MAX_DELAY = float(os.getenv("GEMMA_POLL_MAX_DELAY", "5"))
+POLL_BACKOFF_FACTOR = float(os.getenv("GEMMA_POLL_BACKOFF_FACTOR", "1.5"))
+TASK_TIMEOUT = float(os.getenv("GEMMA_TASK_TIMEOUT", "120"))  # Максимальное время ожидания в секундах
+# Если ожидаемое время выполнения меньше порога (в секундах), используем /runsync.
+# 0 отключает синхронный эндпоинт.
+RUNSYNC_THRESHOLD = float(os.getenv("GEMMA_RUNSYNC_THRESHOLD", "10"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("GEMMA_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("GEMMA_HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# Отчет о сжатии страницы для последнего промпта, собранного в текущем контексте (потоке или корутине)
+_prompt_report: contextvars.ContextVar[dict | None] = contextvars.ContextVar("prompt_report", default=None)
+
 class GemmaClient:
     def __init__(self):
         # --- Конфигурация из переменных окружения ---
         self.gemma_endpoint_id = os.getenv("RUNPOD_ENDPOINT_ID_GEMMA")
         self.api_key = os.getenv("RUNPOD_API_KEY")
-        
+
         if not self.gemma_endpoint_id:
             raise ValueError("RUNPOD_ENDPOINT_ID_GEMMA должен быть установлен в .env файле")
         if not self.api_key:
             raise ValueError("RUNPOD_API_KEY должен быть установлен в .env файле")
 
-        self.base_url = f"https://api.runpod.ai/v2/{self.gemma_endpoint_id}"
+        self.base_url = f"{RUNPOD_API_BASE}/{self.gemma_endpoint_id}"
+
+        # Пул соединений и event loop создаются лениво, в том процессе, который
+        # реально делает запросы (Celery форкает воркеры уже после импорта модуля).
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._http: httpx.AsyncClient | None = None
+        self._batcher: LLMBatcher | None = None
+        self._cache: LLMResponseCache | None = None
+        self._prompt_stats: DistillationStats | None = None
+        self._streamer: LLMStreamer | None = None
+        self._owner_pid: int | None = None
+        self._loop_lock = threading.Lock()
+        # Скользящая оценка времени выполнения задачи на RunPod (секунды)
+        self._expected_runtime: float | None = None
+        # Общий для всех воркеров лимит запусков и одновременных заданий эндпоинта
+        self._rate_limiter = llm_rate_limiter(self.gemma_endpoint_id)
         logger.info(f"Клиент Gemma инициализирован. Используется эндпоинт: {self.base_url}")
 
+    # --- Инфраструктура: собственный event loop и пул соединений ---
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Возвращает фоновый event loop клиента, запуская его при первом обращении.
+        Все запросы (и синхронные, и асинхронные) выполняются в этом loop,
+        поэтому они делят один keep-alive пул соединений.
+        """
+        with self._loop_lock:
+            if self._loop is None or self._owner_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="gemma-client-loop", daemon=True)
+                thread.start()
+                self._loop = loop
+                self._http = None
+                self._batcher = None
+                self._cache = None
+                self._prompt_stats = None
+                self._streamer = None
+                self._owner_pid = os.getpid()
+            return self._loop
+
+    def _get_http(self) -> httpx.AsyncClient:
+        """Общий HTTP-клиент с keep-alive пулом. Вызывается только из loop клиента."""
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                },
+                timeout=httpx.Timeout(20),
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                )
+            )
+        return self._http
+
+    def _get_batcher(self) -> LLMBatcher:
+        """Батчер промптов поверх _arun_and_poll_task. Вызывается только из loop клиента."""
+        if self._batcher is None:
+            self._batcher = LLMBatcher(self._arun_and_poll_task, timeout=TASK_TIMEOUT)
+        return self._batcher
+
+    def _get_cache(self) -> LLMResponseCache:
+        """Кэш ответов LLM. Вызывается только из loop клиента."""
+        if self._cache is None:
+            self._cache = LLMResponseCache(model_key=f"{self.gemma_endpoint_id}:{GEMMA_MODEL_NAME}")
+        return self._cache
+
+    def _get_streamer(self) -> LLMStreamer:
+        """Потоковые ответы через OpenAI-совместимый маршрут. Вызывается только из loop клиента."""
+        if self._streamer is None:
+            self._streamer = LLMStreamer(self._get_http, GEMMA_MODEL_NAME, timeout=TASK_TIMEOUT)
+        return self._streamer
+
+    def _get_prompt_stats(self) -> DistillationStats:
+        """Счетчики сжатия промптов. Вызывается только из loop клиента."""
+        if self._prompt_stats is None:
+            self._prompt_stats = DistillationStats()
+        return self._prompt_stats
+
+    def _run_sync(self, coro):
+        """Выполняет корутину в loop клиента и блокирующе ждет результат."""
+        loop = self._ensure_loop()
+        # Привязка к задаче (task_id, worker_id) переезжает в loop клиента вместе с корутиной
+        return asyncio.run_coroutine_threadsafe(in_trace_context(coro, trace_context()), loop).result()
+
+    async def _run_async(self, coro):
+        """Выполняет корутину в loop клиента, не блокируя loop вызывающего."""
+        loop = self._ensure_loop()
+        try:
+            if asyncio.get_running_loop() is loop:
+                return await coro
+        except RuntimeError:
+            pass
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(in_trace_context(coro, trace_context()), loop))
+
+    def warm_up(self):
+        """Запускает loop клиента и открывает keep-alive соединение с RunPod (GET /health)."""
+        self._run_sync(self._awarm_up())
+
+    async def _awarm_up(self):
+        response = await self._get_http().get("/health")
+        response.raise_for_status()
+
+    def close(self):
+        """Закрывает пул соединений и останавливает фоновый loop."""
+        with self._loop_lock:
+            loop, http = self._loop, self._http
+            self._loop, self._http = None, None
+        if loop is None or self._owner_pid != os.getpid():
+            return
+        if http is not None:
+            asyncio.run_coroutine_threadsafe(http.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    # --- Запуск и опрос задач RunPod ---
+
+    def _should_use_runsync(self) -> bool:
+        if RUNSYNC_THRESHOLD <= 0:
+            return False
+        # Пока статистики нет, пробуем /runsync: если задача не успеет, RunPod
+        # вернет ее ID и мы перейдем к обычному опросу.
+        return self._expected_runtime is None or self._expected_runtime <= RUNSYNC_THRESHOLD
+
+    def _record_runtime(self, status_data: dict):
+        if status_data.get("delayTime") is not None:
+            LLM_QUEUE_SECONDS.observe(status_data["delayTime"] / 1000)
+        execution_ms = status_data.get("executionTime")
+        if not execution_ms:
+            return
+        runtime = execution_ms / 1000
+        LLM_EXECUTION_SECONDS.observe(runtime)
+        if self._expected_runtime is None:
+            self._expected_runtime = runtime
+        else:
+            self._expected_runtime = 0.7 * self._expected_runtime + 0.3 * runtime
+
+    def _handle_status(self, status_data: dict) -> tuple[bool, dict | list | None]:
+        """
+        Разбирает ответ /run, /runsync или /status.
+        Возвращает (задача завершена, результат).
+        """
+        status = status_data.get("status")
+        if status == "COMPLETED":
+            self._record_runtime(status_data)
+            # Ответ от модели находится в поле 'output'
+            return True, status_data.get("output", {})
+        if status in ("FAILED", "CANCELLED", "TIMED_OUT"):
+            logger.error(f"Выполнение задачи {status_data.get('id')} провалилось: {status_data}")
+            return True, {"error": "Выполнение задачи провалилось"}
+        # IN_QUEUE или IN_PROGRESS — продолжаем ждать
+        return False, None
+
+    async def _with_rate_limit(self, job):
+        """Выполняет задание RunPod в слоте общего лимита эндпоинта: от запуска до получения результата."""
+        try:
+            async with self._rate_limiter.slot():
+                return await job
+        except RateLimitTimeout as e:
+            job.close()
+            logger.error(str(e))
+            return {"error": str(e)}
 
-    def _run_and_poll_task(self, payload) -> dict:
+    async def _arun_and_poll_task(self, payload, use_runsync: bool | None = None):
         """
         Реализует логику "Запустить и Опросить" для RunPod API.
+        Для коротких задач использует /runsync, иначе /run с адаптивным опросом /status.
         """
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # --- Шаг 1: Запуск задачи ---
-        run_url = f"{self.base_url}/run"
-        
+        return await self._with_rate_limit(self._arun_and_poll_job(payload, use_runsync))
+
+    async def _arun_and_poll_job(self, payload, use_runsync: bool | None = None):
+        http = self._get_http()
+
         # Если передали строку, оборачиваем в нужную структуру
         if isinstance(payload, str):
             run_body = {"input": {"prompt": payload}}
@@ -42,64 +229,178 @@ class GemmaClient:
             # Если передали уже готовый payload, используем как есть
             run_body = payload
 
+        if use_runsync is None:
+            use_runsync = self._should_use_runsync()
+
+        # --- Шаг 1: Запуск задачи ---
         try:
-            logger.info("Запускаю асинхронную задачу в LLM...")
-            run_response = requests.post(run_url, headers=headers, json=run_body, timeout=20)
+            if use_runsync:
+                logger.info("Запускаю синхронную задачу в LLM (/runsync)...")
+                run_response = await http.post(
+                    "/runsync",
+                    params={"wait": int(RUNSYNC_THRESHOLD * 1000)},
+                    json=run_body,
+                    timeout=RUNSYNC_THRESHOLD + 20
+                )
+            else:
+                logger.info("Запускаю асинхронную задачу в LLM...")
+                run_response = await http.post("/run", json=run_body)
             run_response.raise_for_status()
             task_info = run_response.json()
-            task_id = task_info.get("id")
-            if not task_id:
-                logger.error(f"Не удалось получить ID задачи от RunPod: {task_info}")
-                return {"error": "Не удалось получить ID задачи от RunPod"}
-            logger.info(f"Задача успешно запущена с ID: {task_id}")
-
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Ошибка при запуске задачи в LLM API: {e}")
             return {"error": str(e)}
 
-        # --- Шаг 2: Опрос статуса задачи ---
-        status_url = f"{self.base_url}/status/{task_id}"
-        start_time = time.time()
-        timeout = 120  # Максимальное время ожидания в секундах
+        done, result = self._handle_status(task_info)
+        if done:
+            logger.info("Задача успешно выполнена!")
+            return result
 
-        while time.time() - start_time < timeout:
-            try:
-                logger.info(f"Проверяю статус задачи {task_id}...")
-                status_response = requests.get(status_url, headers=headers, timeout=20)
-                status_response.raise_for_status()
-                status_data = status_response.json()
-                
-                status = status_data.get("status")
-                if status == "COMPLETED":
-                    logger.info("Задача успешно выполнена!")
-                    # Ответ от модели находится в поле 'output'
-                    return status_data.get("output", {})
-                elif status == "FAILED":
-                    logger.error(f"Выполнение задачи {task_id} провалилось: {status_data}")
-                    return {"error": "Выполнение задачи провалилось"}
-                
-                # Если статус IN_QUEUE или IN_PROGRESS, просто ждем
-                time.sleep(5) # Пауза между опросами
-
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Ошибка при опросе статуса задачи {task_id}: {e}")
-                time.sleep(5)
+        task_id = task_info.get("id")
+        if not task_id:
+            logger.error(f"Не удалось получить ID задачи от RunPod: {task_info}")
+            return {"error": "Не удалось получить ID задачи от RunPod"}
+        logger.info(f"Задача успешно запущена с ID: {task_id}")
+
+        # --- Шаг 2: Опрос статуса задачи с нарастающей паузой ---
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        delay = POLL_INITIAL_DELAY
+
+        try:
+            while loop.time() - start_time < TASK_TIMEOUT:
+                await asyncio.sleep(delay)
+                delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY)
+                try:
+                    logger.debug(f"Проверяю статус задачи {task_id}...")
+                    status_response = await http.get(f"/status/{task_id}")
+                    status_response.raise_for_status()
+                    done, result = self._handle_status(status_response.json())
+                    if done:
+                        logger.info("Задача успешно выполнена!")
+                        return result
+                except httpx.HTTPError as e:
+                    logger.error(f"Ошибка при опросе статуса задачи {task_id}: {e}")
+        except asyncio.CancelledError:
+            # Агента остановили во время ожидания: ответ больше не нужен, освобождаем воркер RunPod
+            loop.create_task(self._acancel_job(task_id))
+            raise
 
         logger.error(f"Таймаут ожидания выполнения задачи {task_id}.")
         return {"error": "Таймаут ожидания ответа от LLM"}
 
-    def get_next_action(self, goal: str, url: str, marked_html: str, previous_actions: list) -> dict:
+    async def _acancel_job(self, task_id: str):
+        try:
+            response = await self._get_http().post(f"/cancel/{task_id}")
+            response.raise_for_status()
+            logger.info(f"Задание RunPod {task_id} отменено")
+        except httpx.HTTPError as e:
+            logger.warning(f"Не удалось отменить задание RunPod {task_id}: {e}")
+
+    async def _aexecute(self, payload, cache_method: str | None = None, use_cache: bool = True, prompt_report: dict | None = None):
         """
-        Формирует промпт для LLM, чтобы получить следующее действие.
+        Единая точка входа для всех методов клиента.
+        Учитывает экономию токенов от сжатия страницы (prompt_report), затем проверяет
+        кэш ответов (если метод включен в LLM_CACHE_METHODS) и отправляет промпт:
+        потоком, если метод включен в LLM_STREAM_METHODS, иначе через общую очередь,
+        если включен батчинг.
+        """
+        method = cache_method or "prompt"
+        started = time.perf_counter()
+        with span(f"llm.{method}") as llm_span:
+            if prompt_report is not None:
+                await self._get_prompt_stats().record(method, prompt_report)
+
+            cache = self._get_cache()
+            cache_key = None
+            if use_cache and cache.enabled_for(cache_method, payload):
+                cache_key = cache.make_key(payload)
+                try:
+                    cached = await cache.get(cache_method, cache_key)
+                except (redis.RedisError, ValueError) as e:
+                    # Кэш — только ускорение: при сбое Redis промпт уходит в LLM как обычно
+                    logger.warning(f"Кэш ответов LLM недоступен, отправляю промпт без кэша: {e}")
+                    cached = cache_key = None
+                if cached is not None:
+                    llm_span.set_attribute("source", "cache")
+                    LLM_REQUEST_SECONDS.labels(method=method, source="cache").observe(time.perf_counter() - started)
+                    return cached
+
+            if cache_method in LLM_STREAM_METHODS and isinstance(payload, str):
+                source = "stream"
+                result = await self._with_rate_limit(self._get_streamer().complete(payload, cache_method))
+            elif LLM_BATCH_ENABLED and isinstance(payload, str):
+                source = "batch"
+                result = await self._get_batcher().submit(payload)
+            else:
+                source = "runpod"
+                result = await self._arun_and_poll_task(payload)
+            llm_span.set_attribute("source", source)
+            LLM_REQUEST_SECONDS.labels(method=method, source=source).observe(time.perf_counter() - started)
+
+            if cache_key and not (isinstance(result, dict) and "error" in result):
+                try:
+                    await cache.set(cache_key, result)
+                except redis.RedisError as e:
+                    logger.warning(f"Не удалось сохранить ответ LLM в кэш: {e}")
+            return result
+
+    def _run_and_poll_task(self, payload, cache_method: str | None = None, use_cache: bool = True, prompt_report: dict | None = None) -> dict:
+        """Синхронная обертка над _aexecute для Celery-воркеров."""
+        return self._run_sync(self._aexecute(payload, cache_method, use_cache, prompt_report))
+
+    async def _arun_task(self, payload, cache_method: str | None = None, use_cache: bool = True, prompt_report: dict | None = None) -> dict:
+        """Асинхронный вход для корутин из чужих event loop'ов."""
+        return await self._run_async(self._aexecute(payload, cache_method, use_cache, prompt_report))
+
+    def batch_stats(self) -> dict:
+        """Статистика батчинга промптов (общая для всех воркеров)."""
+        return self._run_sync(self._get_batcher().stats())
+
+    def cache_stats(self) -> dict:
+        """Попадания и промахи кэша ответов LLM по методам."""
+        return self._run_sync(self._get_cache().stats())
+
+    def stream_stats(self) -> dict:
+        """Время до первого токена и до готового действия для потоковых методов."""
+        return self._run_sync(self._get_streamer().stats())
+
+    def prompt_stats(self) -> dict:
+        """Сколько токенов сэкономило сжатие страниц в промптах, по методам."""
+        return self._run_sync(self._get_prompt_stats().stats())
+
+    @staticmethod
+    def last_prompt_report() -> dict | None:
         """
-        prompt = f"""
+        Отчет о сжатии страницы для последнего промпта, собранного в текущем потоке
+        или корутине: original_tokens, tokens, saved_tokens.
+        """
+        return _prompt_report.get()
+
+    # --- Промпты и разбор ответов ---
+
+    @staticmethod
+    def _remember_report(method: str, report: dict) -> dict:
+        _prompt_report.set(report)
+        if report["saved_tokens"]:
+            logger.info(
+                f"{method}: страница сжата с ~{report['original_tokens']} до ~{report['tokens']} токенов "
+                f"(сэкономлено ~{report['saved_tokens']})"
+            )
+        return report
+
+    def _build_next_action_prompt(self, goal: str, url: str, marked_html: str, previous_actions: list) -> tuple[str, dict]:
+        page, report = distill_html(marked_html)
+        self._remember_report("get_next_action", report)
+        return f"""
 Ты — продвинутый ИИ-ассистент, управляющий браузером.
 Твоя текущая цель: "{goal}".
 Ты находишься на странице: {url}.
 
-Вот размеченное содержимое страницы (только body, без script и style), где каждому интерактивному элементу присвоен 'data-ornold-id':
+Вот размеченное содержимое страницы (только body, без script и style), где каждому интерактивному элементу присвоен 'data-ornold-id'.
+Если страница большая, она сжата: каждый интерактивный элемент — строка вида [data-ornold-id] <тег атрибуты> текст.
 ---
-{marked_html}
+{page}
 ---
 
 Твои последние действия (для контекста): {previous_actions}
@@ -114,68 +415,92 @@ class GemmaClient:
 
 Если цель достигнута или не может быть достигнута с текущими элементами, верни:
 {{"action": "finish", "reason": "Цель достигнута"}}
-"""
-        
+""", report
+
+    def get_next_action(self, goal: str, url: str, marked_html: str, previous_actions: list, use_cache: bool = True) -> dict:
+        """
+        Формирует промпт для LLM, чтобы получить следующее действие.
+        """
+        prompt, report = self._build_next_action_prompt(goal, url, marked_html, previous_actions)
         logger.info("Запрос к LLM для получения следующего действия...")
         # logger.debug(f"Промпт для LLM: {prompt}") # Можно раскомментировать для отладки
 
-        return self._run_and_poll_task(prompt)
+        return self._run_and_poll_task(prompt, cache_method="get_next_action", use_cache=use_cache, prompt_report=report)
 
-    def get_next_action_universal(self, goal: str, history: list, perception: dict) -> dict:
-        """
-        Универсальный мыслительный цикл агента. Определяет следующее действие.
-        """
+    async def aget_next_action(self, goal: str, url: str, marked_html: str, previous_actions: list, use_cache: bool = True) -> dict:
+        """Асинхронная версия get_next_action."""
+        prompt, report = self._build_next_action_prompt(goal, url, marked_html, previous_actions)
+        logger.info("Запрос к LLM для получения следующего действия...")
+        return await self._arun_task(prompt, cache_method="get_next_action", use_cache=use_cache, prompt_report=report)
+
+    def _build_universal_prompt(self, goal: str, history: list, perception: dict) -> tuple[str, dict]:
+        # perception — либо полный снимок страницы, либо {"changes": дифф к странице предыдущего
+        # запроса, "elements": компактный список всех интерактивных элементов}
+        if "changes" in perception:
+            changes = json.dumps(perception["changes"], ensure_ascii=False)
+            elements = json.dumps(perception.get("elements", []), ensure_ascii=False)
+            state = (
+                "Состояние: изменения страницы после предыдущего шага "
+                f"(все остальное на странице не изменилось): {changes}\n"
+                f"Все интерактивные элементы страницы (id тег: подпись): {elements}"
+            )
+            tokens = estimate_tokens(changes) + estimate_tokens(elements)
+            report = {"original_tokens": tokens, "tokens": tokens, "saved_tokens": 0}
+        else:
+            snapshot, report = distill_perception(perception)
+            state = f"Состояние: {json.dumps(snapshot, ensure_ascii=False)}"
+        self._remember_report("get_next_action_universal", report)
         # Собираем всю инструкцию в один большой промпт, как того требует API.
-        full_prompt = f"""
+        return f"""
 Ты — агент для управления браузером.
 Цель: "{goal}"
 
 ДОСТУПНЫЕ ДЕЙСТВИЯ (ТОЛЬКО ЭТИ 5!):
 1. {{"action": "think", "text": "...", "reasoning": "..."}}
-2. {{"action": "browse", "url": "...", "reasoning": "..."}}  
+2. {{"action": "browse", "url": "...", "reasoning": "..."}}
 3. {{"action": "click", "element_id": "...", "reasoning": "..."}}
 4. {{"action": "type", "element_id": "...", "text": "...", "reasoning": "..."}}
 5. {{"action": "finish", "result": "...", "reasoning": "..."}}
 
 ЗАПРЕЩЕНО: extract_concert_details, extract_event_details, show_popup, или любые другие действия!
 
+{state}
+
 История: {history[-3:]}
-Состояние: {json.dumps(perception, ensure_ascii=False)}
 
 Ответь ТОЛЬКО JSON одного из 5 действий выше:
-"""
-        logger.info("Запрос к LLM (формат 'prompt')...")
-        
-        llm_response = self._run_and_poll_task(full_prompt)
+""", report
 
+    def _parse_universal_response(self, llm_response) -> dict:
         # 1. Явно обрабатываем ошибку от нашего клиента
-        if "error" in llm_response:
+        if isinstance(llm_response, dict) and "error" in llm_response:
             logger.error(f"Ошибка от _run_and_poll_task: {llm_response['error']}")
             return {"action": "think", "text": f"Внутренняя ошибка LLM-клиента: {llm_response['error']}", "reasoning": "LLM-клиент не смог получить ответ от API."}
 
         # 2. Парсим успешный ответ, структура которого подтверждена тестами.
         if llm_response and isinstance(llm_response, list) and llm_response[0].get('choices'):
+            content = None
             try:
                 # Структура ответа: response['output'][0]['choices'][0]['text']
                 # _run_and_poll_task возвращает нам `output`, так что начинаем с [0]
                 content = llm_response[0]['choices'][0]['text']
                 cleaned_content = content.strip().replace("```json", "").replace("```", "")
                 parsed_action = json.loads(cleaned_content)
-                
+
                 # Проверяем, что действие из разрешенного списка
                 allowed_actions = ["think", "browse", "click", "type", "finish"]
                 action_type = parsed_action.get("action")
-                
+
                 if action_type not in allowed_actions:
                     logger.warning(f"LLM предложил неразрешенное действие '{action_type}'. Заменяю на 'think'.")
                     return {
-                        "action": "think", 
+                        "action": "think",
                         "text": f"LLM ошибочно предложил действие '{action_type}'. Нужно выбрать из: {allowed_actions}",
                         "reasoning": "Исправляю ошибку LLM"
                     }
-                
+
                 return parsed_action
-                
+
             except (json.JSONDecodeError, KeyError, IndexError) as e:
                 logger.error(f"Не удалось распарсить JSON из ответа LLM: {e}. Ответ: {content}")
                 return {"action": "think", "text": f"Ошибка парсинга ответа от LLM: {content}"}
@@ -183,19 +508,40 @@ class GemmaClient:
         logger.warning(f"Получен нестандартный ответ от LLM: {llm_response}")
         return {"action": "think", "text": f"Получен непонятный ответ от LLM: {llm_response}"}
 
+    def get_next_action_universal(self, goal: str, history: list, perception: dict, use_cache: bool = True) -> dict:
+        """
+        Универсальный мыслительный цикл агента. Определяет следующее действие.
+        """
+        full_prompt, report = self._build_universal_prompt(goal, history, perception)
+        logger.info("Запрос к LLM (формат 'prompt')...")
+        return self._parse_universal_response(
+            self._run_and_poll_task(full_prompt, cache_method="get_next_action_universal", use_cache=use_cache, prompt_report=report)
+        )
+
+    async def aget_next_action_universal(self, goal: str, history: list, perception: dict, use_cache: bool = True) -> dict:
+        """Асинхронная версия get_next_action_universal."""
+        full_prompt, report = self._build_universal_prompt(goal, history, perception)
+        logger.info("Запрос к LLM (формат 'prompt')...")
+        return self._parse_universal_response(
+            await self._arun_task(full_prompt, cache_method="get_next_action_universal", use_cache=use_cache, prompt_report=report)
+        )
 
-    def execute_prompt(self, prompt: str) -> dict:
+    def execute_prompt(self, prompt: str, use_cache: bool = True) -> dict:
         """
         Выполняет простой промпт и возвращает результат.
         """
         logger.info("Запрос к LLM с прямым промптом...")
-        return self._run_and_poll_task(prompt)
+        return self._run_and_poll_task(prompt, cache_method="execute_prompt", use_cache=use_cache)
 
-    def classify_error(self, goal: str, url: str, marked_html: str, failed_action: dict, exception_message: str) -> dict:
-        """
-        Анализирует контекст ошибки и предлагает стратегию восстановления.
-        """
-        prompt = f"""
+    async def aexecute_prompt(self, prompt: str, use_cache: bool = True) -> dict:
+        """Асинхронная версия execute_prompt."""
+        logger.info("Запрос к LLM с прямым промптом...")
+        return await self._arun_task(prompt, cache_method="execute_prompt", use_cache=use_cache)
+
+    def _build_classify_error_prompt(self, goal: str, url: str, marked_html: str, failed_action: dict, exception_message: str) -> tuple[str, dict]:
+        page, report = distill_html(marked_html)
+        self._remember_report("classify_error", report)
+        return f"""
 Ты — продвинутый ИИ-аналитик, помогающий веб-агенту восстанавливаться после ошибок.
 Агент пытался выполнить цель: "{goal}".
 
@@ -203,9 +549,9 @@ class GemmaClient:
 Он пытался выполнить действие: {failed_action}
 Но получил Python-исключение: "{exception_message}"
 
-Вот HTML-код страницы, на которой произошла ошибка:
+Вот HTML-код страницы, на которой произошла ошибка (большие страницы сжаты до списка элементов и текста):
 ---
-{marked_html}
+{page}
 ---
 
 Твоя задача — проанализировать ситуацию и предложить лучшую стратегию восстановления.
@@ -227,17 +573,34 @@ class GemmaClient:
 Проанализируй HTML и ошибку и верни ТОЛЬКО JSON-объект с твоим вердиктом.
 Пример:
 {{"error_type": "stale_element", "recovery_strategy": "refresh"}}
-"""
+""", report
+
+    def classify_error(self, goal: str, url: str, marked_html: str, failed_action: dict, exception_message: str, use_cache: bool = True) -> dict:
+        """
+        Анализирует контекст ошибки и предлагает стратегию восстановления.
+        """
+        prompt, report = self._build_classify_error_prompt(goal, url, marked_html, failed_action, exception_message)
         logger.info("Запрос к LLM для классификации ошибки...")
-        return self._run_and_poll_task(prompt)
+        return self._run_and_poll_task(prompt, cache_method="classify_error", use_cache=use_cache, prompt_report=report)
 
-    def create_plan_for_goal(self, goal: str) -> dict:
-        prompt = f"""
+    async def aclassify_error(self, goal: str, url: str, marked_html: str, failed_action: dict, exception_message: str, use_cache: bool = True) -> dict:
+        """Асинхронная версия classify_error."""
+        prompt, report = self._build_classify_error_prompt(goal, url, marked_html, failed_action, exception_message)
+        logger.info("Запрос к LLM для классификации ошибки...")
+        return await self._arun_task(prompt, cache_method="classify_error", use_cache=use_cache, prompt_report=report)
+
+    def _build_plan_prompt(self, goal: str) -> str:
+        return f"""
         Ты - ИИ-планировщик.
         Цель: "{goal}"
         Разбей цель на атомарные шаги. Верни ТОЛЬКО JSON объект со структурой: {{ "plan": ["шаг 1", "шаг 2", "..."] }}
         """
-        return self._run_and_poll_task(prompt)
 
-# Синглтон экземпляр клиента
-llm_client = GemmaClient() 
\ No newline at end of file
+    def create_plan_for_goal(self, goal: str, use_cache: bool = True) -> dict:
+        return self._run_and_poll_task(self._build_plan_prompt(goal), cache_method="create_plan_for_goal", use_cache=use_cache)
+
+    async def acreate_plan_for_goal(self, goal: str, use_cache: bool = True) -> dict:
+        return await self._arun_task(self._build_plan_prompt(goal), cache_method="create_plan_for_goal", use_cache=use_cache)
+
+# Синглтон клиента: создается при первом обращении (или при прогреве, см. shared.services)
+llm_client = services.register("llm_client", GemmaClient)
\ No newline at end of file
@@ -0,0 +1,259 @@
+import os
+import json
+import asyncio
+import logging
+import httpx
+import redis.asyncio as aioredis
+from typing import Callable
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Методы GemmaClient, которые получают ответ потоком и останавливают генерацию
+# на первом полном JSON-объекте (через запятую), например: "get_next_action_universal,classify_error"
+LLM_STREAM_METHODS = {m.strip() for m in os.getenv("LLM_STREAM_METHODS", "").split(",") if m.strip()}
+# Предел генерации для потокового запроса (у /v1/completions vLLM по умолчанию всего 16 токенов)
+LLM_STREAM_MAX_TOKENS = int(os.getenv("LLM_STREAM_MAX_TOKENS", "512"))
+# Маршрут vLLM-воркера, которым выполняется потоковое задание (тот же, что у пачек LLMBatcher)
+LLM_STREAM_ROUTE = "/v1/completions"
+# Пауза между запросами /stream (секунды): начальная — пока приходят новые куски ответа,
+# без новых кусков она удваивается до LLM_STREAM_POLL_MAX_INTERVAL. Каждый опрос — запрос
+# к API RunPod от каждого ждущего агента, поэтому слишком частый опрос нагружает API всего парка
+LLM_STREAM_POLL_INTERVAL = float(os.getenv("LLM_STREAM_POLL_INTERVAL", "0.25"))
+LLM_STREAM_POLL_MAX_INTERVAL = float(os.getenv("LLM_STREAM_POLL_MAX_INTERVAL", "2"))
+
+
+class JSONObjectStream:
+    """
+    Инкрементальный поиск первого полного JSON-объекта в потоке текста.
+    Учитывает строки и экранирование, поэтому скобки внутри значений не мешают;
+    текст до объекта (пояснения, ```json) пропускается.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.text: str | None = None
+        self._pos = 0
+        self._start: int | None = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> dict | None:
+        """Добавляет кусок текста. Возвращает объект, как только он полностью получен."""
+        self.buffer += chunk
+        while self._pos < len(self.buffer):
+            char = self.buffer[self._pos]
+            self._pos += 1
+            if self._start is None:
+                if char == "{":
+                    self._start, self._depth = self._pos - 1, 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = self.buffer[self._start:self._pos]
+                    try:
+                        parsed = json.loads(candidate)
+                    except json.JSONDecodeError:
+                        # Не JSON (например, фигурные скобки в пояснении) — ищем следующий объект
+                        self._pos, self._start = self._start + 1, None
+                        continue
+                    if isinstance(parsed, dict):
+                        self.text = candidate
+                        return parsed
+        return None
+
+
+class LLMStreamer:
+    """
+    Потоковое выполнение промпта заданием RunPod со стримингом (vLLM-воркер, OpenAI-совместимый
+    маршрут): /run запускает задание, /stream/{id} отдает новые куски текста по мере генерации.
+    SSE-маршрут /openai/v1 не подходит: у такого запроса нет ID задания RunPod, и генерацию
+    нельзя отменить — закрытое соединение не останавливает воркер.
+    На первом полном JSON-объекте задание отменяется через /cancel/{id}, и vLLM прекращает
+    генерацию (хвостовые пояснения модели не оплачиваются).
+    Время до первого токена и до готового действия копится в Redis.
+    """
+
+    def __init__(
+        self,
+        get_http: Callable[[], httpx.AsyncClient],
+        model: str,
+        max_tokens: int = LLM_STREAM_MAX_TOKENS,
+        timeout: float = 120,
+        namespace: str = "llm_stream",
+        poll_interval: float = LLM_STREAM_POLL_INTERVAL,
+        max_poll_interval: float = LLM_STREAM_POLL_MAX_INTERVAL
+    ):
+        self.get_http = get_http
+        self.model = model
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(max_poll_interval, poll_interval)
+        self.stats_key = f"{namespace}:stats"
+        self._redis: aioredis.Redis | None = None
+
+    def _get_redis(self) -> aioredis.Redis:
+        if self._redis is None:
+            self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+        return self._redis
+
+    @staticmethod
+    def _chunk_text(output) -> tuple[str, bool]:
+        """
+        Текст куска потока и признак конца генерации. vLLM-воркер отдает куски как объекты
+        OpenAI ({"choices": [{"text": ...}]}) или как строки SSE ("data: {...}").
+        """
+        if isinstance(output, list):
+            parts = [LLMStreamer._chunk_text(item) for item in output]
+            return "".join(text for text, _ in parts), any(done for _, done in parts)
+        if isinstance(output, str):
+            text, done = "", False
+            for line in output.splitlines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    done = True
+                    continue
+                chunk_text, chunk_done = LLMStreamer._chunk_text(json.loads(data))
+                text, done = text + chunk_text, done or chunk_done
+            return text, done
+        choice = ((output or {}).get("choices") or [{}])[0]
+        return choice.get("text") or "", bool(choice.get("finish_reason"))
+
+    async def _cancel(self, job_id: str):
+        try:
+            response = await self.get_http().post(f"/cancel/{job_id}")
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning(f"Не удалось отменить потоковое задание RunPod {job_id}: {e}")
+
+    async def complete(self, prompt: str, method: str | None = None) -> dict | list:
+        """
+        Возвращает ответ в той же форме, что и обычное задание RunPod
+        ([{"choices": [{"text": ...}]}]), либо {"error": ...}.
+        """
+        body = {"input": {
+            "openai_route": LLM_STREAM_ROUTE,
+            "openai_input": {"model": self.model, "prompt": prompt, "max_tokens": self.max_tokens, "stream": True}
+        }}
+        parser = JSONObjectStream()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first_token_at = action_at = None
+        finished = False
+        http = self.get_http()
+
+        try:
+            run_response = await http.post("/run", json=body)
+            run_response.raise_for_status()
+            job_id = run_response.json().get("id")
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            logger.error(f"Ошибка запуска потокового задания LLM: {e}")
+            return {"error": str(e)}
+        if not job_id:
+            return {"error": "Не удалось получить ID потокового задания от RunPod"}
+
+        delay = self.poll_interval
+        try:
+            while not finished and action_at is None:
+                # Сразу после запуска кусков ответа еще нет: первый опрос тоже после паузы
+                await asyncio.sleep(delay)
+                if loop.time() - started > self.timeout:
+                    await self._cancel(job_id)
+                    return {"error": "Таймаут ожидания ответа от LLM"}
+                stream_response = await http.get(f"/stream/{job_id}")
+                stream_response.raise_for_status()
+                data = stream_response.json()
+                status = data.get("status")
+                if status in ("FAILED", "CANCELLED", "TIMED_OUT"):
+                    logger.error(f"Потоковое задание {job_id} завершилось со статусом {status}: {data}")
+                    return {"error": "Выполнение задачи провалилось"}
+                for item in data.get("stream") or []:
+                    text, done = self._chunk_text(item.get("output"))
+                    finished = finished or done
+                    if not text:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = loop.time()
+                    if parser.feed(text) is not None:
+                        action_at = loop.time()
+                        break
+                finished = finished or status == "COMPLETED"
+                # Пока генерация идет, опрашиваем с начальной паузой; задание в очереди — все реже
+                delay = self.poll_interval if data.get("stream") else min(delay * 2, self.max_poll_interval)
+        except asyncio.CancelledError:
+            # Агента остановили во время ожидания: ответ больше не нужен, освобождаем воркер RunPod
+            loop.create_task(self._cancel(job_id))
+            raise
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            logger.error(f"Ошибка потокового запроса к LLM: {e}")
+            await self._cancel(job_id)
+            return {"error": str(e)}
+
+        stopped_early = action_at is not None and not finished
+        if stopped_early:
+            # Действие получено — остаток генерации не нужен
+            await self._cancel(job_id)
+
+        ttft_ms = (first_token_at - started) * 1000 if first_token_at else None
+        action_ms = (action_at - started) * 1000 if action_at else None
+        logger.info(
+            f"Потоковый ответ LLM ({method}): первый токен через "
+            f"{f'{ttft_ms:.0f} мс' if ttft_ms is not None else '-'}, действие через "
+            f"{f'{action_ms:.0f} мс' if action_ms is not None else '-'}"
+            f"{', генерация остановлена досрочно' if stopped_early else ''}"
+        )
+        await self._record(method or "prompt", ttft_ms, action_ms, stopped_early)
+
+        # Если объекта так и не нашлось, отдаем весь текст — пусть разберет вызывающий метод
+        return [{"choices": [{"text": parser.text if parser.text is not None else parser.buffer}]}]
+
+    async def _record(self, method: str, ttft_ms: float | None, action_ms: float | None, stopped_early: bool):
+        try:
+            pipe = self._get_redis().pipeline(transaction=False)
+            pipe.hincrby(self.stats_key, f"{method}:calls", 1)
+            if ttft_ms is not None:
+                pipe.hincrbyfloat(self.stats_key, f"{method}:ttft_ms_total", ttft_ms)
+            if action_ms is not None:
+                pipe.hincrby(self.stats_key, f"{method}:actions", 1)
+                pipe.hincrbyfloat(self.stats_key, f"{method}:action_ms_total", action_ms)
+            if stopped_early:
+                pipe.hincrby(self.stats_key, f"{method}:stopped_early", 1)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Не удалось записать статистику потоковых ответов: {e}")
+
+    async def stats(self) -> dict:
+        """Средние время до первого токена и до действия, доля досрочно остановленных генераций — по методам."""
+        raw = await self._get_redis().hgetall(self.stats_key)
+        counters: dict[str, dict] = {}
+        for field, value in raw.items():
+            method, counter = field.rsplit(":", 1)
+            counters.setdefault(method, {})[counter] = float(value)
+
+        methods = {}
+        for method, c in counters.items():
+            calls = int(c.get("calls", 0))
+            actions = int(c.get("actions", 0))
+            methods[method] = {
+                "calls": calls,
+                "avg_ttft_ms": c.get("ttft_ms_total", 0.0) / calls if calls else 0.0,
+                "avg_time_to_action_ms": c.get("action_ms_total", 0.0) / actions if actions else 0.0,
+                "stopped_early_ratio": c.get("stopped_early", 0.0) / calls if calls else 0.0,
+            }
+        return methods
@@ -1,15 +1,19 @@
 import logging
 import sys
+from shared.tracing import TraceContextFilter
 
 def setup_logging():
     """
     Настраивает базовую конфигурацию логирования для всего приложения.
+    Каждая строка содержит task_id и worker_id, если код выполняется в рамках задачи.
     """
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        format="%(asctime)s [%(levelname)s] %(name)s [%(task_id)s %(worker_id)s]: %(message)s",
         stream=sys.stdout
     )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceContextFilter())
     print("Логирование настроено.")
 
 # Вызываем функцию настройки при импорте модуля, чтобы логирование
@@ -1,23 +1,41 @@
-import chromadb
-import requests
+import httpx
 import os
 from dotenv import load_dotenv
 import logging
 import asyncio
 import json
+import time
 import hashlib
+from typing import Callable
+from shared.embedding_cache import EmbeddingCache
+from shared.vector_index import LocalVectorIndex, publish_changes
+from shared.metrics import observe, EMBEDDING_SECONDS, CHROMA_SECONDS
+from shared.tracing import span
+from shared import services
+from shared.rate_limiter import embedding_rate_limiter, RateLimitTimeout
+from shared.config import RUNPOD_API_BASE
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 # Получаем хост ChromaDB из переменной окружения
 CHROMADB_HOST = os.getenv("CHROMADB_HOST", "localhost")
+# Сколько текстов отправлять в API эмбеддингов за один запрос
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Сколько документов писать в Chroma одним запросом при массовом импорте
+RAG_INGEST_CHUNK_SIZE = int(os.getenv("RAG_INGEST_CHUNK_SIZE", "256"))
+# Искать по локальной memory-mapped реплике коллекций вместо HTTP-запроса к ChromaDB
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "false").lower() == "true"
 
 class RAGMemory:
-    def __init__(self):
-        # --- Подключение к ChromaDB как к серверу ---
-        self.client = chromadb.HttpClient(host=CHROMADB_HOST, port=8000)
-        logger.info(f"RAG Memory: Подключение к серверу ChromaDB на http://{CHROMADB_HOST}:8000")
+    def __init__(self, client=None):
+        # --- Подключение к ChromaDB как к серверу (или к переданному клиенту, например in-memory) ---
+        if client is None:
+            # Пакет тяжелый: загружается только при создании клиента, а не при импорте модуля
+            import chromadb
+            client = chromadb.HttpClient(host=CHROMADB_HOST, port=8000)
+            logger.info(f"RAG Memory: Подключение к серверу ChromaDB на http://{CHROMADB_HOST}:8000")
+        self.client = client
         
         # Коллекция для успешных сценариев (как было)
         self.scenarios_collection = self.client.get_or_create_collection(
@@ -33,6 +51,12 @@ class RAGMemory:
         
         logger.info("RAG Memory инициализирована с коллекциями 'successful_scenarios' и 'failure_knowledge_base'")
 
+        # Локальные read-реплики коллекций (опционально)
+        self.local_indexes: dict[str, LocalVectorIndex] = {}
+        if VECTOR_INDEX_ENABLED:
+            for collection in (self.scenarios_collection, self.failures_collection):
+                self.local_indexes[collection.name] = LocalVectorIndex(collection)
+
         # --- Новые настройки для API эмбеддингов ---
         self.embedding_endpoint_id = os.getenv("RUNPOD_ENDPOINT_ID_EMBEDDING")
         self.api_key = os.getenv("RUNPOD_API_KEY")
@@ -41,99 +65,286 @@ class RAGMemory:
         if not self.embedding_endpoint_id or not self.api_key:
             raise ValueError("RUNPOD_ENDPOINT_ID_EMBEDDING и RUNPOD_API_KEY должны быть установлены в .env")
 
-        self.embedding_api_url = f"https://api.runpod.ai/v2/{self.embedding_endpoint_id}/openai/v1/embeddings"
+        self.embedding_api_url = f"{RUNPOD_API_BASE}/{self.embedding_endpoint_id}/openai/v1/embeddings"
+        self.embedding_cache = EmbeddingCache()
+        # Общий для всех воркеров лимит запросов к эндпоинту эмбеддингов
+        self.rate_limiter = embedding_rate_limiter(self.embedding_endpoint_id)
+        # Асинхронный HTTP-клиент привязан к event loop: свой в каждом loop, закрывается вместе с ним
+        self._http = services.LoopBound(self._create_http)
         logger.info(f"Система памяти RAG инициализирована. Используется API эндпоинт: {self.embedding_api_url}")
-    
-    async def _get_embedding(self, text: str) -> list[float]:
-        """Получает векторное представление текста через API."""
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+
+    def _create_http(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            timeout=httpx.Timeout(30)
+        )
+
+    def _get_http(self) -> httpx.AsyncClient:
+        return self._http.get()
+
+    async def _request_embeddings(self, texts: list[str]) -> list[list[float]]:
+        """Один запрос к API эмбеддингов для пачки текстов."""
         body = {
             "model": self.embedding_model_name,
-            "input": text
+            "input": texts
         }
         try:
-            response = requests.post(self.embedding_api_url, headers=headers, json=body, timeout=30)
-            response.raise_for_status()
-            result = response.json()
-            # API возвращает список эмбеддингов, нам нужен первый (и единственный)
-            if result.get("data") and len(result["data"]) > 0:
-                return result["data"][0]["embedding"]
-            else:
-                logger.error(f"API эмбеддингов вернуло неожиданный ответ: {result}")
-                return []
-        except requests.exceptions.RequestException as e:
+            async with self.rate_limiter.slot():
+                with span("memory.embeddings", texts=len(texts)), observe(EMBEDDING_SECONDS):
+                    response = await self._get_http().post(self.embedding_api_url, json=body)
+                    response.raise_for_status()
+                    result = response.json()
+        except (httpx.HTTPError, RateLimitTimeout) as e:
             logger.error(f"Ошибка при запросе к API эмбеддингов: {e}")
-            return []
+            return [[] for _ in texts]
 
+        embeddings = [[] for _ in texts]
+        for i, item in enumerate(result.get("data") or []):
+            index = item.get("index", i)
+            if 0 <= index < len(texts):
+                embeddings[index] = item["embedding"]
+        if not all(embeddings):
+            logger.error(f"API эмбеддингов вернуло неожиданный ответ: {result}")
+        return embeddings
 
-    async def add_successful_scenario(self, goal: str, actions: list[dict]):
-        document = f"Цель: {goal}\n" + "\n".join(f"Шаг: {json.dumps(step)}" for step in actions)
-        doc_id = f"scenario_{self.scenarios_collection.count() + 1}"
-        
-        embedding = await self._get_embedding(document)
-        if not embedding:
-            logger.warning(f"Не удалось получить эмбеддинг для успешного сценария '{goal}'. Пропускаю.")
-            return
+    async def _get_embeddings(self, texts: list[str]) -> list[list[float]]:
+        """
+        Получает векторные представления пачки текстов.
+        Сначала смотрит в кэш, недостающие запрашивает у API пачками по EMBEDDING_BATCH_SIZE.
+        """
+        cached = await self.embedding_cache.get_many(self.embedding_model_name, texts)
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, cached) if embedding is None))
 
-        self.scenarios_collection.add(
-            embeddings=[embedding], documents=[document],
-            metadatas=[{"goal": goal}], ids=[doc_id]
+        fetched: dict[str, list[float]] = {}
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            chunk = missing[start:start + EMBEDDING_BATCH_SIZE]
+            for text, embedding in zip(chunk, await self._request_embeddings(chunk)):
+                if embedding:
+                    fetched[text] = embedding
+
+        if fetched:
+            await self.embedding_cache.set_many(self.embedding_model_name, fetched)
+        if missing:
+            logger.info(f"Эмбеддинги: {len(texts) - len(missing)} из кэша, {len(fetched)} получено от API.")
+
+        return [embedding if embedding is not None else fetched.get(text, []) for text, embedding in zip(texts, cached)]
+
+    async def _get_embedding(self, text: str) -> list[float]:
+        """Получает векторное представление текста через API (или из кэша)."""
+        return (await self._get_embeddings([text]))[0]
+
+
+    def _query(self, collection, embedding: list[float], n_results: int, include: list[str], where: dict | None = None) -> dict:
+        """Поиск по локальной реплике, если она включена, иначе (или при ее сбое) — в ChromaDB."""
+        index = self.local_indexes.get(collection.name)
+        if index is not None:
+            try:
+                with observe(CHROMA_SECONDS, operation="local_query"):
+                    return index.query(embedding, n_results=n_results, include=include, where=where)
+            except Exception as e:
+                logger.warning(f"Локальный индекс '{collection.name}' недоступен, ищу в ChromaDB: {e}")
+        with span("memory.chroma_query", collection=collection.name), observe(CHROMA_SECONDS, operation="query"):
+            return collection.query(query_embeddings=[embedding], n_results=n_results, include=include, where=where)
+
+    @staticmethod
+    def _tenant(tenant: str | None) -> str:
+        # Метаданные Chroma не хранят None: сценарии задач без клиента помечаются пустой строкой
+        return tenant or ""
+
+    @staticmethod
+    def _scenario_id(document: str, tenant: str | None) -> str:
+        # У одинаковых сценариев разных клиентов разные ID, иначе запись одного перезапишет другого
+        key = f"{tenant}\n{document}" if tenant else document
+        return f"scenario_{hashlib.sha256(key.encode()).hexdigest()}"
+
+    @staticmethod
+    def _scenario_document(goal: str, actions: list[dict]) -> str:
+        return f"Цель: {goal}\n" + "\n".join(f"Шаг: {json.dumps(step)}" for step in actions)
+
+    @staticmethod
+    def _failure_context_text(goal: str, url: str, failed_action: dict, exception_message: str) -> str:
+        return f"Цель: {goal}. URL: {url}. Действие: {json.dumps(failed_action)}. Ошибка: {exception_message}"
+
+    async def _bulk_upsert(
+        self,
+        collection,
+        ids: list[str],
+        documents: list[str],
+        metadatas: list[dict],
+        chunk_size: int,
+        skip_existing: bool,
+        on_progress: Callable[[int, int], None] | None
+    ) -> dict:
+        """
+        Пишет документы в коллекцию порциями: один батч эмбеддингов и один запрос к Chroma на порцию.
+        ID стабильны (хэш содержимого), поэтому прерванный импорт можно просто запустить заново:
+        при skip_existing уже записанные документы не эмбеддятся повторно.
+        """
+        # Дубликаты внутри одного импорта схлопываем, последний побеждает
+        unique = {doc_id: (document, metadata) for doc_id, document, metadata in zip(ids, documents, metadatas)}
+        ids = list(unique)
+        total = len(ids)
+        stats = {"total": total, "added": 0, "skipped": 0, "failed": 0}
+
+        for start in range(0, total, chunk_size):
+            chunk_ids = ids[start:start + chunk_size]
+            if skip_existing:
+                with observe(CHROMA_SECONDS, operation="get"):
+                    existing = set((await asyncio.to_thread(collection.get, ids=chunk_ids, include=[]))["ids"])
+                stats["skipped"] += len(existing)
+                chunk_ids = [doc_id for doc_id in chunk_ids if doc_id not in existing]
+
+            if chunk_ids:
+                chunk_documents = [unique[doc_id][0] for doc_id in chunk_ids]
+                embeddings = await self._get_embeddings(chunk_documents)
+                ready = [i for i, embedding in enumerate(embeddings) if embedding]
+                stats["failed"] += len(chunk_ids) - len(ready)
+                if ready:
+                    with observe(CHROMA_SECONDS, operation="upsert"):
+                        # Клиент Chroma блокирующий: запрос уходит в поток, чтобы не держать event loop агентов
+                        await asyncio.to_thread(
+                            collection.upsert,
+                            ids=[chunk_ids[i] for i in ready],
+                            documents=[chunk_documents[i] for i in ready],
+                            metadatas=[unique[chunk_ids[i]][1] for i in ready],
+                            embeddings=[embeddings[i] for i in ready]
+                        )
+                    stats["added"] += len(ready)
+                    if collection.name in self.local_indexes:
+                        self.local_indexes[collection.name].mark_stale()
+                    # Реплики коллекции в других процессах и на других хостах дочитают эти документы
+                    await asyncio.to_thread(publish_changes, collection.name, [chunk_ids[i] for i in ready])
+
+            done = min(start + chunk_size, total)
+            logger.info(f"Импорт в '{collection.name}': {done}/{total}")
+            if on_progress:
+                on_progress(done, total)
+
+        if stats["failed"]:
+            logger.warning(f"Импорт в '{collection.name}': для {stats['failed']} документов не удалось получить эмбеддинг.")
+        return stats
+
+    async def add_scenarios(
+        self,
+        scenarios: list[dict],
+        chunk_size: int = RAG_INGEST_CHUNK_SIZE,
+        skip_existing: bool = True,
+        on_progress: Callable[[int, int], None] | None = None
+    ) -> dict:
+        """
+        Массово сохраняет успешные сценарии. Каждый элемент: {"goal": str, "actions": list[dict]}
+        и, опционально, "replay" — шаги с отпечатками страниц для повтора без LLM (universal_agent/replay.py)
+        и "tenant" — клиент, которому принадлежит сценарий: другие клиенты его не находят.
+        Возвращает счетчики {"total", "added", "skipped", "failed"}.
+        """
+        documents = [self._scenario_document(s["goal"], s["actions"]) for s in scenarios]
+        ids = [self._scenario_id(document, s.get("tenant")) for s, document in zip(scenarios, documents)]
+        recorded_at = time.time()
+        metadatas = []
+        for s in scenarios:
+            metadata = {"goal": s["goal"], "tenant": self._tenant(s.get("tenant"))}
+            if s.get("replay"):
+                # Метаданные Chroma — только скаляры, поэтому шаги повтора хранятся JSON-строкой
+                metadata.update(replay=json.dumps(s["replay"], ensure_ascii=False), replay_at=recorded_at)
+            metadatas.append(metadata)
+        return await self._bulk_upsert(
+            self.scenarios_collection, ids, documents, metadatas, chunk_size, skip_existing, on_progress
         )
-        logger.info(f"Сохранен успешный сценарий '{goal}' с ID {doc_id}")
 
-    def search_similar_scenarios(self, query: str, n_results: int = 1) -> dict:
-        query_embedding = self._get_embedding(query)
+    async def add_successful_scenario(
+        self, goal: str, actions: list[dict], replay: list[dict] | None = None, tenant: str | None = None
+    ):
+        # Отпечатки страниц со временем меняются: сценарий с шагами повтора перезаписывается свежим
+        stats = await self.add_scenarios(
+            [{"goal": goal, "actions": actions, "replay": replay, "tenant": tenant}], skip_existing=replay is None
+        )
+        if stats["failed"]:
+            logger.warning(f"Не удалось получить эмбеддинг для успешного сценария '{goal}'. Пропускаю.")
+            return
+        logger.info(f"Сохранен успешный сценарий '{goal}'")
+
+    async def search_similar_scenarios(self, query: str, n_results: int = 1, tenant: str | None = None) -> dict:
+        """Ближайшие по смыслу сценарии клиента tenant (None — задачи без клиента)."""
+        query_embedding = await self._get_embedding(query)
         if not query_embedding:
             logger.warning(f"Не удалось получить эмбеддинг для поискового запроса '{query}'. Возвращаю пустой результат.")
             return {}
             
-        return self.scenarios_collection.query(
-            query_embeddings=[query_embedding], n_results=n_results
+        return await asyncio.to_thread(
+            self._query, self.scenarios_collection, query_embedding, n_results,
+            include=["metadatas", "documents", "distances"], where={"tenant": self._tenant(tenant)}
         )
         
-    async def add_failure_log(self, goal: str, url: str, failed_action: dict, exception_message: str, recovery_strategy: str):
+    async def get_scenarios_by_goal(self, goal: str, limit: int = 10, tenant: str | None = None) -> dict:
+        """Сценарии клиента tenant с точно такой же целью: фильтр по метаданным, без запроса эмбеддинга."""
+        with observe(CHROMA_SECONDS, operation="get"):
+            return await asyncio.to_thread(
+                self.scenarios_collection.get,
+                where={"$and": [{"goal": goal}, {"tenant": self._tenant(tenant)}]}, limit=limit, include=["metadatas"]
+            )
+
+    async def add_failure_logs(
+        self,
+        failures: list[dict],
+        chunk_size: int = RAG_INGEST_CHUNK_SIZE,
+        skip_existing: bool = True,
+        on_progress: Callable[[int, int], None] | None = None
+    ) -> dict:
         """
-        Сохраняет в базу знаний запись о провале и успешной стратегии восстановления.
+        Массово сохраняет записи о провалах. Каждый элемент содержит ключи
+        goal, url, failed_action, exception_message и recovery_strategy.
+        Возвращает счетчики {"total", "added", "skipped", "failed"}.
         """
-        # Создаем подробное текстовое описание проблемы
-        error_context_text = f"Цель: {goal}. URL: {url}. Действие: {json.dumps(failed_action)}. Ошибка: {exception_message}"
-        
-        embedding = await self._get_embedding(error_context_text)
-        
+        documents = [
+            self._failure_context_text(f["goal"], f["url"], f["failed_action"], f["exception_message"])
+            for f in failures
+        ]
         # ID будет хэшем от контекста, чтобы избежать дубликатов
-        doc_id = hashlib.sha256(error_context_text.encode()).hexdigest()
-        
-        logger.info(f"Добавляю запись об ошибке в базу знаний. ID: {doc_id}")
-        
-        self.failures_collection.add(
-            documents=[error_context_text],
-            metadatas=[{"recovery_strategy": recovery_strategy}],
-            embeddings=[embedding],
-            ids=[doc_id]
+        ids = [hashlib.sha256(document.encode()).hexdigest() for document in documents]
+        metadatas = [{"recovery_strategy": f["recovery_strategy"]} for f in failures]
+        return await self._bulk_upsert(
+            self.failures_collection, ids, documents, metadatas, chunk_size, skip_existing, on_progress
         )
 
+    async def add_failure_log(self, goal: str, url: str, failed_action: dict, exception_message: str, recovery_strategy: str):
+        """
+        Сохраняет в базу знаний запись о провале и успешной стратегии восстановления.
+        """
+        logger.info(f"Добавляю запись об ошибке в базу знаний для цели '{goal}'.")
+        # Повторная запись того же контекста обновляет стратегию восстановления
+        await self.add_failure_logs([{
+            "goal": goal,
+            "url": url,
+            "failed_action": failed_action,
+            "exception_message": exception_message,
+            "recovery_strategy": recovery_strategy
+        }], skip_existing=False)
+
     async def search_similar_failures(self, goal: str, url: str, failed_action: dict, exception_message: str, n_results: int = 1) -> list:
         """
         Ищет в базе знаний похожие ошибки и возвращает проверенные стратегии восстановления.
         """
-        error_context_text = f"Цель: {goal}. URL: {url}. Действие: {json.dumps(failed_action)}. Ошибка: {exception_message}"
+        error_context_text = self._failure_context_text(goal, url, failed_action, exception_message)
         embedding = await self._get_embedding(error_context_text)
         
-        results = self.failures_collection.query(
-            query_embeddings=[embedding],
-            n_results=n_results,
-            include=["metadatas", "distances"]
+        results = await asyncio.to_thread(
+            self._query, self.failures_collection, embedding, n_results, include=["metadatas", "distances"]
         )
         logger.info(f"Поиск похожих ошибок в базе знаний нашел: {results}")
         
         # Возвращаем метаданные (где хранится стратегия) и расстояние до запроса
         return list(zip(results.get('metadatas', [[]])[0], results.get('distances', [[]])[0]))
 
+    def warm_up(self):
+        """Проверяет соединение с ChromaDB (коллекции к этому моменту уже созданы)."""
+        self.client.heartbeat()
+
 
-rag_memory_instance = RAGMemory()
+# Синглтон памяти: подключение к ChromaDB откладывается до первого обращения (см. shared.services)
+rag_memory_instance = services.register("rag_memory", RAGMemory)
 
 async def main():
     # --- Тестирование новой логики ошибок ---
@@ -0,0 +1,150 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+from contextlib import contextmanager
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess, start_http_server
+)
+
+logger = logging.getLogger(__name__)
+
+# Порт, на котором Celery-воркер отдает /metrics (0 — не запускать экспортер)
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+# Каталог для метрик prefork-процессов Celery (режим multiprocess prometheus_client).
+# Должен быть задан до запуска воркера; без него каждый процесс видит только свои метрики.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Корзины для сетевых операций: от миллисекунд (Redis) до минут (очередь RunPod)
+_FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+_SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "ornold_http_request_seconds", "Время обработки запроса к API оркестратора",
+    ["method", "route", "status"], buckets=_FAST_BUCKETS + (5, 10)
+)
+LLM_QUEUE_SECONDS = Histogram(
+    "ornold_llm_queue_seconds", "Время задачи в очереди RunPod до начала выполнения (delayTime)",
+    buckets=_SLOW_BUCKETS
+)
+LLM_EXECUTION_SECONDS = Histogram(
+    "ornold_llm_execution_seconds", "Время выполнения задачи на воркере RunPod (executionTime)",
+    buckets=_SLOW_BUCKETS
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "ornold_llm_request_seconds", "Полное время запроса к LLM по методам и способу получения ответа",
+    ["method", "source"], buckets=_SLOW_BUCKETS
+)
+EMBEDDING_SECONDS = Histogram(
+    "ornold_embedding_request_seconds", "Время запроса эмбеддингов к RunPod", buckets=_SLOW_BUCKETS
+)
+CHROMA_SECONDS = Histogram(
+    "ornold_chroma_seconds", "Время операций с ChromaDB и локальным индексом", ["operation"], buckets=_FAST_BUCKETS + (5, 10)
+)
+REDIS_SECONDS = Histogram(
+    "ornold_redis_op_seconds", "Время операций с Redis", ["operation"], buckets=_FAST_BUCKETS
+)
+BROWSER_CONNECT_SECONDS = Histogram(
+    "ornold_browser_connect_seconds", "Время подключения к браузеру", ["pool"], buckets=_SLOW_BUCKETS
+)
+TASK_STEPS = Histogram(
+    "ornold_task_steps", "Число шагов агента на задачу", ["status"], buckets=(1, 2, 3, 5, 8, 13, 20, 30, 50, 100)
+)
+TASK_DURATION_SECONDS = Histogram(
+    "ornold_task_duration_seconds", "Время выполнения задачи агентом", ["status"], buckets=_SLOW_BUCKETS + (600, 1800)
+)
+TASKS_FINISHED = Counter("ornold_tasks_finished_total", "Завершенные агентом задачи", ["status"])
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    "ornold_task_queue_wait_seconds", "Время задачи в очереди Celery до начала выполнения", ["priority"],
+    buckets=_SLOW_BUCKETS + (600, 1800, 3600)
+)
+TASK_CANCELLATIONS = Counter(
+    "ornold_task_cancellations_total",
+    "Остановки задач: cooperative — воркер вышел сам, abandoned — агент не уложился в очистку, escalated — SIGKILL",
+    ["outcome"]
+)
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "ornold_rate_limit_wait_seconds", "Ожидание разрешения общего лимита запросов к RunPod", ["limiter"],
+    buckets=_FAST_BUCKETS + (5, 10, 30, 60)
+)
+RATE_LIMIT_REJECTED = Counter(
+    "ornold_rate_limit_rejected_total", "Запросы, не дождавшиеся разрешения лимита", ["limiter"]
+)
+REPLAY_LOOKUPS = Counter(
+    "ornold_replay_lookups_total", "Поиск сохраненного сценария для повтора: hit, miss, error", ["result"]
+)
+REPLAY_STEPS = Counter(
+    "ornold_replay_steps_total",
+    "Шаги задач с планом повтора: replay — действие из сценария без LLM, llm — страница изменилась", ["source"]
+)
+
+
+@contextmanager
+def observe(histogram: Histogram, **labels):
+    """Замеряет время блока в гистограмму (и для синхронного, и для асинхронного кода)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(time.perf_counter() - started)
+
+
+def timed(histogram: Histogram, **labels):
+    """Декоратор: замеряет время вызова функции или корутины."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with observe(histogram, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with observe(histogram, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def redis_op(operation: str):
+    """Декоратор для методов, выполняющих операцию с Redis (одну команду, pipeline или скрипт)."""
+    return timed(REDIS_SECONDS, operation=operation)
+
+
+def record_task_finished(status: str, duration: float | None, steps: int | None = None):
+    """Учитывает задачу, которую агент довел до конечного статуса."""
+    TASKS_FINISHED.labels(status=status).inc()
+    if duration is not None:
+        TASK_DURATION_SECONDS.labels(status=status).observe(duration)
+    if steps is not None:
+        TASK_STEPS.labels(status=status).observe(steps)
+
+
+def _registry() -> CollectorRegistry:
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    # Собираем метрики всех процессов из общего каталога
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Текст для /metrics и его Content-Type."""
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def start_exporter(port: int = WORKER_METRICS_PORT):
+    """HTTP-экспортер метрик процесса воркера."""
+    if port <= 0:
+        return
+    start_http_server(port, registry=_registry())
+    logger.info(f"Экспортер метрик запущен на порту {port}")
+
+
+def mark_process_dead(pid: int):
+    """Убирает живые gauge завершившегося prefork-процесса (нужно только в режиме multiprocess)."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,179 @@
+import os
+import time
+import uuid
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import redis
+import redis.asyncio as aioredis
+from shared.metrics import RATE_LIMIT_WAIT_SECONDS, RATE_LIMIT_REJECTED
+from shared.services import LoopBound
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# --- Схема ключей ---
+# ratelimit:{name}:bucket    — HASH tokens, ts: token bucket запросов в секунду
+# ratelimit:{name}:inflight  — ZSET lease_id -> время истечения: задания, выполняющиеся сейчас
+BUCKET_KEY = "ratelimit:{name}:bucket"
+INFLIGHT_KEY = "ratelimit:{name}:inflight"
+
+# Лимиты на эндпоинт RunPod, общие для всех воркеров (0 — без ограничения).
+# RPS ограничивает запуск заданий, MAX_IN_FLIGHT — число одновременно выполняющихся.
+LLM_RATE_LIMIT_RPS = float(os.getenv("LLM_RATE_LIMIT_RPS", "0"))
+LLM_RATE_LIMIT_BURST = int(os.getenv("LLM_RATE_LIMIT_BURST", "10"))
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "0"))
+EMBEDDING_RATE_LIMIT_RPS = float(os.getenv("EMBEDDING_RATE_LIMIT_RPS", "0"))
+EMBEDDING_RATE_LIMIT_BURST = int(os.getenv("EMBEDDING_RATE_LIMIT_BURST", "10"))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", "0"))
+# Сколько запрос ждет разрешения, прежде чем вернуть ошибку (секунды)
+RATE_LIMIT_WAIT_TIMEOUT = float(os.getenv("RATE_LIMIT_WAIT_TIMEOUT", "60"))
+# Слот in-flight освобождается сам, если воркер умер, не вернув его (секунды)
+RATE_LIMIT_LEASE_TTL = int(os.getenv("RATE_LIMIT_LEASE_TTL", "300"))
+
+# Проверка лимита одновременных заданий и списание токена одним атомарным вызовом.
+# Возвращает 0, если слот выдан, иначе — сколько миллисекунд подождать до повтора.
+# Время — по часам Redis: лимит общий для парка, и расхождение часов воркеров не должно
+# ускорять пополнение токенов или досрочно освобождать чужие слоты
+_ACQUIRE_SCRIPT = """
+local t = redis.call('time')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_in_flight = tonumber(ARGV[3])
+local lease_ttl = tonumber(ARGV[5])
+
+if max_in_flight > 0 then
+    redis.call('zremrangebyscore', KEYS[2], '-inf', now)
+    if redis.call('zcard', KEYS[2]) >= max_in_flight then
+        return 50
+    end
+end
+
+if rate > 0 then
+    local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+    if tokens < 1 then
+        redis.call('hset', KEYS[1], 'tokens', tokens, 'ts', now)
+        return math.ceil((1 - tokens) / rate * 1000)
+    end
+    redis.call('hset', KEYS[1], 'tokens', tokens - 1, 'ts', now)
+    redis.call('expire', KEYS[1], math.ceil(burst / rate) + 60)
+end
+
+if max_in_flight > 0 then
+    redis.call('zadd', KEYS[2], now + lease_ttl, ARGV[4])
+    redis.call('expire', KEYS[2], lease_ttl)
+end
+return 0
+"""
+
+
+class RateLimitTimeout(RuntimeError):
+    """Разрешение на запрос не получено за отведенное время."""
+
+
+class DistributedRateLimiter:
+    """
+    Общий для всего парка воркеров лимит запросов к эндпоинту: token bucket (запросов
+    в секунду с допустимым всплеском) и предел одновременно выполняющихся заданий.
+    Состояние хранится в Redis, поэтому лимит соблюдается суммарно, а не в каждом процессе.
+
+    Если Redis недоступен, лимитер пропускает запросы (с предупреждением в логе):
+    потеря лимита лучше, чем остановка всех агентов.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        max_in_flight: int,
+        wait_timeout: float = RATE_LIMIT_WAIT_TIMEOUT,
+        lease_ttl: int = RATE_LIMIT_LEASE_TTL
+    ):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_in_flight = max_in_flight
+        self.wait_timeout = wait_timeout
+        self.lease_ttl = lease_ttl
+        self.bucket_key = BUCKET_KEY.format(name=name)
+        self.inflight_key = INFLIGHT_KEY.format(name=name)
+        # Клиент redis.asyncio привязан к event loop: свой в каждом loop, закрывается вместе с ним
+        self._redis = LoopBound(lambda: aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True))
+        self._script = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 or self.max_in_flight > 0
+
+    def _get_redis(self) -> aioredis.Redis:
+        return self._redis.get()
+
+    async def _try_acquire(self, lease_id: str) -> int:
+        redis_client = self._get_redis()
+        if self._script is None:
+            self._script = redis_client.register_script(_ACQUIRE_SCRIPT)
+        return int(await self._script(
+            keys=[self.bucket_key, self.inflight_key],
+            args=[self.rate, self.burst, self.max_in_flight, lease_id, self.lease_ttl],
+            client=redis_client
+        ))
+
+    @asynccontextmanager
+    async def slot(self):
+        """Ждет разрешения на одно задание и держит слот in-flight до выхода из блока."""
+        if not self.enabled:
+            yield
+            return
+
+        lease_id = uuid.uuid4().hex
+        started = time.monotonic()
+        acquired = False
+        while True:
+            try:
+                retry_ms = await self._try_acquire(lease_id)
+            except redis.RedisError as e:
+                logger.warning(f"Лимитер {self.name}: Redis недоступен, запрос пропущен без лимита: {e}")
+                break
+            if retry_ms == 0:
+                acquired = True
+                break
+            waited = time.monotonic() - started
+            if waited >= self.wait_timeout:
+                RATE_LIMIT_REJECTED.labels(limiter=self.name).inc()
+                raise RateLimitTimeout(f"Лимит запросов к {self.name}: нет разрешения за {self.wait_timeout:g} с")
+            # Небольшой случайный разброс, чтобы ожидающие воркеры не стучались одновременно
+            delay = min(retry_ms / 1000, self.wait_timeout - waited) * random.uniform(1.0, 1.3)
+            await asyncio.sleep(delay)
+        RATE_LIMIT_WAIT_SECONDS.labels(limiter=self.name).observe(time.monotonic() - started)
+
+        try:
+            yield
+        finally:
+            if acquired and self.max_in_flight > 0:
+                try:
+                    await self._get_redis().zrem(self.inflight_key, lease_id)
+                except redis.RedisError as e:
+                    logger.warning(f"Лимитер {self.name}: не удалось освободить слот (истечет сам): {e}")
+
+    async def in_flight(self) -> int:
+        redis_client = self._get_redis()
+        # Сроки слотов записаны по часам Redis
+        seconds, microseconds = await redis_client.time()
+        await redis_client.zremrangebyscore(self.inflight_key, "-inf", seconds + microseconds / 1_000_000)
+        return await redis_client.zcard(self.inflight_key)
+
+
+def llm_rate_limiter(endpoint_id: str) -> DistributedRateLimiter:
+    return DistributedRateLimiter(f"runpod:{endpoint_id}", LLM_RATE_LIMIT_RPS, LLM_RATE_LIMIT_BURST, LLM_MAX_IN_FLIGHT)
+
+
+def embedding_rate_limiter(endpoint_id: str) -> DistributedRateLimiter:
+    return DistributedRateLimiter(
+        f"runpod:{endpoint_id}", EMBEDDING_RATE_LIMIT_RPS, EMBEDDING_RATE_LIMIT_BURST, EMBEDDING_MAX_IN_FLIGHT
+    )
@@ -0,0 +1,142 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Callable, Generic, TypeVar
+
+logger = logging.getLogger(__name__)
+
+# Прогревать ли клиенты в фоне при старте процесса (иначе соединения открываются на первом запросе)
+SERVICES_WARMUP_ENABLED = os.getenv("SERVICES_WARMUP_ENABLED", "true").lower() == "true"
+
+T = TypeVar("T")
+
+
+class LazyService(Generic[T]):
+    """
+    Клиент внешнего сервиса, который создается при первом обращении.
+
+    Атрибуты проксируются в экземпляр, поэтому модульный синглтон используется как раньше
+    (llm_client.aget_next_action_universal(...)), но импорт модуля больше не подключается
+    к RunPod или ChromaDB. Если создать клиент не удалось (например, ChromaDB ненадолго
+    недоступна), ошибка поднимается в вызывающий код, а следующее обращение пробует снова.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], T]):
+        self.name = name
+        self._factory = factory
+        self._instance: T | None = None
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        instance = self._instance
+        if instance is not None:
+            return instance
+        with self._lock:
+            if self._instance is None:
+                started = time.perf_counter()
+                self._instance = self._factory()
+                logger.info(f"Сервис {self.name} создан за {(time.perf_counter() - started) * 1000:.0f} мс")
+            return self._instance
+
+    @property
+    def initialized(self) -> bool:
+        return self._instance is not None
+
+    def warm_up(self):
+        """Создает клиент и прогревает его соединения (метод warm_up экземпляра, если он есть)."""
+        warm = getattr(self.get(), "warm_up", None)
+        if warm is not None:
+            warm()
+
+    def __getattr__(self, attr: str):
+        return getattr(self.get(), attr)
+
+
+class LoopBound(Generic[T]):
+    """
+    Асинхронный клиент (redis.asyncio, httpx.AsyncClient), привязанный к event loop:
+    в каждом loop — свой экземпляр. Вместе с экземпляром в loop запускается задача-сторож;
+    при завершении loop (asyncio.run в prefork-задаче отменяет все оставшиеся задачи) она
+    закрывает клиент, поэтому соединения короткоживущих loop не копятся в процессе.
+    """
+
+    def __init__(self, factory: Callable[[], T], close: Callable[[T], Awaitable] = lambda client: client.aclose()):
+        self._factory = factory
+        self._close = close
+        self._instances: dict[asyncio.AbstractEventLoop, tuple[T, asyncio.Task]] = {}
+
+    def get(self) -> T:
+        loop = asyncio.get_running_loop()
+        entry = self._instances.get(loop)
+        if entry is None:
+            client = self._factory()
+            # Ссылка на сторожа хранится здесь: loop держит свои задачи только слабо
+            entry = self._instances[loop] = (client, loop.create_task(self._close_on_shutdown(loop, client)))
+        return entry[0]
+
+    async def _close_on_shutdown(self, loop: asyncio.AbstractEventLoop, client: T):
+        try:
+            await asyncio.Event().wait()
+        finally:
+            entry = self._instances.get(loop)
+            if entry is not None and entry[0] is client:
+                del self._instances[loop]
+                await self._close_client(client)
+
+    async def _close_client(self, client: T):
+        try:
+            await self._close(client)
+        except Exception as e:
+            logger.debug(f"Клиент закрыт с ошибкой: {e}")
+
+    async def aclose(self):
+        """Закрывает экземпляр текущего loop (для долгоживущих loop, которые останавливаются без отмены задач)."""
+        entry = self._instances.pop(asyncio.get_running_loop(), None)
+        if entry is not None:
+            entry[1].cancel()
+            await self._close_client(entry[0])
+
+
+_registry: dict[str, LazyService] = {}
+
+
+def register(name: str, factory: Callable[[], T]) -> LazyService[T]:
+    """Регистрирует ленивый сервис. Вызывается на уровне модуля вместо создания синглтона."""
+    service = LazyService(name, factory)
+    _registry[name] = service
+    return service
+
+
+def get_service(name: str):
+    return _registry[name].get()
+
+
+def warm_up(*services: LazyService) -> threading.Thread | None:
+    """
+    Прогревает сервисы (по умолчанию — все зарегистрированные) в фоновом потоке: старт
+    процесса не ждет сетевых подключений, а ошибка прогрева только пишется в лог —
+    клиент будет создан заново при первом запросе.
+    """
+    if not SERVICES_WARMUP_ENABLED:
+        return None
+    targets = list(services) or list(_registry.values())
+
+    def run():
+        for service in targets:
+            started = time.perf_counter()
+            try:
+                service.warm_up()
+                logger.info(f"Сервис {service.name} прогрет за {(time.perf_counter() - started) * 1000:.0f} мс")
+            except Exception as e:
+                logger.warning(f"Не удалось прогреть сервис {service.name}: {e}")
+
+    thread = threading.Thread(target=run, name="services-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def services_state() -> dict[str, bool]:
+    """Какие из зарегистрированных сервисов уже созданы."""
+    return {name: service.initialized for name, service in _registry.items()}
@@ -0,0 +1,233 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable, Iterable, TypeVar
+import redis
+import redis.asyncio as aioredis
+from shared.metrics import TASK_CANCELLATIONS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# --- Схема ключей ---
+# task_cancel:flag:{id} — STRING с причиной: запрошена остановка задачи. Воркер удаляет флаг,
+#                     когда закончил с задачей, — это и есть подтверждение для оркестратора.
+#                     Ключ вне task:*, где TaskStore.rebuild_indexes ищет записи задач
+# task_cancel       — канал pub/sub: ID задачи, которую нужно остановить немедленно
+# task_cancel:escalations — ZSET: ID задачи -> срок (unix-время), после которого неподтвержденная
+#                     остановка завершается SIGKILL. Сроки живут в Redis и переживают перезапуск API
+CANCEL_KEY = "task_cancel:flag:{task_id}"
+CANCEL_CHANNEL = "task_cancel"
+ESCALATION_KEY = "task_cancel:escalations"
+
+# Сколько хранится флаг, если задачу так и не взял ни один воркер (секунды)
+TASK_CANCEL_FLAG_TTL = int(os.getenv("TASK_CANCEL_FLAG_TTL", str(24 * 3600)))
+# Сколько асинхронный воркер ждет, пока отмененный агент закроет браузер и освободит ресурсы
+TASK_CANCEL_CLEANUP_TIMEOUT = float(os.getenv("TASK_CANCEL_CLEANUP_TIMEOUT", "10"))
+# Через сколько после остановки оркестратор убивает процесс воркера (SIGKILL), если тот не подтвердил отмену
+TASK_STOP_ESCALATION_SECONDS = float(os.getenv("TASK_STOP_ESCALATION_SECONDS", "30"))
+# Как часто API ищет остановки с истекшим сроком подтверждения (секунды)
+TASK_STOP_SWEEP_INTERVAL = float(os.getenv("TASK_STOP_SWEEP_INTERVAL", "5"))
+# Как часто блокирующий агент (Magnitude в prefork-воркере) проверяет флаг отмены (секунды)
+TASK_CANCEL_POLL_SECONDS = float(os.getenv("TASK_CANCEL_POLL_SECONDS", "1"))
+
+# Забирает задачи с истекшим сроком эскалации. Забранные удаляются из ZSET в том же скрипте,
+# поэтому при нескольких экземплярах API каждую задачу эскалирует только один из них
+_CLAIM_DUE_SCRIPT = """
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due > 0 then
+    redis.call('zrem', KEYS[1], unpack(due))
+end
+return due
+"""
+
+
+class TaskCancelledError(Exception):
+    """Задача остановлена пользователем, агент прерван на текущем шаге."""
+
+
+def cancel_key(task_id: str) -> str:
+    return CANCEL_KEY.format(task_id=task_id)
+
+
+async def arequest_cancel(
+    redis_client: aioredis.Redis, task_ids: Iterable[str], reason: str, escalate_after: float | None = None
+):
+    """
+    Ставит флаги отмены и оповещает воркеры, выполняющие эти задачи. Один round trip на все задачи.
+    С escalate_after задачи, не подтвердившие отмену за это время, заберет aclaim_due_escalations.
+    """
+    task_ids = list(task_ids)
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.set(cancel_key(task_id), reason, ex=TASK_CANCEL_FLAG_TTL)
+        pipe.publish(CANCEL_CHANNEL, task_id)
+    if escalate_after is not None and task_ids:
+        deadline = time.time() + escalate_after
+        pipe.zadd(ESCALATION_KEY, {task_id: deadline for task_id in task_ids})
+    await pipe.execute()
+
+
+async def aclaim_due_escalations(redis_client: aioredis.Redis, limit: int = 1000) -> list[str]:
+    """Задачи, срок подтверждения остановки которых истек; из очереди эскалаций они удаляются."""
+    return await redis_client.eval(_CLAIM_DUE_SCRIPT, 1, ESCALATION_KEY, time.time(), limit)
+
+
+async def apending_cancels(redis_client: aioredis.Redis, task_ids: list[str]) -> list[str]:
+    """Задачи, отмену которых воркер еще не подтвердил."""
+    if not task_ids:
+        return []
+    flags = await redis_client.mget([cancel_key(task_id) for task_id in task_ids])
+    return [task_id for task_id, flag in zip(task_ids, flags) if flag is not None]
+
+
+def is_cancel_requested(redis_client: redis.Redis, task_id: str) -> bool:
+    try:
+        return bool(redis_client.exists(cancel_key(task_id)))
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось проверить флаг отмены задачи {task_id}: {e}")
+        return False
+
+
+def acknowledge_cancel(redis_client: redis.Redis, task_id: str):
+    """Снимает флаг: воркер закончил с задачей, эскалация не нужна."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.delete(cancel_key(task_id))
+        pipe.zrem(ESCALATION_KEY, task_id)
+        deleted, _ = pipe.execute()
+        if deleted:
+            TASK_CANCELLATIONS.labels(outcome="cooperative").inc()
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось снять флаг отмены задачи {task_id}: {e}")
+
+
+@contextmanager
+def watch_cancel(
+    redis_client: redis.Redis, task_id: str, on_cancel: Callable[[], None], interval: float = TASK_CANCEL_POLL_SECONDS
+):
+    """
+    Отмена для агентов, выполняющих цель одним блокирующим вызовом. Фоновый поток раз
+    в interval секунд проверяет флаг отмены и, увидев его, вызывает on_cancel — например,
+    закрывает браузерную сессию, чтобы блокирующий вызов завершился ошибкой. Отдает Event,
+    установленный при отмене: по нему вызывающий отличает отмену от настоящей ошибки.
+    """
+    stopped, cancelled = threading.Event(), threading.Event()
+
+    def poll():
+        while not stopped.wait(interval):
+            if is_cancel_requested(redis_client, task_id):
+                logger.info(f"Задача {task_id} отменена, прерываю блокирующего агента")
+                cancelled.set()
+                try:
+                    on_cancel()
+                except Exception as e:
+                    logger.warning(f"Ошибка при прерывании агента задачи {task_id}: {e}")
+                return
+
+    thread = threading.Thread(target=poll, name=f"cancel-{task_id}", daemon=True)
+    thread.start()
+    try:
+        yield cancelled
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class CancellationWatcher:
+    """
+    Отмена задач для агентов асинхронного воркера. На процесс — одна подписка на канал
+    task_cancel (а не по соединению на агента); получив ID своей задачи, агент прерывается
+    там, где сейчас ждет: на запросе к LLM (отмена доходит до опроса RunPod в loop клиента),
+    на действии в браузере или на учете шага. Контекст браузера закрывается обычным выходом
+    из аренды, подключение к браузеру и процесс воркера остаются прогретыми.
+
+    Сообщения pub/sub, пришедшие без подписки (агент еще не стартовал, соединение
+    переподключалось), не теряются: флаги отмены сверяются при регистрации и после переподключения.
+    """
+
+    def __init__(self, redis_client: aioredis.Redis, cleanup_timeout: float = TASK_CANCEL_CLEANUP_TIMEOUT):
+        self.redis = redis_client
+        self.cleanup_timeout = cleanup_timeout
+        self._events: dict[str, asyncio.Event] = {}
+        self._listener: asyncio.Task | None = None
+
+    async def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(CANCEL_CHANNEL)
+                await self._check_flags(list(self._events))
+                async for message in pubsub.listen():
+                    event = self._events.get(message["data"])
+                    if event is not None:
+                        event.set()
+            except redis.RedisError as e:
+                logger.warning(f"Подписка на отмену задач прервана, переподключаюсь: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def _check_flags(self, task_ids: list[str]):
+        for task_id in await apending_cancels(self.redis, task_ids):
+            event = self._events.get(task_id)
+            if event is not None:
+                event.set()
+
+    @asynccontextmanager
+    async def watch(self, task_id: str):
+        """Событие, которое установится при отмене задачи."""
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+        event = self._events[task_id] = asyncio.Event()
+        try:
+            try:
+                await self._check_flags([task_id])
+            except redis.RedisError as e:
+                logger.warning(f"Не удалось проверить флаг отмены задачи {task_id}: {e}")
+            yield event
+        finally:
+            self._events.pop(task_id, None)
+
+    async def run(self, task_id: str, work: Awaitable[T]) -> T:
+        """
+        Выполняет работу агента до конца или до отмены задачи. При отмене прерывает ее
+        и ждет очистки не дольше cleanup_timeout, после чего поднимает TaskCancelledError.
+        """
+        async with self.watch(task_id) as cancelled:
+            work_task = asyncio.ensure_future(work)
+            waiter = asyncio.ensure_future(cancelled.wait())
+            try:
+                await asyncio.wait({work_task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                work_task.cancel()
+                raise
+            finally:
+                waiter.cancel()
+            if work_task.done():
+                return work_task.result()
+
+        logger.info(f"Задача {task_id} отменена, прерываю агента")
+        work_task.cancel()
+        done, _ = await asyncio.wait({work_task}, timeout=self.cleanup_timeout)
+        if done and not work_task.cancelled():
+            # Ошибка во время очистки уже не важна, но должна быть прочитана
+            work_task.exception()
+        if not done:
+            # Корутина зависла в очистке: слот воркера важнее, она доработает в фоне
+            TASK_CANCELLATIONS.labels(outcome="abandoned").inc()
+            logger.warning(f"Агент задачи {task_id} не завершился за {self.cleanup_timeout:g} с после отмены")
+        raise TaskCancelledError(task_id)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
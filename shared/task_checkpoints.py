@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import redis.asyncio as aioredis
+from shared.metrics import redis_op
+
+logger = logging.getLogger(__name__)
+
+# --- Схема ключей ---
+# task_checkpoints:{id} — LIST JSON-записей о выполненных шагах агента по порядку:
+#   step            — номер шага
+#   action          — действие, выбранное LLM (или оператором)
+#   outcome         — результат действия ("ok" или текст ошибки)
+#   url             — адрес страницы после действия: с него продолжается возобновленная задача
+#   perception_hash — отпечаток страницы, на которой действие было выбрано
+#   ts              — время записи
+# Ключ лежит вне task:*: в этом пространстве TaskStore.rebuild_indexes ищет записи самих задач
+CHECKPOINTS_KEY = "task_checkpoints:{task_id}"
+
+# Сколько хранить контрольные точки после последнего шага (секунды): задачу можно
+# возобновить или перезапустить в этом окне, дальше ключ удаляется Redis
+CHECKPOINT_RETENTION_SECONDS = int(os.getenv("CHECKPOINT_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# Сколько последних шагов задачи хранить (более ранние отбрасываются при записи)
+CHECKPOINT_MAX_STEPS = int(os.getenv("CHECKPOINT_MAX_STEPS", "200"))
+# Длина результата действия в контрольной точке: полный текст ошибки браузера для возобновления не нужен
+CHECKPOINT_OUTCOME_LIMIT = 300
+
+
+def checkpoints_key(task_id: str) -> str:
+    return CHECKPOINTS_KEY.format(task_id=task_id)
+
+
+def perception_hash(perception: dict) -> str:
+    """
+    Отпечаток страницы: адрес, заголовок и интерактивные элементы. Видимый текст не учитывается —
+    в нем часто меняются даты, счетчики и реклама, а для агента это та же страница.
+    """
+    elements = [
+        [element.get(attr) for attr in ("id", "tag", "text", "type", "role", "href", "name")]
+        for element in perception.get("elements", [])
+    ]
+    payload = json.dumps([perception.get("url"), perception.get("title"), elements], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def make_checkpoint(step: int, action: dict, outcome: str, url: str, page_hash: str) -> dict:
+    return {
+        "step": step,
+        "action": action,
+        "outcome": outcome[:CHECKPOINT_OUTCOME_LIMIT],
+        "url": url,
+        "perception_hash": page_hash,
+        "ts": round(time.time(), 3)
+    }
+
+
+class CheckpointStore:
+    """Компактная история шагов задачи в Redis: по ней агент продолжает работу с последнего удачного шага."""
+
+    def __init__(
+        self,
+        redis_client: aioredis.Redis,
+        retention: int = CHECKPOINT_RETENTION_SECONDS,
+        max_steps: int = CHECKPOINT_MAX_STEPS
+    ):
+        self.redis = redis_client
+        self.retention = retention
+        self.max_steps = max_steps
+
+    @redis_op("checkpoint_append")
+    async def append(self, task_id: str, checkpoint: dict):
+        key = checkpoints_key(task_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.rpush(key, json.dumps(checkpoint, ensure_ascii=False))
+        pipe.ltrim(key, -self.max_steps, -1)
+        # Окно хранения отсчитывается от последнего шага: точки брошенных задач удаляет сам Redis
+        pipe.expire(key, self.retention)
+        await pipe.execute()
+
+    @redis_op("checkpoint_load")
+    async def load(self, task_id: str) -> list[dict]:
+        checkpoints = []
+        for raw in await self.redis.lrange(checkpoints_key(task_id), 0, -1):
+            try:
+                checkpoints.append(json.loads(raw))
+            except json.JSONDecodeError:
+                logger.warning(f"Пропускаю поврежденную контрольную точку задачи {task_id}: {raw[:100]}")
+        return checkpoints
+
+    @redis_op("checkpoint_truncate")
+    async def truncate(self, task_id: str, keep: int):
+        """Оставляет первые keep точек: шаги после них придется выполнить заново."""
+        if keep <= 0:
+            await self.redis.delete(checkpoints_key(task_id))
+        else:
+            await self.redis.ltrim(checkpoints_key(task_id), 0, keep - 1)
+
+    @redis_op("checkpoint_clear")
+    async def clear(self, task_id: str):
+        await self.redis.delete(checkpoints_key(task_id))
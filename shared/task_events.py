@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import logging
+import redis
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+# --- Схема ключей ---
+# task_events:{id}  — Redis Stream событий одной задачи
+# task_events:all   — общий Stream событий всех задач (для мультиплексированной подписки)
+TASK_EVENTS_STREAM = "task_events:{task_id}"
+ALL_EVENTS_STREAM = "task_events:all"
+
+TASK_STREAM_MAXLEN = int(os.getenv("TASK_STREAM_MAXLEN", "1000"))
+ALL_STREAM_MAXLEN = int(os.getenv("ALL_STREAM_MAXLEN", "100000"))
+# Сколько хранить поток событий задачи после последнего события (секунды)
+TASK_STREAM_TTL = int(os.getenv("TASK_STREAM_TTL", str(24 * 3600)))
+
+
+def task_stream_key(task_id: str) -> str:
+    return TASK_EVENTS_STREAM.format(task_id=task_id)
+
+
+def publish_event(redis_client: redis.Redis, task_id: str, event_type: str, data: dict | None = None, pipe=None):
+    """
+    Публикует событие задачи в ее поток и в общий поток.
+    Если передан pipe, команды добавляются в него (без отдельного round trip).
+    """
+    fields = {
+        "type": event_type,
+        "task_id": task_id,
+        "data": json.dumps(data or {}, ensure_ascii=False),
+        "ts": f"{time.time():.3f}"
+    }
+    target = pipe if pipe is not None else redis_client.pipeline(transaction=False)
+    target.xadd(task_stream_key(task_id), fields, maxlen=TASK_STREAM_MAXLEN, approximate=True)
+    target.expire(task_stream_key(task_id), TASK_STREAM_TTL)
+    target.xadd(ALL_EVENTS_STREAM, fields, maxlen=ALL_STREAM_MAXLEN, approximate=True)
+    if pipe is None:
+        target.execute()
+
+
+async def apublish_event(redis_client: aioredis.Redis, task_id: str, event_type: str, data: dict | None = None):
+    """Асинхронная версия publish_event."""
+    pipe = redis_client.pipeline(transaction=False)
+    publish_event(redis_client, task_id, event_type, data, pipe=pipe)
+    await pipe.execute()
+
+
+def format_sse(event_id: str, fields: dict) -> str:
+    """Форматирует событие из Stream в кадр Server-Sent Events."""
+    payload = {
+        "task_id": fields.get("task_id"),
+        "ts": float(fields.get("ts", 0)),
+        "data": json.loads(fields.get("data", "{}"))
+    }
+    return f"id: {event_id}\nevent: {fields.get('type', 'message')}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def read_events(
+    redis_client: aioredis.Redis,
+    stream: str,
+    last_id: str,
+    block_ms: int = 15000,
+    count: int = 100
+) -> list[tuple[str, dict]]:
+    """Ждет новые события в потоке после last_id. Возвращает [(event_id, fields), ...]."""
+    response = await redis_client.xread({stream: last_id}, block=block_ms, count=count)
+    if not response:
+        return []
+    _, entries = response[0]
+    return entries
+
+
+async def stream_last_id(redis_client: aioredis.Redis, stream: str) -> str:
+    """
+    ID последнего события в потоке ("0-0", если событий нет). Подписка "только на новые"
+    должна начинаться с этого ID, а не с "$": "$" при каждом чтении означает "после текущего
+    конца", и события, пришедшие между чтениями, терялись бы.
+    """
+    entries = await redis_client.xrevrange(stream, count=1)
+    return entries[0][0] if entries else "0-0"
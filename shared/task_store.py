@@ -0,0 +1,565 @@
+import json
+import time
+import redis
+import redis.asyncio as aioredis
+import logging
+from datetime import datetime
+from typing import Iterable
+from shared.task_events import (
+    publish_event, task_stream_key, ALL_EVENTS_STREAM,
+    TASK_STREAM_MAXLEN, ALL_STREAM_MAXLEN, TASK_STREAM_TTL
+)
+from shared.metrics import redis_op
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# --- Схема ключей ---
+# task:{id}              — HASH с полями задачи
+# tasks:by_created       — ZSET всех задач, score = время создания
+# tasks:status:{status}  — ZSET задач в данном статусе, score = время создания
+# tasks:campaign:{id}    — ZSET задач одной кампании (пакетной отправки), score = время создания
+TASK_KEY = "task:{task_id}"
+# task:celery_id:{id}    — ID Celery-задачи, выполняющей задачу агента
+CELERY_ID_KEY = "task:celery_id:{task_id}"
+CREATED_INDEX = "tasks:by_created"
+STATUS_INDEX = "tasks:status:{status}"
+STATUS_INDEX_PREFIX = "tasks:status:"
+CAMPAIGN_INDEX = "tasks:campaign:{campaign_id}"
+
+TASK_STATUSES = (
+    "pending",
+    "queued",
+    "in_progress",
+    "completed",
+    "error",
+    "stopped",
+    "human_intervention_required",
+)
+STATUS_INDEX_KEYS = [STATUS_INDEX.format(status=status) for status in TASK_STATUSES]
+# Статусы, из которых задача уже не выйдет сама
+TERMINAL_STATUSES = ("completed", "error", "stopped")
+
+# Поля со сложными значениями хранятся в хэше как JSON, счетчики — как целые числа,
+# все остальное — как обычные строки.
+JSON_FIELDS = {"browser_endpoints", "failed_action_context", "result"}
+COUNTER_FIELDS = {"steps_completed"}
+
+# Частичное обновление задачи за один вызов: проверка статуса (compare-and-set),
+# запись/удаление полей, инкременты счетчиков, перенос между статусными индексами
+# и публикация события о смене статуса в потоки задачи (атомарно с самой сменой).
+# Все ключи, которые трогает скрипт, передаются в KEYS (статусные индексы — с KEYS[5], все сразу:
+# текущий статус заранее неизвестен), как того требуют Redis Cluster и проверка слотов ключей.
+# Возвращает {код, статус до обновления}: 1 — обновлено, 0 — статус не совпал,
+# -1 — задачи нет, -2 — запись в старом формате (JSON-строка).
+_UPDATE_SCRIPT = """
+local key = KEYS[1]
+local key_type = redis.call('type', key).ok
+if key_type == 'none' then return {-1, false} end
+if key_type ~= 'hash' then return {-2, false} end
+
+local args = cjson.decode(ARGV[1])
+local task_id = ARGV[2]
+local current = redis.call('hget', key, 'status')
+
+if #args.expected > 0 then
+    local matched = false
+    for _, status in ipairs(args.expected) do
+        if status == current then matched = true end
+    end
+    if not matched then return {0, current} end
+end
+
+local status_keys = {}
+for i = 5, #KEYS do status_keys[KEYS[i]] = true end
+local new_status = args.set.status
+if new_status and not status_keys[ARGV[3] .. new_status] then
+    return redis.error_reply('unknown task status: ' .. new_status)
+end
+
+local hset_args = {}
+for field, value in pairs(args.set) do
+    table.insert(hset_args, field)
+    table.insert(hset_args, value)
+end
+if #hset_args > 0 then redis.call('hset', key, unpack(hset_args)) end
+for _, field in ipairs(args.delete) do redis.call('hdel', key, field) end
+for field, amount in pairs(args.incr) do redis.call('hincrby', key, field, amount) end
+
+if new_status and new_status ~= current then
+    local score = redis.call('zscore', KEYS[2], task_id) or 0
+    if current and status_keys[ARGV[3] .. current] then redis.call('zrem', ARGV[3] .. current, task_id) end
+    redis.call('zadd', ARGV[3] .. new_status, score, task_id)
+
+    local event = {status = new_status, previous_status = current or cjson.null}
+    if args.set.status_reason then event.status_reason = args.set.status_reason end
+    if args.set.result then event.result = cjson.decode(args.set.result) end
+    local fields = {'type', 'status', 'task_id', task_id, 'data', cjson.encode(event), 'ts', ARGV[4]}
+    redis.call('xadd', KEYS[3], 'MAXLEN', '~', ARGV[5], '*', unpack(fields))
+    redis.call('expire', KEYS[3], ARGV[7])
+    redis.call('xadd', KEYS[4], 'MAXLEN', '~', ARGV[6], '*', unpack(fields))
+end
+return {1, current}
+"""
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def _encode_fields(fields: dict) -> tuple[dict[str, str], list[str]]:
+    """Готовит поля к записи в хэш. None означает удаление поля."""
+    to_set, to_delete = {}, []
+    for field, value in fields.items():
+        if value is None:
+            to_delete.append(field)
+        elif field in JSON_FIELDS:
+            to_set[field] = json.dumps(value, ensure_ascii=False)
+        else:
+            to_set[field] = str(value)
+    return to_set, to_delete
+
+
+def _decode_fields(raw: dict[str, str]) -> dict:
+    task_data = {}
+    for field, value in raw.items():
+        if field in JSON_FIELDS:
+            task_data[field] = json.loads(value)
+        elif field in COUNTER_FIELDS:
+            task_data[field] = int(value)
+        else:
+            task_data[field] = value
+    return task_data
+
+
+class _TaskStoreBase:
+    """Общая для синхронного и асинхронного хранилищ логика: ключи, кодирование, разбор ответов."""
+
+    @staticmethod
+    def _task_key(task_id: str) -> str:
+        return TASK_KEY.format(task_id=task_id)
+
+    @staticmethod
+    def _index_status(pipe, task_id: str, status: str, score: float):
+        # Задача может находиться только в одном статусном индексе
+        for other in TASK_STATUSES:
+            if other != status:
+                pipe.zrem(STATUS_INDEX.format(status=other), task_id)
+        pipe.zadd(STATUS_INDEX.format(status=status), {task_id: score})
+
+    def _queue_save(self, pipe, task_data: dict, created_at: float | None, new: bool, celery_task_id: str | None):
+        """
+        Добавляет в pipeline команды полной записи задачи с индексами и событием.
+        Для новой задачи (new=True) не нужно чистить старую запись и другие статусные индексы.
+        """
+        task_id = task_data["id"]
+        score = created_at if created_at is not None else time.time()
+        status = task_data.get("status", "pending")
+        to_set, _ = _encode_fields(task_data)
+        if new:
+            pipe.hset(self._task_key(task_id), mapping=to_set)
+            pipe.zadd(STATUS_INDEX.format(status=status), {task_id: score})
+        else:
+            pipe.delete(self._task_key(task_id))
+            pipe.hset(self._task_key(task_id), mapping=to_set)
+            self._index_status(pipe, task_id, status, score)
+        pipe.zadd(CREATED_INDEX, {task_id: score})
+        if task_data.get("campaign_id"):
+            pipe.zadd(CAMPAIGN_INDEX.format(campaign_id=task_data["campaign_id"]), {task_id: score})
+        if celery_task_id:
+            pipe.set(CELERY_ID_KEY.format(task_id=task_id), celery_task_id)
+        publish_event(self.redis, task_id, "status", {"status": status, "previous_status": None}, pipe=pipe)
+
+    def _update_script_call(self, task_id: str, expected: list[str], incr: dict | None, fields: dict) -> dict:
+        to_set, to_delete = _encode_fields(fields)
+        args = json.dumps({
+            "expected": expected,
+            "set": to_set,
+            "delete": to_delete,
+            "incr": incr or {}
+        }, ensure_ascii=False)
+        return {
+            "keys": [self._task_key(task_id), CREATED_INDEX, task_stream_key(task_id), ALL_EVENTS_STREAM, *STATUS_INDEX_KEYS],
+            "args": [
+                args, task_id, STATUS_INDEX_PREFIX, f"{time.time():.3f}",
+                TASK_STREAM_MAXLEN, ALL_STREAM_MAXLEN, TASK_STREAM_TTL
+            ]
+        }
+
+    @staticmethod
+    def _expected_list(expected_status: str | Iterable[str] | None) -> list[str]:
+        if isinstance(expected_status, str):
+            return [expected_status]
+        return list(expected_status or [])
+
+    @staticmethod
+    def _update_outcome(task_id: str, code: int, current: str | None, expected: list[str]) -> bool | None:
+        if code == -1:
+            return None
+        if code == 0:
+            logger.info(f"Задача {task_id} в статусе '{current}', ожидался {expected}. Обновление отклонено.")
+            return False
+        return True
+
+    @staticmethod
+    def _decode_many(task_ids: list[str], raws: list) -> tuple[list[dict | None], list[int]]:
+        """Разбирает ответы HGETALL. Возвращает задачи и позиции записей старого формата."""
+        tasks, legacy_positions = [], []
+        for position, (task_id, raw) in enumerate(zip(task_ids, raws)):
+            if isinstance(raw, redis.ResponseError):
+                legacy_positions.append(position)
+                tasks.append(None)
+                continue
+            try:
+                tasks.append(_decode_fields(raw) if raw else None)
+            except (json.JSONDecodeError, ValueError):
+                logger.warning(f"Не удалось разобрать задачу '{task_id}'. Значение: '{raw}'")
+                tasks.append(None)
+        return tasks, legacy_positions
+
+    @staticmethod
+    def _parse_legacy(task_id: str, task_json: str | None) -> dict | None:
+        try:
+            return json.loads(task_json) if task_json else None
+        except json.JSONDecodeError:
+            logger.warning(f"Не удалось распарсить JSON задачи '{task_id}'. Значение: '{task_json}'")
+            return None
+
+    @staticmethod
+    def _page_index(status: str | None, campaign_id: str | None) -> str:
+        if campaign_id:
+            return CAMPAIGN_INDEX.format(campaign_id=campaign_id)
+        return STATUS_INDEX.format(status=status) if status else CREATED_INDEX
+
+    @staticmethod
+    def _filter_page(tasks: list[dict], status: str | None, campaign_id: str | None) -> list[dict]:
+        # Страница кампании листается по ее индексу, статус проверяем уже на прочитанных задачах
+        if campaign_id and status:
+            return [task for task in tasks if task.get("status") == status]
+        return tasks
+
+
+class TaskStore(_TaskStoreBase):
+    """
+    Хранилище состояния задач в Redis.
+
+    Каждая задача — хэш, поэтому статус, причина, результат и счетчики шагов
+    обновляются по отдельности и атомарно (один вызов Lua-скрипта на обновление),
+    а параллельные обновления разных полей не затирают друг друга.
+    Вторичные индексы позволяют листать задачи без KEYS и без чтения всех записей.
+    """
+
+    def __init__(self, redis_client: redis.Redis):
+        # Клиент должен быть создан с decode_responses=True
+        self.redis = redis_client
+        self._update_script = self.redis.register_script(_UPDATE_SCRIPT)
+
+    @redis_op("task_store.save")
+    def save(
+        self,
+        task_data: dict,
+        created_at: float | None = None,
+        new: bool = False,
+        celery_task_id: str | None = None
+    ):
+        """
+        Сохраняет задачу целиком и регистрирует ее в индексах (одна транзакция).
+        celery_task_id, если передан, записывается в той же транзакции.
+        """
+        pipe = self.redis.pipeline()
+        self._queue_save(pipe, task_data, created_at, new, celery_task_id)
+        pipe.execute()
+
+    @redis_op("task_store.get")
+    def get(self, task_id: str) -> dict | None:
+        try:
+            raw = self.redis.hgetall(self._task_key(task_id))
+        except redis.ResponseError:
+            # Запись в старом формате (JSON-строка)
+            return self._read_legacy(task_id)
+        return _decode_fields(raw) if raw else None
+
+    @redis_op("task_store.get_many")
+    def get_many(self, task_ids: list[str]) -> list[dict]:
+        """Читает пачку задач за один round trip. Отсутствующие и битые записи пропускаются."""
+        if not task_ids:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(self._task_key(task_id))
+        tasks, legacy_positions = self._decode_many(task_ids, pipe.execute(raise_on_error=False))
+        for position in legacy_positions:
+            tasks[position] = self._read_legacy(task_ids[position])
+        return [task for task in tasks if task]
+
+    @redis_op("task_store.update")
+    def update(
+        self,
+        task_id: str,
+        expected_status: str | Iterable[str] | None = None,
+        incr: dict[str, int] | None = None,
+        **fields
+    ) -> bool | None:
+        """
+        Атомарно обновляет поля задачи за один round trip.
+
+        expected_status — compare-and-set: обновление применяется, только если текущий
+        статус совпадает с ним (или с одним из списка). incr — инкременты счетчиков.
+        Поле со значением None удаляется.
+        Возвращает True при успехе, False если статус не совпал, None если задачи нет.
+        """
+        expected = self._expected_list(expected_status)
+        call = self._update_script_call(task_id, expected, incr, fields)
+        code, current = self._update_script(**call)
+        if code == -2:
+            self._migrate_legacy(task_id)
+            code, current = self._update_script(**call)
+        return self._update_outcome(task_id, code, current, expected)
+
+    @redis_op("task_store.list_page")
+    def list_page(
+        self,
+        status: str | None = None,
+        limit: int = 50,
+        cursor: str | None = None,
+        campaign_id: str | None = None
+    ) -> tuple[list[dict], str | None]:
+        """
+        Возвращает страницу задач (новые первыми) и курсор следующей страницы.
+        Курсор — ID последней задачи на странице; новые задачи, созданные между
+        запросами страниц, не сдвигают выдачу.
+        С campaign_id выдаются только задачи кампании; страница при фильтре по статусу
+        может оказаться короче limit, конец выдачи определяется по next_cursor.
+        """
+        index = self._page_index(status, campaign_id)
+
+        if cursor is None:
+            task_ids = self.redis.zrevrange(index, 0, limit - 1)
+        else:
+            rank = self.redis.zrevrank(index, cursor)
+            if rank is not None:
+                task_ids = self.redis.zrevrange(index, rank + 1, rank + limit)
+            else:
+                # Задача-курсор успела сменить статус: продолжаем по времени ее создания
+                score = self.redis.zscore(CREATED_INDEX, cursor)
+                if score is None:
+                    raise InvalidCursorError(f"Неизвестный курсор: {cursor}")
+                task_ids = self.redis.zrevrangebyscore(index, f"({score}", "-inf", start=0, num=limit)
+
+        tasks = self.get_many(task_ids)
+        next_cursor = task_ids[-1] if len(task_ids) == limit else None
+        return self._filter_page(tasks, status, campaign_id), next_cursor
+
+    # --- Миграция записей старого формата ---
+
+    def _read_legacy(self, task_id: str) -> dict | None:
+        return self._parse_legacy(task_id, self.redis.get(self._task_key(task_id)))
+
+    def _migrate_legacy(self, task_id: str):
+        """Переводит задачу из JSON-строки в хэш."""
+        task_data = self._read_legacy(task_id)
+        if task_data is None:
+            return
+        to_set, _ = _encode_fields(task_data)
+        pipe = self.redis.pipeline()
+        pipe.delete(self._task_key(task_id))
+        pipe.hset(self._task_key(task_id), mapping=to_set)
+        pipe.execute()
+
+    def rebuild_indexes(self, batch_size: int = 1000) -> int:
+        """
+        Переводит старые записи в хэши и строит индексы для всех задач (SCAN, без KEYS).
+        Время создания берется из поля created_at, для старых записей — 0.
+        """
+        indexed = 0
+        batch: list[str] = []
+
+        def flush():
+            nonlocal indexed
+            pipe = self.redis.pipeline()
+            for task_data in self.get_many(batch):
+                if "id" not in task_data:
+                    continue
+                if self.redis.type(self._task_key(task_data["id"])) == "string":
+                    self._migrate_legacy(task_data["id"])
+                created_at = task_data.get("created_at")
+                score = _parse_timestamp(created_at) if created_at else 0
+                pipe.zadd(CREATED_INDEX, {task_data["id"]: score})
+                if task_data.get("campaign_id"):
+                    pipe.zadd(CAMPAIGN_INDEX.format(campaign_id=task_data["campaign_id"]), {task_data["id"]: score})
+                self._index_status(pipe, task_data["id"], task_data.get("status", "pending"), score)
+                indexed += 1
+            pipe.execute()
+            batch.clear()
+
+        for key in self.redis.scan_iter(match="task:*", count=batch_size):
+            task_id = key.removeprefix("task:")
+            # Запись задачи — только task:{id}; ключи с суффиксом (task:celery_id:{id} и т.п.) служебные
+            if ":" in task_id:
+                continue
+            batch.append(task_id)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        logger.info(f"Переиндексировано задач: {indexed}")
+        return indexed
+
+
+class AsyncTaskStore(_TaskStoreBase):
+    """
+    Асинхронный вариант TaskStore поверх redis.asyncio для API оркестратора.
+    Формат данных, индексы и события те же; миграция старых записей — в TaskStore.
+    """
+
+    def __init__(self, redis_client: aioredis.Redis):
+        # Клиент должен быть создан с decode_responses=True
+        self.redis = redis_client
+        self._update_script = self.redis.register_script(_UPDATE_SCRIPT)
+
+    @redis_op("task_store.save")
+    async def save(
+        self,
+        task_data: dict,
+        created_at: float | None = None,
+        new: bool = False,
+        celery_task_id: str | None = None
+    ):
+        pipe = self.redis.pipeline()
+        self._queue_save(pipe, task_data, created_at, new, celery_task_id)
+        await pipe.execute()
+
+    @redis_op("task_store.save_many")
+    async def save_many(
+        self,
+        tasks: list[tuple[dict, str | None]],
+        created_at: float | None = None,
+        chunk_size: int = 500
+    ):
+        """
+        Сохраняет пачку новых задач [(task_data, celery_task_id), ...].
+        Записи, индексы и события уходят транзакциями по chunk_size задач — round trip на пачку.
+        """
+        for start in range(0, len(tasks), chunk_size):
+            pipe = self.redis.pipeline()
+            for task_data, celery_task_id in tasks[start:start + chunk_size]:
+                self._queue_save(pipe, task_data, created_at, True, celery_task_id)
+            await pipe.execute()
+
+    @redis_op("task_store.get")
+    async def get(self, task_id: str) -> dict | None:
+        try:
+            raw = await self.redis.hgetall(self._task_key(task_id))
+        except redis.ResponseError:
+            return self._parse_legacy(task_id, await self.redis.get(self._task_key(task_id)))
+        return _decode_fields(raw) if raw else None
+
+    @redis_op("task_store.get_many")
+    async def get_many(self, task_ids: list[str]) -> list[dict]:
+        if not task_ids:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(self._task_key(task_id))
+        tasks, legacy_positions = self._decode_many(task_ids, await pipe.execute(raise_on_error=False))
+        for position in legacy_positions:
+            task_id = task_ids[position]
+            tasks[position] = self._parse_legacy(task_id, await self.redis.get(self._task_key(task_id)))
+        return [task for task in tasks if task]
+
+    @redis_op("task_store.update")
+    async def update(
+        self,
+        task_id: str,
+        expected_status: str | Iterable[str] | None = None,
+        incr: dict[str, int] | None = None,
+        **fields
+    ) -> bool | None:
+        expected = self._expected_list(expected_status)
+        call = self._update_script_call(task_id, expected, incr, fields)
+        code, current = await self._update_script(**call)
+        if code == -2:
+            await self._migrate_legacy(task_id)
+            code, current = await self._update_script(**call)
+        return self._update_outcome(task_id, code, current, expected)
+
+    @redis_op("task_store.update_many")
+    async def update_many(
+        self,
+        task_ids: list[str],
+        expected_status: str | Iterable[str] | None = None,
+        chunk_size: int = 500,
+        **fields
+    ) -> list[bool | None]:
+        """Применяет одно и то же обновление к многим задачам, пачками вызовов скрипта в pipeline."""
+        expected = self._expected_list(expected_status)
+        outcomes = []
+        for start in range(0, len(task_ids), chunk_size):
+            chunk = task_ids[start:start + chunk_size]
+            pipe = self.redis.pipeline(transaction=False)
+            for task_id in chunk:
+                await self._update_script(client=pipe, **self._update_script_call(task_id, expected, None, fields))
+            for task_id, (code, current) in zip(chunk, await pipe.execute()):
+                if code == -2:
+                    outcomes.append(await self.update(task_id, expected_status=expected, **fields))
+                else:
+                    outcomes.append(self._update_outcome(task_id, code, current, expected))
+        return outcomes
+
+    @redis_op("task_store.campaign_task_ids")
+    async def campaign_task_ids(self, campaign_id: str) -> list[str]:
+        return await self.redis.zrange(CAMPAIGN_INDEX.format(campaign_id=campaign_id), 0, -1)
+
+    @redis_op("task_store.get_celery_ids")
+    async def get_celery_ids(self, task_ids: list[str]) -> list[str | None]:
+        if not task_ids:
+            return []
+        return await self.redis.mget([CELERY_ID_KEY.format(task_id=task_id) for task_id in task_ids])
+
+    @redis_op("task_store.list_page")
+    async def list_page(
+        self,
+        status: str | None = None,
+        limit: int = 50,
+        cursor: str | None = None,
+        campaign_id: str | None = None
+    ) -> tuple[list[dict], str | None]:
+        index = self._page_index(status, campaign_id)
+
+        if cursor is None:
+            task_ids = await self.redis.zrevrange(index, 0, limit - 1)
+        else:
+            rank = await self.redis.zrevrank(index, cursor)
+            if rank is not None:
+                task_ids = await self.redis.zrevrange(index, rank + 1, rank + limit)
+            else:
+                score = await self.redis.zscore(CREATED_INDEX, cursor)
+                if score is None:
+                    raise InvalidCursorError(f"Неизвестный курсор: {cursor}")
+                task_ids = await self.redis.zrevrangebyscore(index, f"({score}", "-inf", start=0, num=limit)
+
+        tasks = await self.get_many(task_ids)
+        next_cursor = task_ids[-1] if len(task_ids) == limit else None
+        return self._filter_page(tasks, status, campaign_id), next_cursor
+
+    async def _migrate_legacy(self, task_id: str):
+        task_data = self._parse_legacy(task_id, await self.redis.get(self._task_key(task_id)))
+        if task_data is None:
+            return
+        to_set, _ = _encode_fields(task_data)
+        pipe = self.redis.pipeline()
+        pipe.delete(self._task_key(task_id))
+        pipe.hset(self._task_key(task_id), mapping=to_set)
+        await pipe.execute()
+
+def _parse_timestamp(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    # Разовая миграция: python -m shared.task_store
+    import shared.logging_config
+    store = TaskStore(redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True))
+    store.rebuild_indexes()
\ No newline at end of file
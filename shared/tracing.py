@@ -0,0 +1,62 @@
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from opentelemetry import trace
+
+logger = logging.getLogger(__name__)
+
+# Какая задача и какой воркер выполняют текущий код (поток Celery или корутина агента)
+current_task_id: contextvars.ContextVar[str] = contextvars.ContextVar("task_id", default="-")
+current_worker_id: contextvars.ContextVar[str] = contextvars.ContextVar("worker_id", default="-")
+
+_tracer = trace.get_tracer("ornold")
+
+
+def bind_task(task_id: str, worker_id: str | None = None):
+    """Привязывает текущий поток или корутину к задаче: ее ID попадет в спаны и строки логов."""
+    current_task_id.set(task_id)
+    if worker_id is not None:
+        current_worker_id.set(worker_id)
+
+
+def bind_worker(worker_id: str):
+    current_worker_id.set(worker_id)
+
+
+def trace_context() -> dict[contextvars.ContextVar, str]:
+    """Снимок привязки для передачи в другой поток или event loop (см. in_trace_context)."""
+    return {current_task_id: current_task_id.get(), current_worker_id: current_worker_id.get()}
+
+
+async def in_trace_context(coro, context: dict[contextvars.ContextVar, str]):
+    """Выполняет корутину с привязкой вызывающего (корутина в чужом loop получает свой контекст)."""
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Спан OpenTelemetry с task_id и worker_id текущей привязки. Без настроенного SDK
+    спаны ничего не стоят; длительность в любом случае пишется в DEBUG-лог, так что
+    задачу можно проследить от API до LLM и браузера по task_id.
+    """
+    attributes = {"task_id": current_task_id.get(), "worker_id": current_worker_id.get(), **attributes}
+    started = time.monotonic()
+    # Исключение OpenTelemetry записывает в спан сам
+    with _tracer.start_as_current_span(name, attributes=attributes) as otel_span:
+        try:
+            yield otel_span
+        finally:
+            logger.debug(f"span {name} {(time.monotonic() - started) * 1000:.1f} мс {attributes}")
+
+
+class TraceContextFilter(logging.Filter):
+    """Добавляет task_id и worker_id к каждой записи лога."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.task_id = current_task_id.get()
+        record.worker_id = current_worker_id.get()
+        return True
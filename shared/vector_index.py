@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+import numpy as np
+import redis
+from pathlib import Path
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Каталог с локальными репликами коллекций (общий для всех процессов на хосте)
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "/tmp/ornold_vector_index")
+# Как часто сверяться с ChromaDB (секунды)
+VECTOR_INDEX_REFRESH_SECONDS = float(os.getenv("VECTOR_INDEX_REFRESH_SECONDS", "30"))
+# Как часто процесс проверяет в Redis, не записал ли кто-то в коллекцию (секунды)
+VECTOR_INDEX_VERSION_CHECK_SECONDS = float(os.getenv("VECTOR_INDEX_VERSION_CHECK_SECONDS", "1"))
+# Сколько последних измененных ID помнит журнал изменений коллекции
+VECTOR_INDEX_CHANGES_LIMIT = 10000
+
+# --- Схема ключей ---
+# vector_index:{name}:version — INT: номер последней записи в коллекцию (общий для всех хостов)
+# vector_index:{name}:changes — ZSET id -> номер записи, в которой документ добавлен или изменен
+# vector_index:{name}:trimmed — INT: последний номер записи, вытесненный из журнала изменений
+VERSION_KEY = "vector_index:{name}:version"
+CHANGES_KEY = "vector_index:{name}:changes"
+TRIMMED_KEY = "vector_index:{name}:trimmed"
+
+_PUBLISH_CHANGES_SCRIPT = """
+local version = redis.call('incr', KEYS[1])
+for _, id in ipairs(ARGV) do
+    redis.call('zadd', KEYS[2], version, id)
+end
+local overflow = redis.call('zcard', KEYS[2]) - tonumber(ARGV_LIMIT)
+if overflow > 0 then
+    local trimmed = redis.call('zrange', KEYS[2], overflow - 1, overflow - 1, 'WITHSCORES')
+    redis.call('set', KEYS[3], trimmed[2])
+    redis.call('zremrangebyrank', KEYS[2], 0, overflow - 1)
+end
+return version
+""".replace("ARGV_LIMIT", str(VECTOR_INDEX_CHANGES_LIMIT))
+
+_redis_client: redis.Redis | None = None
+
+
+def _get_redis() -> redis.Redis:
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True, socket_timeout=1)
+    return _redis_client
+
+
+def publish_changes(collection_name: str, ids: list[str]):
+    """
+    Отмечает запись в коллекцию: реплики на всех хостах увидят новую версию при следующем
+    запросе и дочитают только эти документы. Сбой Redis не мешает записи — реплики
+    сверятся с Chroma по VECTOR_INDEX_REFRESH_SECONDS.
+    """
+    try:
+        _get_redis().eval(
+            _PUBLISH_CHANGES_SCRIPT, 3,
+            VERSION_KEY.format(name=collection_name),
+            CHANGES_KEY.format(name=collection_name),
+            TRIMMED_KEY.format(name=collection_name),
+            *ids
+        )
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось отметить изменения коллекции '{collection_name}': {e}")
+
+
+class LocalVectorIndex:
+    """
+    Локальная read-реплика коллекции ChromaDB для быстрого поиска без сетевых вызовов.
+
+    Нормализованные эмбеддинги лежат в файле float32, который каждый процесс отображает
+    в память (np.memmap), поэтому все воркеры на хосте делят одну копию данных.
+    ID, метаданные и документы хранятся рядом в JSON. Обновление инкрементальное:
+    у Chroma запрашивается только список ID, а эмбеддинги, метаданные и документы — лишь
+    для новых ID и для ID из журнала изменений в Redis (ID в наших коллекциях — хэши
+    содержимого, поэтому вектор под тем же ID не меняется, а метаданные могут).
+    Записи с любого хоста увеличивают общую версию коллекции, и реплики сверяются с Chroma
+    сразу, а не через VECTOR_INDEX_REFRESH_SECONDS. Источником истины остается ChromaDB.
+    """
+
+    def __init__(self, collection, directory: str = VECTOR_INDEX_DIR, refresh_interval: float = VECTOR_INDEX_REFRESH_SECONDS):
+        self.collection = collection
+        self.name = collection.name
+        self.refresh_interval = refresh_interval
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.meta_path = self.dir / f"{self.name}.meta.json"
+        self.lock_path = self.dir / f"{self.name}.lock"
+
+        self._version: str | None = None
+        self._matrix: np.ndarray | None = None
+        self._ids: list[str] = []
+        self._metadatas: list[dict | None] = []
+        self._documents: list[str | None] = []
+        self._stale = False
+        self._version_checked_at = 0.0
+        self.version_key = VERSION_KEY.format(name=self.name)
+        self.changes_key = CHANGES_KEY.format(name=self.name)
+        self.trimmed_key = TRIMMED_KEY.format(name=self.name)
+        # Запросы идут из потоков (asyncio.to_thread): загрузка новой версии и сверка с Chroma
+        # не должны пересекаться друг с другом и с чтением реплики. Между процессами сверку
+        # защищает flock на lock_path. RLock — query вызывает refresh под ним же
+        self._lock = threading.RLock()
+
+    # --- Чтение общей реплики ---
+
+    def _read_meta(self) -> dict | None:
+        try:
+            return json.loads(self.meta_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _load(self, meta: dict | None = None) -> dict | None:
+        """Подхватывает актуальную версию реплики, если ее обновил другой процесс."""
+        with self._lock:
+            return self._load_locked(meta)
+
+    def _load_locked(self, meta: dict | None = None) -> dict | None:
+        meta = meta or self._read_meta()
+        if meta is None or meta["version"] == self._version:
+            return meta
+        try:
+            self._matrix = np.memmap(
+                self.dir / meta["matrix_file"], dtype=np.float32, mode="r", shape=(meta["count"], meta["dim"])
+            ) if meta["count"] else None
+        except FileNotFoundError:
+            # Файл успели заменить новой версией между чтением meta и отображением
+            return self._load_locked()
+        self._ids = meta["ids"]
+        self._metadatas = meta["metadatas"]
+        self._documents = meta["documents"]
+        self._version = meta["version"]
+        return meta
+
+    # --- Синхронизация с ChromaDB ---
+
+    def mark_stale(self):
+        """Принудительно сверить реплику с Chroma при следующем запросе этого процесса."""
+        self._stale = True
+
+    def _remote_version(self) -> int | None:
+        try:
+            return int(_get_redis().get(self.version_key) or 0)
+        except redis.RedisError as e:
+            logger.warning(f"Локальный индекс '{self.name}': не удалось проверить версию коллекции: {e}")
+            return None
+
+    def _needs_refresh(self, meta: dict | None) -> bool:
+        if self._stale or meta is None or time.time() - meta["refreshed_at"] >= self.refresh_interval:
+            return True
+        if time.monotonic() - self._version_checked_at < VECTOR_INDEX_VERSION_CHECK_SECONDS:
+            return False
+        self._version_checked_at = time.monotonic()
+        remote_version = self._remote_version()
+        return remote_version is not None and remote_version > meta.get("source_version", 0)
+
+    def maybe_refresh(self):
+        with self._lock:
+            if self._needs_refresh(self._load()):
+                self.refresh()
+
+    def _changed_ids(self, meta: dict | None, source_version: int | None) -> set[str] | None:
+        """ID, измененные после версии реплики; None — журнал недоступен или неполон, перечитать все."""
+        applied = (meta or {}).get("source_version", 0)
+        if meta is None or source_version is None:
+            return None
+        if source_version <= applied:
+            return set()
+        try:
+            pipe = _get_redis().pipeline()
+            pipe.get(self.trimmed_key)
+            pipe.zrangebyscore(self.changes_key, f"({applied}", "+inf")
+            trimmed, changes = pipe.execute()
+        except redis.RedisError:
+            return None
+        # Журнал обрезан дальше версии реплики: часть изменений потеряна
+        if int(trimmed or 0) > applied:
+            return None
+        return set(changes)
+
+    def refresh(self):
+        """Инкрементально синхронизирует реплику с коллекцией Chroma."""
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self._load()
+            # Пока мы ждали блокировку, реплику мог обновить другой процесс
+            self._version_checked_at = 0.0
+            if not self._needs_refresh(meta):
+                self._stale = False
+                return
+
+            # Версию читаем до запроса к Chroma: запись, сделанная во время сверки, даст еще одну
+            source_version = self._remote_version()
+            remote_ids = self.collection.get(include=[])["ids"]
+            local_rows = {doc_id: row for row, doc_id in enumerate(self._ids)}
+            new_ids = [doc_id for doc_id in remote_ids if doc_id not in local_rows]
+            changed = self._changed_ids(meta, source_version)
+            refetch = [
+                doc_id for doc_id in remote_ids
+                if doc_id in local_rows and (changed is None or doc_id in changed)
+            ]
+
+            new_vectors = np.empty((0, 0), dtype=np.float32)
+            rows: dict[str, tuple] = {}
+            if new_ids:
+                fetched = self.collection.get(ids=new_ids, include=["embeddings", "metadatas", "documents"])
+                by_id = dict(zip(fetched["ids"], fetched["embeddings"]))
+                new_vectors = np.asarray([by_id[doc_id] for doc_id in new_ids], dtype=np.float32)
+                norms = np.linalg.norm(new_vectors, axis=1, keepdims=True)
+                new_vectors /= np.where(norms == 0, 1, norms)
+                rows.update(zip(fetched["ids"], zip(fetched["metadatas"], fetched["documents"])))
+            if refetch:
+                fetched = self.collection.get(ids=refetch, include=["metadatas", "documents"])
+                rows.update(zip(fetched["ids"], zip(fetched["metadatas"], fetched["documents"])))
+            remote = {
+                "ids": remote_ids,
+                "metadatas": [
+                    rows[doc_id][0] if doc_id in rows else self._metadatas[local_rows[doc_id]] for doc_id in remote_ids
+                ],
+                "documents": [
+                    rows[doc_id][1] if doc_id in rows else self._documents[local_rows[doc_id]] for doc_id in remote_ids
+                ],
+                "source_version": source_version if source_version is not None else (meta or {}).get("source_version", 0)
+            }
+
+            kept_rows = [local_rows[doc_id] for doc_id in remote_ids if doc_id in local_rows]
+            unchanged = not new_ids and kept_rows == list(range(len(self._ids)))
+
+            if unchanged and meta is not None:
+                # Векторы те же — переиспользуем файл матрицы, обновляем метаданные и отметку времени
+                self._write_meta(meta["matrix_file"], meta["dim"], f"{time.time_ns()}", remote)
+            else:
+                parts = []
+                if kept_rows and self._matrix is not None:
+                    parts.append(np.asarray(self._matrix[kept_rows]))
+                if new_ids:
+                    parts.append(new_vectors)
+                matrix = np.concatenate(parts) if parts else np.empty((0, 0), dtype=np.float32)
+                # Строки матрицы должны идти в порядке remote_ids
+                order = [doc_id for doc_id in remote_ids if doc_id in local_rows] + new_ids
+                if order != remote_ids:
+                    position = {doc_id: i for i, doc_id in enumerate(order)}
+                    matrix = matrix[[position[doc_id] for doc_id in remote_ids]]
+                self._write_version(matrix, remote)
+                logger.info(f"Локальный индекс '{self.name}': {len(remote_ids)} векторов (+{len(new_ids)} новых).")
+
+            self._stale = False
+            self._load()
+
+    def _write_version(self, matrix: np.ndarray, remote: dict):
+        version = f"{time.time_ns()}"
+        matrix_file = f"{self.name}.{version}.f32"
+        tmp_path = self.dir / f"{matrix_file}.tmp"
+        np.ascontiguousarray(matrix, dtype=np.float32).tofile(tmp_path)
+        os.replace(tmp_path, self.dir / matrix_file)
+        previous = self._read_meta()
+        dim = int(matrix.shape[1]) if matrix.size else 0
+        self._write_meta(matrix_file, dim, version, remote)
+
+        # Старые файлы можно удалять: процессы, которые их еще отображают, сохранят доступ к данным
+        if previous and previous["matrix_file"] != matrix_file:
+            (self.dir / previous["matrix_file"]).unlink(missing_ok=True)
+
+    def _write_meta(self, matrix_file: str, dim: int, version: str, remote: dict):
+        meta = {
+            "version": version,
+            "matrix_file": matrix_file,
+            "count": len(remote["ids"]),
+            "dim": dim,
+            "ids": remote["ids"],
+            "metadatas": remote.get("metadatas") or [None] * len(remote["ids"]),
+            "documents": remote.get("documents") or [None] * len(remote["ids"]),
+            "source_version": remote.get("source_version", 0),
+            "refreshed_at": time.time()
+        }
+        tmp_path = self.meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(meta, ensure_ascii=False))
+        os.replace(tmp_path, self.meta_path)
+
+    # --- Поиск ---
+
+    def query(
+        self, query_embedding: list[float], n_results: int = 1, include: list[str] | None = None, where: dict | None = None
+    ) -> dict:
+        """
+        Косинусный top-k по реплике. Возвращает результат в формате collection.query
+        (distances — косинусное расстояние, как в коллекциях с hnsw:space=cosine).
+        where — фильтр по метаданным в формате Chroma: равенство полей, в том числе через "$and".
+        """
+        include = include or ["metadatas", "documents", "distances"]
+        with self._lock:
+            self.maybe_refresh()
+            # Снимок текущей версии: загрузка новой заменяет ссылки, а не меняет сами данные
+            matrix, ids, metadatas, documents = self._matrix, self._ids, self._metadatas, self._documents
+
+        rows, scores = [], np.empty(0, dtype=np.float32)
+        if matrix is not None and len(ids):
+            query = np.asarray(query_embedding, dtype=np.float32)
+            query /= np.linalg.norm(query) or 1
+            similarities = matrix @ query
+            candidates = np.arange(len(ids))
+            if where:
+                candidates = np.asarray([row for row in candidates if _matches(metadatas[row], where)], dtype=np.int64)
+                similarities = similarities[candidates]
+            if len(candidates):
+                k = min(n_results, len(similarities))
+                top = np.argpartition(-similarities, k - 1)[:k]
+                top = top[np.argsort(-similarities[top])]
+                rows, scores = candidates[top].tolist(), similarities[top]
+
+        result = {"ids": [[ids[row] for row in rows]]}
+        if "distances" in include:
+            result["distances"] = [[float(1 - score) for score in scores]]
+        if "metadatas" in include:
+            result["metadatas"] = [[metadatas[row] for row in rows]]
+        if "documents" in include:
+            result["documents"] = [[documents[row] for row in rows]]
+        return result
+
+
+def _matches(metadata: dict | None, where: dict) -> bool:
+    """Подмножество фильтров Chroma, которое использует память: равенство полей и "$and"."""
+    if "$and" in where:
+        return all(_matches(metadata, condition) for condition in where["$and"])
+    metadata = metadata or {}
+    return all(metadata.get(key) == value for key, value in where.items())
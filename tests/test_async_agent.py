@@ -0,0 +1,55 @@
+import asyncio
+import types
+import fakeredis
+import pytest
+from shared.task_store import AsyncTaskStore
+from universal_agent.async_agent import (
+    UniversalAgent, HumanInterventionRequired, operator_step, action_selector, AGENT_MAX_FAILED_ACTIONS
+)
+
+
+def test_operator_selector_is_passed_to_the_browser_as_is():
+    step = operator_step({"action": "click", "element_id": "#new_selector_provided_by_human"})
+
+    assert step == {"action": "click", "selector": "#new_selector_provided_by_human"}
+    assert action_selector(step) == "#new_selector_provided_by_human"
+    assert action_selector({"action": "click", "element_id": "7"}) == '[data-ornold-id="7"]'
+
+
+def test_repeated_failures_hand_the_task_to_an_operator():
+    store = AsyncTaskStore(fakeredis.aioredis.FakeRedis(decode_responses=True))
+    runtime = types.SimpleNamespace(task_store=store)
+    agent = UniversalAgent(runtime, "task-1", "goal")
+    agent.endpoint = "http://browser:9222"
+    action = {"action": "click", "element_id": "3"}
+
+    async def scenario():
+        await store.save({"id": "task-1", "goal": "goal", "status": "in_progress"}, new=True)
+        with pytest.raises(HumanInterventionRequired) as raised:
+            for step in range(1, AGENT_MAX_FAILED_ACTIONS + 1):
+                agent._check_failures(step, action, "Ошибка: Timeout", "https://shop.example/cart")
+        await agent.update_task_status("human_intervention_required", str(raised.value), failed_action_context=raised.value.context)
+        return await store.get("task-1")
+
+    task = asyncio.run(scenario())
+    assert task["status"] == "human_intervention_required"
+    assert task["failed_action_context"]["browser_endpoint_url"] == "http://browser:9222"
+    assert task["failed_action_context"]["failed_action"] == action
+
+
+def test_successful_action_resets_the_failure_count():
+    agent = UniversalAgent(types.SimpleNamespace(), "task-1", "goal")
+    for step in range(1, 2 * AGENT_MAX_FAILED_ACTIONS):
+        agent._check_failures(step, {"action": "click"}, "ok" if step % 2 else "Ошибка", "about:blank")
+
+
+def test_page_diff_keeps_unchanged_elements_in_view():
+    agent = UniversalAgent(types.SimpleNamespace(), "task-1", "goal")
+    elements = [{"id": str(i), "tag": "button", "text": f"Кнопка {i}"} for i in range(10)]
+    first = {"url": "https://shop.example", "title": "Магазин", "text": "Каталог", "elements": elements}
+    second = {**first, "text": "Каталог\nТовар добавлен в корзину"}
+
+    assert agent._page_state(first) == first
+    state = agent._page_state(second)
+    assert state["changes"] == {"text_added": ["Товар добавлен в корзину"]}
+    assert "3 button: Кнопка 3" in state["elements"]
@@ -0,0 +1,71 @@
+import json
+from shared.dom_distiller import distill_html, distill_perception, estimate_tokens
+
+
+PAGE = """
+<html><head><title>Магазин</title><style>.a { color: red }</style></head>
+<body>
+  <script>window.tracking = "очень длинный скрипт";</script>
+  <h1>Оформление заказа</h1>
+  <div style="display: none">Скрытое промо</div>
+  <input type="hidden" name="csrf" value="secret" data-ornold-id="9">
+  <label for="email">Электронная почта</label>
+  <input id="email" type="email" name="email" data-ornold-id="1">
+  <p>Доставка занимает от двух до пяти рабочих дней.</p>
+  <p>Доставка занимает от двух до пяти рабочих дней.</p>
+  <button data-ornold-id="2">Оплатить</button>
+  <!-- комментарий разработчика -->
+</body></html>
+""" + "<p>" + "Подробные условия возврата. " * 200 + "</p>"
+
+
+def test_distill_html_keeps_interactive_elements_and_drops_noise():
+    distilled, report = distill_html(PAGE, token_budget=300)
+    lines = distilled.splitlines()
+
+    assert lines[:5] == [
+        "h1: Оформление заказа",
+        "label: Электронная почта",
+        '[1] <input type="email" name="email"> (подпись: Электронная почта)',
+        "Доставка занимает от двух до пяти рабочих дней.",
+        "[2] <button> Оплатить",
+    ]
+    for noise in ("tracking", "Скрытое промо", "csrf", "комментарий", "color"):
+        assert noise not in distilled
+    assert estimate_tokens(distilled) <= 300
+    assert report["saved_tokens"] == report["original_tokens"] - report["tokens"] > 0
+
+
+def test_distill_html_reports_what_did_not_fit():
+    distilled, _ = distill_html(PAGE, token_budget=60)
+
+    # Интерактивные элементы идут в бюджет первыми, текст отбрасывается
+    assert "[1] <input" in distilled and "[2] <button> Оплатить" in distilled
+    assert "Доставка" not in distilled
+    assert distilled.splitlines()[-1].startswith("... (не поместилось в бюджет:")
+
+
+def test_small_page_is_returned_unchanged():
+    html = '<button data-ornold-id="1">OK</button>'
+
+    assert distill_html(html) == (html, {"original_tokens": estimate_tokens(html), "tokens": estimate_tokens(html), "saved_tokens": 0})
+
+
+def test_distill_perception_trims_text_before_elements():
+    perception = {
+        "url": "https://shop.example",
+        "text": "Длинный видимый текст. " * 100,
+        "elements": [{"id": i, "tag": "button", "text": f"Кнопка {i}"} for i in range(20)],
+    }
+    distilled, report = distill_perception(perception, token_budget=400)
+
+    assert len(distilled["text"]) < len(perception["text"])
+    assert distilled["elements"] == perception["elements"]
+    assert "elements_truncated" not in distilled
+    assert estimate_tokens(json.dumps(distilled, ensure_ascii=False)) <= 400 + 1
+    assert report["saved_tokens"] > 0
+
+    squeezed, _ = distill_perception(perception, token_budget=150)
+    assert squeezed["text"] == ""
+    assert 0 < squeezed["elements_truncated"] < 20
+    assert squeezed["elements"] == perception["elements"][:20 - squeezed["elements_truncated"]]
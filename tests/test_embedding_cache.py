@@ -0,0 +1,22 @@
+import asyncio
+import fakeredis
+from shared import embedding_cache
+from shared.embedding_cache import EmbeddingCache
+
+
+def test_disk_cache_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "EMBEDDING_CACHE_PATH", str(tmp_path / "cache.sqlite3"))
+    cache = EmbeddingCache(backend="disk")
+
+    async def scenario():
+        await cache.set_many("model", {"текст": [0.5, -0.25]})
+        return await cache.get_many("model", ["текст", "другой"])
+
+    assert asyncio.run(scenario()) == [[0.5, -0.25], None]
+
+
+def test_redis_cache_unavailable_is_a_miss(monkeypatch):
+    monkeypatch.setattr(embedding_cache.aioredis, "Redis", lambda **kwargs: fakeredis.aioredis.FakeRedis(connected=False))
+    cache = EmbeddingCache(backend="redis")
+
+    assert asyncio.run(cache.get_many("model", ["текст"])) == [None]
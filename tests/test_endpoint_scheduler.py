@@ -0,0 +1,47 @@
+import time
+import fakeredis
+import pytest
+from shared import endpoint_scheduler
+from shared.endpoint_scheduler import (
+    EndpointScheduler, NoEndpointAvailableError, LEASES_PREFIX, QUARANTINE_KEY,
+    ENDPOINT_LEASE_TTL, ENDPOINT_QUARANTINE_SECONDS
+)
+
+
+def _scheduler() -> EndpointScheduler:
+    return EndpointScheduler(fakeredis.FakeRedis(decode_responses=True))
+
+
+def test_unregistered_endpoint_is_not_limited():
+    scheduler = _scheduler()
+
+    assert [scheduler.acquire(f"task-{i}", ["ws://browser"]) for i in range(5)] == ["ws://browser"] * 5
+
+
+def test_renew_extends_only_a_live_lease():
+    scheduler = _scheduler()
+    scheduler.acquire("task-1", ["ws://browser"])
+    lease_key = f"{LEASES_PREFIX}ws://browser"
+    # Аренда почти истекла: продление отсчитывает новый срок от часов Redis
+    scheduler.redis.zadd(lease_key, {"task-1": time.time() + 1})
+    assert scheduler.renew("task-1", "ws://browser")
+    assert scheduler.redis.zscore(lease_key, "task-1") > time.time() + ENDPOINT_LEASE_TTL - 5
+
+    # Истекшую аренду мог занять другой — она не восстанавливается
+    scheduler.redis.zadd(lease_key, {"task-1": time.time() - 1})
+    assert not scheduler.renew("task-1", "ws://browser")
+
+
+def test_quarantine_after_consecutive_failures(monkeypatch):
+    monkeypatch.setattr(endpoint_scheduler, "ENDPOINT_FAILURE_THRESHOLD", 2)
+    scheduler = _scheduler()
+    scheduler.report_failure("ws://bad")
+    assert scheduler.acquire("task-1", ["ws://bad"]) == "ws://bad"
+    scheduler.release("task-1", "ws://bad")
+
+    scheduler.report_failure("ws://bad")
+    quarantined_until = scheduler.redis.zscore(QUARANTINE_KEY, "ws://bad")
+    assert quarantined_until > time.time() + ENDPOINT_QUARANTINE_SECONDS - 5
+    assert scheduler.acquire("task-2", ["ws://bad", "ws://good"]) == "ws://good"
+    with pytest.raises(NoEndpointAvailableError):
+        scheduler.acquire("task-3", ["ws://bad"])
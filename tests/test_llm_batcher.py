@@ -0,0 +1,66 @@
+import asyncio
+import time
+import fakeredis
+from shared.llm_batcher import LLMBatcher
+
+
+def make_batcher(server: fakeredis.FakeServer, dispatch, **kwargs) -> LLMBatcher:
+    batcher = LLMBatcher(dispatch, window_ms=20, timeout=5, **kwargs)
+    batcher._redis = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+    return batcher
+
+
+async def echo(payload):
+    if isinstance(payload, str):
+        return [{"choices": [{"text": payload}]}]
+    prompts = payload["input"]["openai_input"]["prompt"]
+    return [{"choices": [{"index": i, "text": prompt} for i, prompt in enumerate(prompts)]}]
+
+
+async def hang(payload):
+    await asyncio.sleep(100)
+
+
+def test_batch_replies_in_prompt_order():
+    async def scenario():
+        batcher = make_batcher(fakeredis.FakeServer(), echo)
+        return await asyncio.gather(*(batcher.submit(f"p{i}") for i in range(5)))
+
+    results = asyncio.run(scenario())
+    assert [result[0]["choices"][0]["text"] for result in results] == [f"p{i}" for i in range(5)]
+
+
+def test_requests_of_dead_leader_are_taken_over_after_lease():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        dead = make_batcher(server, hang, lease_seconds=0.5)
+        alive = make_batcher(server, echo, lease_seconds=0.5)
+        before = set(asyncio.all_tasks())
+        asyncio.create_task(dead.submit("dead"))
+        await asyncio.sleep(0.01)
+        started = time.monotonic()
+        follower = asyncio.create_task(alive.submit("follower"))
+        await asyncio.sleep(0.2)
+        # Процесс лидера умер: все его корутины, включая отправку пачки под shield, прерваны
+        for task in set(asyncio.all_tasks()) - before - {follower}:
+            task.cancel()
+        result = await follower
+        return result, time.monotonic() - started, await alive._get_redis().hlen(alive.inflight_key)
+
+    result, elapsed, inflight = asyncio.run(scenario())
+    assert result[0]["choices"][0]["text"] == "follower"
+    # Ответ пришел после аренды пачки, а не по таймауту вызывающего
+    assert elapsed < 2
+    assert inflight == 0
+
+
+def test_dispatch_failure_answers_every_request():
+    async def fail(payload):
+        raise RuntimeError("runpod down")
+
+    async def scenario():
+        batcher = make_batcher(fakeredis.FakeServer(), fail)
+        return await asyncio.gather(*(batcher.submit(f"p{i}") for i in range(3)), return_exceptions=True)
+
+    for result in asyncio.run(scenario()):
+        assert "error" in result
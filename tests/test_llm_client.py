@@ -0,0 +1,154 @@
+import asyncio
+import fakeredis
+import httpx
+import pytest
+from shared import llm_client
+from shared.llm_cache import LLMResponseCache
+from shared.llm_client import GemmaClient
+from universal_agent.perception import element_index
+
+
+@pytest.fixture
+def runpod_client(monkeypatch) -> GemmaClient:
+    monkeypatch.setenv("RUNPOD_ENDPOINT_ID_GEMMA", "test-llm")
+    monkeypatch.setenv("RUNPOD_API_KEY", "test")
+    return GemmaClient()
+
+
+@pytest.fixture
+def client(runpod_client):
+    client = runpod_client
+    calls = []
+
+    async def run_on_runpod(payload):
+        calls.append(payload)
+        return [{"choices": [{"text": "ok"}]}]
+
+    client._arun_and_poll_task = run_on_runpod
+    client.calls = calls
+    return client
+
+
+def with_cache(client: GemmaClient, redis_client) -> LLMResponseCache:
+    cache = LLMResponseCache(model_key="test", methods={"execute_prompt"})
+    cache._redis = redis_client
+    client._cache = cache
+    return cache
+
+
+def test_response_cache_serves_repeated_prompt(client):
+    with_cache(client, fakeredis.aioredis.FakeRedis(decode_responses=True))
+
+    async def scenario():
+        first = await client._aexecute("промпт", cache_method="execute_prompt")
+        second = await client._aexecute("промпт", cache_method="execute_prompt")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+    assert len(client.calls) == 1
+
+
+def test_redis_failure_falls_back_to_uncached_call(client):
+    with_cache(client, fakeredis.aioredis.FakeRedis(decode_responses=True, connected=False))
+
+    result = asyncio.run(client._aexecute("промпт", cache_method="execute_prompt"))
+    assert result == [{"choices": [{"text": "ok"}]}]
+    assert len(client.calls) == 1
+
+
+def test_universal_prompt_sends_bare_page_diff(client):
+    snapshot = {"url": "https://example.com", "title": "Каталог", "text": "Длинный текст страницы", "elements": [
+        {"id": "1", "tag": "a", "text": "Товар A"}
+    ]}
+    diff = {"text_added": ["Товар добавлен в корзину"]}
+
+    full_prompt, _ = client._build_universal_prompt("цель", [], snapshot)
+    diff_prompt, report = client._build_universal_prompt(
+        "цель", [], {"changes": diff, "elements": element_index(snapshot)}
+    )
+
+    assert "Длинный текст страницы" in full_prompt
+    assert "Длинный текст страницы" not in diff_prompt
+    assert "Товар добавлен в корзину" in diff_prompt
+    # Неизмененный элемент остается доступным для действия
+    assert "1 a: Товар A" in diff_prompt
+    assert report["tokens"] < 30
+
+
+def runpod(client: GemmaClient, handler) -> list:
+    requests = []
+
+    def record(request: httpx.Request) -> httpx.Response:
+        requests.append((request.method, request.url.path))
+        return handler(request)
+
+    client._http = httpx.AsyncClient(transport=httpx.MockTransport(record), base_url="http://runpod")
+    return requests
+
+
+def test_runsync_returns_a_fast_job_in_one_request(runpod_client):
+    client = runpod_client
+    output = [{"choices": [{"text": "ok"}]}]
+    requests = runpod(client, lambda request: httpx.Response(
+        200, json={"id": "job-1", "status": "COMPLETED", "output": output, "executionTime": 800}
+    ))
+
+    assert asyncio.run(client._arun_and_poll_job("промпт")) == output
+    assert requests == [("POST", "/runsync")]
+    assert client._expected_runtime == 0.8
+
+
+def test_unfinished_runsync_falls_back_to_polling_with_backoff(runpod_client, monkeypatch):
+    client = runpod_client
+    output = [{"choices": [{"text": "ok"}]}]
+    statuses = ["IN_QUEUE", "IN_PROGRESS", "COMPLETED"]
+    delays = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/runsync":
+            return httpx.Response(200, json={"id": "job-1", "status": "IN_PROGRESS"})
+        return httpx.Response(200, json={"id": "job-1", "status": statuses.pop(0), "output": output})
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    requests = runpod(client, handler)
+    monkeypatch.setattr(llm_client.asyncio, "sleep", fake_sleep)
+
+    assert asyncio.run(client._arun_and_poll_job("промпт")) == output
+    assert requests == [("POST", "/runsync")] + [("GET", "/status/job-1")] * 3
+    assert delays == [
+        llm_client.POLL_INITIAL_DELAY,
+        llm_client.POLL_INITIAL_DELAY * llm_client.POLL_BACKOFF_FACTOR,
+        llm_client.POLL_INITIAL_DELAY * llm_client.POLL_BACKOFF_FACTOR ** 2
+    ]
+
+
+def test_cancelled_caller_cancels_the_runpod_job(runpod_client, monkeypatch):
+    monkeypatch.setattr(llm_client, "POLL_INITIAL_DELAY", 0.01)
+    client = runpod_client
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/run":
+            return httpx.Response(200, json={"id": "job-1", "status": "IN_QUEUE"})
+        if request.url.path == "/cancel/job-1":
+            return httpx.Response(200, json={"id": "job-1", "status": "CANCELLED"})
+        return httpx.Response(200, json={"id": "job-1", "status": "IN_PROGRESS"})
+
+    requests = runpod(client, handler)
+
+    async def scenario():
+        job = asyncio.create_task(client._arun_and_poll_job("промпт", use_runsync=False))
+        while ("GET", "/status/job-1") not in requests:
+            await asyncio.sleep(0.01)
+        job.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await job
+        # Отмена задания RunPod уходит фоновой задачей
+        while ("POST", "/cancel/job-1") not in requests:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert requests[0] == ("POST", "/run")
+    assert requests[-1] == ("POST", "/cancel/job-1")
@@ -0,0 +1,93 @@
+import json
+import asyncio
+import fakeredis
+import httpx
+from shared import llm_stream
+from shared.llm_stream import JSONObjectStream, LLMStreamer
+
+
+def feed_all(chunks: list[str]) -> dict | None:
+    parser = JSONObjectStream()
+    for chunk in chunks:
+        parsed = parser.feed(chunk)
+        if parsed is not None:
+            return parsed
+    return None
+
+
+def test_json_stream_ignores_braces_and_quotes_inside_strings():
+    text = '{"action": "type", "text": "скобки } { и \\"кавычки\\" \\\\", "reasoning": "ok"}'
+
+    assert feed_all([text]) == json.loads(text)
+
+
+def test_json_stream_waits_for_nested_objects_to_close():
+    parser = JSONObjectStream()
+
+    assert parser.feed('{"action": "click", "meta": {"a": {"b": 1}') is None
+    assert parser.feed('}, "element_id": "5"}') == {"action": "click", "meta": {"a": {"b": 1}}, "element_id": "5"}
+
+
+def test_json_stream_handles_chunks_split_inside_escapes():
+    text = '```json\n{"action": "finish", "result": "путь C:\\\\temp \\u00e9"}\nпояснение'
+    chunks = [text[i:i + 3] for i in range(0, len(text), 3)]
+
+    assert feed_all(chunks) == {"action": "finish", "result": "путь C:\\temp é"}
+
+
+def test_json_stream_skips_text_in_braces_before_the_object():
+    assert feed_all(["Ответ {см. ниже}: ", '{"action": "think"}']) == {"action": "think"}
+
+
+def test_streamer_cancels_the_job_after_the_first_action():
+    requests = []
+    chunks = ['{"action": ', '"finish"}', " пояснение модели", " еще текст"]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append((request.method, request.url.path))
+        if request.url.path == "/run":
+            return httpx.Response(200, json={"id": "job-1", "status": "IN_QUEUE"})
+        if request.url.path == "/stream/job-1":
+            stream = [{"output": {"choices": [{"text": chunk, "finish_reason": None}]}} for chunk in chunks]
+            return httpx.Response(200, json={"status": "IN_PROGRESS", "stream": stream})
+        return httpx.Response(200, json={"id": "job-1", "status": "CANCELLED"})
+
+    async def scenario():
+        http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://runpod")
+        streamer = LLMStreamer(lambda: http, "model")
+        streamer._redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        return await streamer.complete("промпт", "test")
+
+    result = asyncio.run(scenario())
+    assert result == [{"choices": [{"text": '{"action": "finish"}'}]}]
+    assert requests == [("POST", "/run"), ("GET", "/stream/job-1"), ("POST", "/cancel/job-1")]
+
+
+def test_streamer_backs_off_while_the_job_waits_in_queue(monkeypatch):
+    responses = [[], [], [], ['{"action": '], ['"finish"}']]
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        await real_sleep(0)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/run":
+            return httpx.Response(200, json={"id": "job-1", "status": "IN_QUEUE"})
+        if request.url.path == "/stream/job-1":
+            chunks = responses.pop(0)
+            stream = [{"output": {"choices": [{"text": chunk, "finish_reason": None}]}} for chunk in chunks]
+            return httpx.Response(200, json={"status": "IN_PROGRESS" if chunks else "IN_QUEUE", "stream": stream})
+        return httpx.Response(200, json={"id": "job-1", "status": "CANCELLED"})
+
+    async def scenario():
+        http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://runpod")
+        streamer = LLMStreamer(lambda: http, "model", poll_interval=0.25, max_poll_interval=1)
+        streamer._redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        monkeypatch.setattr(llm_stream.asyncio, "sleep", fake_sleep)
+        return await streamer.complete("промпт", "test")
+
+    assert asyncio.run(scenario()) == [{"choices": [{"text": '{"action": "finish"}'}]}]
+    # Пока кусков нет, пауза удваивается до предела; с первым куском возвращается к начальной
+    assert delays == [0.25, 0.5, 1, 1, 0.25]
@@ -0,0 +1,69 @@
+import asyncio
+import chromadb
+import fakeredis
+import pytest
+from shared import vector_index
+from shared.memory import RAGMemory
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    monkeypatch.setenv("RUNPOD_ENDPOINT_ID_EMBEDDING", "embedding-test")
+    monkeypatch.setenv("RUNPOD_API_KEY", "test-key")
+    monkeypatch.setattr(vector_index, "_redis_client", fakeredis.FakeRedis(decode_responses=True))
+    client = chromadb.EphemeralClient()
+    rag = RAGMemory(client=client)
+
+    # Эмбеддинг без API: запоминаем, какие тексты реально пришлось эмбеддить
+    rag.embedded = []
+
+    async def get_embeddings(texts):
+        rag.embedded.extend(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    rag._get_embeddings = get_embeddings
+    yield rag
+    for name in ("successful_scenarios", "failure_knowledge_base"):
+        client.delete_collection(name)
+
+
+def scenario(goal):
+    return {"goal": goal, "actions": [{"action": "click", "element_id": 1}]}
+
+
+def test_rerun_import_skips_already_stored_documents(memory):
+    first = asyncio.run(memory.add_scenarios([scenario("a"), scenario("b")], chunk_size=1))
+    memory.embedded.clear()
+    # Прерванный импорт запускают заново с тем же и новым содержимым
+    second = asyncio.run(memory.add_scenarios([scenario("a"), scenario("b"), scenario("c")], chunk_size=2))
+
+    assert first == {"total": 2, "added": 2, "skipped": 0, "failed": 0}
+    assert second == {"total": 3, "added": 1, "skipped": 2, "failed": 0}
+    assert memory.embedded == [RAGMemory._scenario_document("c", scenario("c")["actions"])]
+    assert memory.scenarios_collection.count() == 3
+
+
+def test_duplicates_collapse_and_upsert_overwrites(memory):
+    failure = {
+        "goal": "войти", "url": "https://example.com", "failed_action": {"action": "click"},
+        "exception_message": "timeout", "recovery_strategy": "старая"
+    }
+    stats = asyncio.run(memory.add_failure_logs([failure, {**failure, "recovery_strategy": "новая"}]))
+    # Без skip_existing тот же контекст перезаписывает стратегию, а не добавляет запись
+    asyncio.run(memory.add_failure_logs([{**failure, "recovery_strategy": "последняя"}], skip_existing=False))
+
+    assert stats == {"total": 1, "added": 1, "skipped": 0, "failed": 0}
+    stored = memory.failures_collection.get(include=["metadatas"])
+    assert stored["metadatas"] == [{"recovery_strategy": "последняя"}]
+    assert len(memory.embedded) == 2
+
+
+def test_documents_without_embedding_are_counted_as_failed(memory):
+    async def no_embeddings(texts):
+        return [[] for _ in texts]
+
+    memory._get_embeddings = no_embeddings
+    stats = asyncio.run(memory.add_scenarios([scenario("a")]))
+
+    assert stats == {"total": 1, "added": 0, "skipped": 0, "failed": 1}
+    assert memory.scenarios_collection.count() == 0
@@ -0,0 +1,123 @@
+import asyncio
+import fakeredis
+from datetime import datetime, timezone
+from orchestrator.orchestrator import Orchestrator
+from orchestrator.schemas import Task
+from shared.task_store import AsyncTaskStore, TaskStore, CELERY_ID_KEY
+
+
+class _Result:
+    def __init__(self, task_id: str):
+        self.id = task_id
+
+
+def test_start_task_saves_before_worker_can_pick_it_up():
+    server = fakeredis.FakeServer()
+    orchestrator = Orchestrator()
+    orchestrator.task_store = AsyncTaskStore(fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+    worker_store = TaskStore(fakeredis.FakeRedis(server=server, decode_responses=True))
+    claimed, sent_ids = [], []
+
+    class CeleryApp:
+        @staticmethod
+        def send_task(name, kwargs, queue, task_id):
+            # Воркер забирает задачу сразу: CAS queued -> in_progress должен найти сохраненную запись
+            claimed.append(worker_store.update(kwargs["task_id"], expected_status="queued", status="in_progress"))
+            sent_ids.append(task_id)
+            return _Result(task_id)
+
+    orchestrator.celery_app = CeleryApp()
+    task = Task(id="task-1", goal="goal", created_at=datetime.now(timezone.utc))
+    asyncio.run(orchestrator.start_task(task))
+
+    assert claimed == [True]
+    assert worker_store.get("task-1")["status"] == "in_progress"
+    assert worker_store.redis.get(CELERY_ID_KEY.format(task_id="task-1")) == sent_ids[0]
+
+
+def test_start_task_marks_unsent_task_as_error():
+    orchestrator = Orchestrator()
+    orchestrator.task_store = AsyncTaskStore(fakeredis.aioredis.FakeRedis(decode_responses=True))
+
+    class CeleryApp:
+        @staticmethod
+        def send_task(name, kwargs, queue, task_id):
+            raise ConnectionError("broker is down")
+
+    orchestrator.celery_app = CeleryApp()
+    task = Task(id="task-1", goal="goal", created_at=datetime.now(timezone.utc))
+
+    async def scenario():
+        try:
+            await orchestrator.start_task(task)
+        except ConnectionError:
+            pass
+        return await orchestrator.task_store.get("task-1")
+
+    assert asyncio.run(scenario())["status"] == "error"
+
+
+def test_start_task_routes_to_its_agent_queue():
+    orchestrator = Orchestrator()
+    orchestrator.task_store = AsyncTaskStore(fakeredis.aioredis.FakeRedis(decode_responses=True))
+    sent = []
+
+    class CeleryApp:
+        @staticmethod
+        def send_task(name, kwargs, queue, task_id):
+            sent.append((kwargs["agent"], queue))
+            return _Result(task_id)
+
+    orchestrator.celery_app = CeleryApp()
+    for agent in ("magnitude", "universal"):
+        task = Task(id=f"task-{agent}", goal="goal", agent=agent, created_at=datetime.now(timezone.utc))
+        asyncio.run(orchestrator.start_task(task))
+
+    assert sent == [("magnitude", "agents.normal"), ("universal", "agents.universal.normal")]
+
+
+def test_unacknowledged_stop_is_escalated_by_any_api_instance(monkeypatch):
+    import orchestrator.orchestrator as orchestrator_module
+    from shared.task_cancel import acknowledge_cancel, ESCALATION_KEY
+
+    server = fakeredis.FakeServer()
+    revoked = []
+
+    class CeleryApp:
+        @staticmethod
+        def send_task(name, kwargs, queue, task_id):
+            return _Result(task_id)
+
+        class control:
+            @staticmethod
+            def revoke(celery_ids, terminate, signal):
+                revoked.append((sorted(celery_ids), signal))
+
+    def api_instance() -> Orchestrator:
+        instance = Orchestrator()
+        instance.redis_client = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+        instance.task_store = AsyncTaskStore(instance.redis_client)
+        instance.celery_app = CeleryApp()
+        return instance
+
+    monkeypatch.setattr(orchestrator_module, "TASK_STOP_ESCALATION_SECONDS", 0)
+    worker_redis = fakeredis.FakeRedis(server=server, decode_responses=True)
+
+    async def stop_tasks():
+        first = api_instance()
+        for task_id in ("task-1", "task-2"):
+            await first.start_task(Task(id=task_id, goal="goal", created_at=datetime.now(timezone.utc)))
+            await first.stop_task(task_id)
+
+    async def sweep():
+        # Эскалацию выполняет другой экземпляр API: остановивший задачи мог уже перезапуститься
+        return await api_instance().escalate_due_stops()
+
+    asyncio.run(stop_tasks())
+    acknowledge_cancel(worker_redis, "task-1")
+    escalated = asyncio.run(sweep())
+
+    assert escalated == ["task-2"]
+    assert revoked == [([worker_redis.get(CELERY_ID_KEY.format(task_id="task-2"))], "SIGKILL")]
+    assert worker_redis.zcard(ESCALATION_KEY) == 0
+    assert asyncio.run(sweep()) == []
@@ -0,0 +1,112 @@
+import asyncio
+import functools
+import fakeredis
+import httpx
+import pytest
+from datetime import datetime, timezone, timedelta
+from orchestrator import main
+from shared import task_events
+from shared.task_store import AsyncTaskStore
+
+
+@pytest.fixture
+def api(monkeypatch):
+    redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    store = AsyncTaskStore(redis_client)
+    monkeypatch.setattr(main, "task_store", store)
+    monkeypatch.setattr(main, "async_redis_client", redis_client)
+    monkeypatch.setattr(main, "read_events", functools.partial(task_events.read_events, block_ms=10))
+    return store
+
+
+async def _request(method: str, url: str, **kwargs) -> httpx.Response:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.request(method, url, **kwargs)
+
+
+def _seed(store: AsyncTaskStore, count: int):
+    async def scenario():
+        started = datetime.now(timezone.utc)
+        for i in range(count):
+            created_at = started + timedelta(seconds=i)
+            task = {"id": f"task-{i}", "goal": f"goal {i}", "status": "queued", "created_at": created_at.isoformat()}
+            await store.save(task, created_at=created_at.timestamp(), new=True)
+    asyncio.run(scenario())
+
+
+def test_get_tasks_returns_a_list_by_default(api):
+    _seed(api, 3)
+    response = asyncio.run(_request("GET", "/tasks"))
+
+    assert response.status_code == 200
+    assert [task["id"] for task in response.json()] == ["task-2", "task-1", "task-0"]
+
+
+def test_get_tasks_returns_a_bounded_list_by_default(api, monkeypatch):
+    monkeypatch.setattr(main, "TASK_LIST_DEFAULT_LIMIT", 2)
+    _seed(api, 3)
+    first = asyncio.run(_request("GET", "/tasks"))
+    rest = asyncio.run(_request("GET", "/tasks", params={"cursor": first.headers["X-Next-Cursor"]}))
+    everything = asyncio.run(_request("GET", "/tasks", params={"all": "true"}))
+
+    assert [task["id"] for task in first.json()] == ["task-2", "task-1"]
+    assert [task["id"] for task in rest.json()] == ["task-0"]
+    assert "X-Next-Cursor" not in rest.headers
+    assert [task["id"] for task in everything.json()] == ["task-2", "task-1", "task-0"]
+
+
+def test_get_tasks_paginates_on_request(api):
+    _seed(api, 3)
+    first = asyncio.run(_request("GET", "/tasks", params={"paginate": "true", "limit": 2})).json()
+    second = asyncio.run(_request(
+        "GET", "/tasks", params={"paginate": "true", "limit": 2, "cursor": first["next_cursor"]}
+    )).json()
+
+    assert [task["id"] for task in first["items"]] == ["task-2", "task-1"]
+    assert [task["id"] for task in second["items"]] == ["task-0"]
+    assert second["next_cursor"] is None
+
+
+def test_task_events_close_when_stream_expired(api):
+    _seed(api, 1)
+
+    async def scenario():
+        await api.update("task-0", status="completed")
+        await api.redis.delete(task_events.task_stream_key("task-0"))
+        return await asyncio.wait_for(_request("GET", "/tasks/task-0/events", params={"last_event_id": "0"}), 5)
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert response.text == ""
+
+
+def test_events_start_after_last_event_at_connect(api):
+    _seed(api, 2)
+
+    async def scenario():
+        last_id = await task_events.stream_last_id(api.redis, task_events.ALL_EVENTS_STREAM)
+        await task_events.apublish_event(api.redis, "task-1", "step", {"n": 1})
+        return await task_events.read_events(api.redis, task_events.ALL_EVENTS_STREAM, last_id, block_ms=10)
+
+    entries = asyncio.run(scenario())
+    assert [(fields["type"], fields["task_id"]) for _, fields in entries] == [("step", "task-1")]
+
+
+def test_retry_marks_task_as_error_when_broker_is_down(api, monkeypatch):
+    class CeleryApp:
+        @staticmethod
+        def send_task(name, kwargs, queue, task_id):
+            raise ConnectionError("broker is down")
+
+    monkeypatch.setattr(main.orchestrator_instance, "task_store", api)
+    monkeypatch.setattr(main.orchestrator_instance, "celery_app", CeleryApp())
+    _seed(api, 1)
+    asyncio.run(api.update("task-0", status="error", status_reason="timeout"))
+
+    response = asyncio.run(_request("POST", "/tasks/task-0/retry"))
+
+    assert response.status_code == 503
+    task = asyncio.run(api.get("task-0"))
+    assert task["status"] == "error"
+    assert "broker is down" in task["status_reason"]
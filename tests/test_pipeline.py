@@ -0,0 +1,43 @@
+import asyncio
+from universal_agent.pipeline import PipelinedStepExecutor, likely_targets
+
+
+def test_likely_targets_skips_other_origins_and_mutating_links():
+    perception = {"url": "https://shop.example/catalog", "elements": [
+        {"text": "Корзина", "href": "/cart"},
+        {"text": "Корзина партнера", "href": "https://partner.example/cart"},
+        {"text": "Корзина по http", "href": "http://shop.example/cart/http"},
+        {"text": "Очистить корзину", "href": "/cart/delete?all=1"},
+        {"text": "Выйти из корзины", "href": "/logout?next=/cart"},
+        {"text": "Отписаться от корзины", "href": "/cart/Unsubscribe"},
+    ]}
+
+    assert likely_targets("Открыть корзину", perception, limit=10) == ["https://shop.example/cart"]
+
+
+def test_abort_runs_the_deferred_step_bookkeeping():
+    recorded = []
+
+    async def record_step():
+        await asyncio.sleep(0)
+        recorded.append("step")
+
+    async def scenario():
+        pipeline = PipelinedStepExecutor(page=None, goal="цель", enabled=True)
+        await pipeline.defer(record_step())
+        await pipeline.abort()
+
+    asyncio.run(scenario())
+    assert recorded == ["step"]
+
+
+def test_abort_does_not_raise_when_bookkeeping_fails():
+    async def record_step():
+        raise ConnectionError("redis недоступен")
+
+    async def scenario():
+        pipeline = PipelinedStepExecutor(page=None, goal="цель", enabled=True)
+        await pipeline.defer(record_step())
+        await pipeline.abort()
+
+    asyncio.run(scenario())
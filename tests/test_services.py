@@ -0,0 +1,116 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from shared import services
+from shared.services import LazyService, LoopBound
+
+
+class FakeClient:
+    def __init__(self):
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+
+def test_loop_bound_client_per_loop_closed_with_loop():
+    bound = LoopBound(FakeClient)
+
+    async def use():
+        client = bound.get()
+        assert bound.get() is client
+        return client
+
+    first = asyncio.run(use())
+    second = asyncio.run(use())
+    assert first is not second
+    assert first.closed and second.closed
+    assert not bound._instances
+
+
+def test_loop_bound_explicit_close():
+    bound = LoopBound(FakeClient)
+
+    async def use():
+        client = bound.get()
+        await bound.aclose()
+        return client, bound.get()
+
+    closed, fresh = asyncio.run(use())
+    assert closed.closed
+    assert fresh is not closed
+
+
+class Client:
+    def __init__(self):
+        self.warmed = False
+
+    def warm_up(self):
+        self.warmed = True
+
+    def ping(self):
+        return "pong"
+
+
+def test_lazy_service_created_once_on_first_use():
+    created = []
+    gate = threading.Barrier(8)
+
+    def factory():
+        created.append(Client())
+        return created[-1]
+
+    service = LazyService("client", factory)
+    assert not service.initialized and not created
+
+    def use(_):
+        gate.wait()
+        return service.get()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        instances = list(pool.map(use, range(8)))
+
+    assert len(created) == 1
+    assert all(instance is created[0] for instance in instances)
+    # Атрибуты проксируются в экземпляр
+    assert service.initialized and service.ping() == "pong"
+
+
+def test_lazy_service_retries_after_failed_creation():
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("ChromaDB недоступна")
+        return Client()
+
+    service = LazyService("flaky", factory)
+    with pytest.raises(ConnectionError):
+        service.get()
+    assert not service.initialized
+
+    assert service.ping() == "pong"
+    assert len(attempts) == 2
+
+
+def test_background_warm_up_creates_registered_services(monkeypatch):
+    monkeypatch.setattr(services, "_registry", {})
+    monkeypatch.setattr(services, "SERVICES_WARMUP_ENABLED", True)
+    ready = services.register("ready", Client)
+    services.register("broken", lambda: 1 / 0)
+
+    services.warm_up().join(timeout=5)
+
+    assert ready.warmed
+    assert services.services_state() == {"ready": True, "broken": False}
+
+
+def test_warm_up_disabled(monkeypatch):
+    monkeypatch.setattr(services, "_registry", {})
+    monkeypatch.setattr(services, "SERVICES_WARMUP_ENABLED", False)
+    services.register("client", Client)
+
+    assert services.warm_up() is None
+    assert services.services_state() == {"client": False}
@@ -0,0 +1,26 @@
+import threading
+import fakeredis
+from shared.task_cancel import cancel_key, watch_cancel
+
+
+def test_watch_cancel_interrupts_a_blocking_call():
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    session_closed = threading.Event()
+
+    with watch_cancel(redis_client, "task-1", session_closed.set, interval=0.01) as cancelled:
+        redis_client.set(cancel_key("task-1"), "Остановлена пользователем")
+        # Блокирующий вызов агента завершается, когда наблюдатель закрывает сессию
+        assert session_closed.wait(timeout=5)
+
+    assert cancelled.is_set()
+
+
+def test_watch_cancel_leaves_other_tasks_running():
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    redis_client.set(cancel_key("task-2"), "Остановлена пользователем")
+    session_closed = threading.Event()
+
+    with watch_cancel(redis_client, "task-1", session_closed.set, interval=0.01) as cancelled:
+        assert not session_closed.wait(timeout=0.1)
+
+    assert not cancelled.is_set()
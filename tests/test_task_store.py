@@ -0,0 +1,98 @@
+import json
+import asyncio
+import redis
+import pytest
+import fakeredis
+from shared.task_store import TaskStore, AsyncTaskStore, CREATED_INDEX, STATUS_INDEX, CAMPAIGN_INDEX
+from shared.task_checkpoints import CheckpointStore, make_checkpoint
+from shared.task_cancel import cancel_key
+
+
+def test_rebuild_indexes_skips_checkpoints():
+    server = fakeredis.FakeServer()
+    store = TaskStore(fakeredis.FakeRedis(server=server, decode_responses=True))
+    store.save({"id": "task-1", "goal": "goal", "status": "in_progress", "created_at": "2026-01-01T00:00:00+00:00"})
+    # Запись старого формата — JSON-строка
+    store.redis.set("task:task-2", json.dumps({"id": "task-2", "goal": "goal", "status": "completed"}))
+    checkpoints = CheckpointStore(fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+    asyncio.run(checkpoints.append("task-1", make_checkpoint(1, {"action": "click"}, "ok", "http://site", "hash")))
+
+    assert store.rebuild_indexes() == 2
+    assert store.redis.zrange(CREATED_INDEX, 0, -1) == ["task-2", "task-1"]
+    assert store.redis.type("task:task-2") == "hash"
+    assert store.redis.zrange(STATUS_INDEX.format(status="completed"), 0, -1) == ["task-2"]
+
+
+def test_rebuild_indexes_skips_pending_cancel_flag():
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    store = TaskStore(redis_client)
+    store.save({"id": "task-1", "goal": "goal", "status": "in_progress"})
+    redis_client.set(cancel_key("task-1"), "Остановлена пользователем")
+
+    assert store.rebuild_indexes() == 1
+    assert redis_client.zrange(STATUS_INDEX.format(status="in_progress"), 0, -1) == ["task-1"]
+    assert redis_client.get(cancel_key("task-1")) == "Остановлена пользователем"
+
+
+def test_update_applies_only_when_status_matches():
+    store = TaskStore(fakeredis.FakeRedis(decode_responses=True))
+    store.save({"id": "task-1", "goal": "goal", "status": "queued"}, created_at=1.0)
+
+    assert store.update("task-1", expected_status="queued", status="in_progress", incr={"steps_completed": 2})
+    assert not store.update("task-1", expected_status="queued", status="error")
+    assert store.update("task-missing", expected_status="queued", status="error") is None
+
+    task = store.get("task-1")
+    assert (task["status"], task["steps_completed"]) == ("in_progress", 2)
+    assert store.redis.zrange(STATUS_INDEX.format(status="queued"), 0, -1) == []
+    assert store.redis.zrange(STATUS_INDEX.format(status="in_progress"), 0, -1) == ["task-1"]
+
+
+def test_update_migrates_legacy_record_before_applying():
+    store = TaskStore(fakeredis.FakeRedis(decode_responses=True))
+    store.redis.set("task:task-1", json.dumps({"id": "task-1", "goal": "goal", "status": "queued"}))
+
+    assert store.update("task-1", expected_status="queued", status="completed", result={"answer": 42})
+    assert store.redis.type("task:task-1") == "hash"
+    assert store.get("task-1")["result"] == {"answer": 42}
+    assert store.redis.zrange(STATUS_INDEX.format(status="completed"), 0, -1) == ["task-1"]
+
+
+def test_update_rejects_unknown_status_without_writing():
+    store = TaskStore(fakeredis.FakeRedis(decode_responses=True))
+    store.save({"id": "task-1", "goal": "goal", "status": "queued"})
+
+    with pytest.raises(redis.ResponseError):
+        store.update("task-1", status="paused", status_reason="неизвестный статус")
+    assert store.get("task-1") == {"id": "task-1", "goal": "goal", "status": "queued"}
+
+
+def test_async_store_keeps_secondary_indexes_in_sync():
+    server = fakeredis.FakeServer()
+    store = AsyncTaskStore(fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+    redis_client = fakeredis.FakeRedis(server=server, decode_responses=True)
+
+    async def scenario():
+        await store.save_many([
+            ({"id": f"task-{i}", "goal": "goal", "status": "queued", "campaign_id": "camp"}, None)
+            for i in range(3)
+        ], created_at=1.0, chunk_size=2)
+        outcomes = await store.update_many(["task-0", "task-1", "task-missing"], expected_status="queued", status="in_progress")
+        # Полная перезапись существующей задачи убирает ее из прежнего статусного индекса
+        await store.save({"id": "task-2", "goal": "goal", "status": "completed", "campaign_id": "camp"}, created_at=1.0)
+        in_progress, _ = await store.list_page(status="in_progress")
+        campaign, _ = await store.list_page(campaign_id="camp")
+        return outcomes, in_progress, campaign
+
+    outcomes, in_progress, campaign = asyncio.run(scenario())
+
+    assert outcomes == [True, True, None]
+    assert redis_client.zrange(STATUS_INDEX.format(status="queued"), 0, -1) == []
+    assert redis_client.zrange(STATUS_INDEX.format(status="in_progress"), 0, -1) == ["task-0", "task-1"]
+    assert redis_client.zrange(STATUS_INDEX.format(status="completed"), 0, -1) == ["task-2"]
+    assert redis_client.zcard(CREATED_INDEX) == 3
+    assert redis_client.zcard(CAMPAIGN_INDEX.format(campaign_id="camp")) == 3
+    assert sorted(task["id"] for task in in_progress) == ["task-0", "task-1"]
+    assert {task["id"]: task["status"] for task in campaign} == {
+        "task-0": "in_progress", "task-1": "in_progress", "task-2": "completed"
+    }
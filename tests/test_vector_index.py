@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+import chromadb
+import fakeredis
+import pytest
+from shared import vector_index
+from shared.vector_index import LocalVectorIndex, publish_changes
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    monkeypatch.setattr(vector_index, "_redis_client", fakeredis.FakeRedis(decode_responses=True))
+    client = chromadb.EphemeralClient()
+    collection = client.get_or_create_collection("scenarios_test")
+    yield collection
+    client.delete_collection("scenarios_test")
+
+
+def test_write_from_another_process_is_seen_without_waiting_for_interval(collection, tmp_path):
+    collection.add(ids=["a"], embeddings=[[1.0, 0.0]], metadatas=[{"goal": "a"}], documents=["a"])
+    index = LocalVectorIndex(collection, directory=str(tmp_path), refresh_interval=3600)
+    index.maybe_refresh()
+
+    # Другой воркер добавляет документ и меняет метаданные существующего
+    collection.add(ids=["b"], embeddings=[[0.0, 1.0]], metadatas=[{"goal": "b"}], documents=["b"])
+    collection.update(ids=["a"], metadatas=[{"goal": "a2"}])
+    publish_changes(collection.name, ["b", "a"])
+    index._version_checked_at = 0.0
+    index.maybe_refresh()
+
+    assert index._ids == ["a", "b"]
+    assert index._metadatas == [{"goal": "a2"}, {"goal": "b"}]
+
+
+def test_refresh_fetches_only_new_and_changed_rows(collection, tmp_path, monkeypatch):
+    collection.add(ids=["a", "b"], embeddings=[[1.0, 0.0], [0.0, 1.0]], metadatas=[{"n": 1}, {"n": 2}], documents=["a", "b"])
+    index = LocalVectorIndex(collection, directory=str(tmp_path), refresh_interval=3600)
+    index.maybe_refresh()
+
+    collection.add(ids=["c"], embeddings=[[1.0, 1.0]], metadatas=[{"n": 3}], documents=["c"])
+    publish_changes(collection.name, ["c"])
+    requests = []
+    original_get = collection.get
+    monkeypatch.setattr(collection, "get", lambda **kwargs: requests.append(kwargs) or original_get(**kwargs))
+    index._version_checked_at = 0.0
+    index.maybe_refresh()
+
+    assert requests[0] == {"include": []}
+    assert [request.get("ids") for request in requests[1:]] == [["c"]]
+    assert index._metadatas == [{"n": 1}, {"n": 2}, {"n": 3}]
+
+
+def test_query_filters_by_metadata(collection, tmp_path):
+    collection.add(
+        ids=["a1", "b1", "a2"],
+        embeddings=[[1.0, 0.0], [1.0, 0.1], [0.0, 1.0]],
+        metadatas=[{"goal": "g", "tenant": "a"}, {"goal": "g", "tenant": "b"}, {"goal": "h", "tenant": "a"}],
+        documents=["a1", "b1", "a2"]
+    )
+    index = LocalVectorIndex(collection, directory=str(tmp_path), refresh_interval=3600)
+
+    assert index.query([1.0, 0.0], n_results=3, where={"tenant": "a"})["ids"] == [["a1", "a2"]]
+    assert index.query([1.0, 0.0], n_results=3, where={"$and": [{"goal": "g"}, {"tenant": "b"}]})["ids"] == [["b1"]]
+    assert index.query([1.0, 0.0], n_results=3, where={"tenant": "c"})["ids"] == [[]]
+
+
+def test_queries_run_safely_during_refresh(collection, tmp_path):
+    collection.add(ids=["a"], embeddings=[[1.0, 0.0]], metadatas=[{"tenant": "a"}], documents=["a"])
+    index = LocalVectorIndex(collection, directory=str(tmp_path), refresh_interval=3600)
+    index.maybe_refresh()
+
+    def writer():
+        for n in range(20):
+            collection.add(ids=[f"w{n}"], embeddings=[[0.0, 1.0]], metadatas=[{"tenant": "b"}], documents=[f"w{n}"])
+            publish_changes(collection.name, [f"w{n}"])
+            index._version_checked_at = 0.0
+
+    def reader():
+        for _ in range(50):
+            result = index.query([1.0, 0.0], n_results=5, where={"tenant": "a"})
+            assert result["ids"] == [["a"]]
+            assert len(result["metadatas"][0]) == len(result["ids"][0])
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(writer)] + [pool.submit(reader) for _ in range(3)]
+        for future in futures:
+            future.result()
+    index._version_checked_at = 0.0
+    assert len(index.query([0.0, 1.0], n_results=50)["ids"][0]) == 21
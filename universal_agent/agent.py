@@ -1,74 +1,171 @@
-from magnitude import BrowserAgent
 import logging
-import json
 import redis
 import os
-import requests
-import urllib.parse
+import time
+import threading
+from contextlib import contextmanager
 from typing import List, Optional
+from shared.task_store import TaskStore, TASK_STATUSES, TERMINAL_STATUSES
+from shared.task_events import publish_event
+from shared.endpoint_scheduler import EndpointScheduler, NoEndpointAvailableError, ENDPOINT_LEASE_TTL
+from universal_agent.browser_pool import get_browser_pool, BrowserConnectError
+from shared.metrics import record_task_finished
+from shared.task_cancel import TaskCancelledError, is_cancel_requested, watch_cancel
+from shared.config import REDIS_HOST, REDIS_PORT, RUNPOD_API_BASE
 
 # --- Конфигурация ---
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-redis_client = redis.Redis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+task_store = TaskStore(redis_client)
+endpoint_scheduler = EndpointScheduler(redis_client)
 logger = logging.getLogger(__name__)
 
+ACTIVE_STATUSES = [status for status in TASK_STATUSES if status not in TERMINAL_STATUSES]
+# Сколько разных эндпоинтов пробовать, если подключение к браузеру не удалось
+ENDPOINT_CONNECT_ATTEMPTS = int(os.getenv("ENDPOINT_CONNECT_ATTEMPTS", "3"))
+
 class MagnitudeAgent:
-    def __init__(self, task_id: str, goal: str, browser_endpoints: Optional[List[str]] = None):
+    def __init__(
+        self,
+        task_id: str,
+        goal: str,
+        browser_endpoints: Optional[List[str]] = None,
+        endpoint_group: Optional[str] = None,
+        operator_action: Optional[dict] = None
+    ):
         self.task_id = task_id
+        # Magnitude не ведет пошаговую историю: действие оператора передается ему в тексте цели
+        if operator_action:
+            goal = f"{goal}\nВозобновляю работу. Следующее действие, продиктованное человеком: {operator_action}"
         self.goal = goal
         self.browser_endpoints = browser_endpoints
+        self.endpoint_group = endpoint_group
+        self.started_at: Optional[float] = None
+        # Magnitude выполняет цель одним вызовом goto: для метрик это один шаг агента
+        self.steps = 0
 
     def run(self):
+        """
+        Выполняет цель. Если для задачи заданы эндпоинты или группа, но все они заняты,
+        поднимает NoEndpointAvailableError до перевода задачи в работу — воркер отложит ее.
+        """
         logger.info(f"Агент Magnitude {self.task_id} начинает работу над целью: '{self.goal}'")
-        self.update_task_status("in_progress")
+        candidates = endpoint_scheduler.candidates(self.browser_endpoints, self.endpoint_group)
+        if (self.browser_endpoints or self.endpoint_group) and not candidates:
+            self.update_task_status("error", status_reason=f"В группе '{self.endpoint_group}' нет эндпоинтов")
+            return
+        endpoint = endpoint_scheduler.acquire(self.task_id, candidates) if candidates else None
+        if not self.update_task_status("in_progress"):
+            # Задачу остановили, пока она ждала в очереди
+            if endpoint is not None:
+                endpoint_scheduler.release(self.task_id, endpoint)
+            return
 
         # --- Конфигурация Magnitude ---
         os.environ["OPENAI_API_KEY"] = os.getenv("RUNPOD_API_KEY")
-        os.environ["OPENAI_API_BASE"] = f"https://api.runpod.ai/v2/{os.getenv('RUNPOD_ENDPOINT_ID_GEMMA')}/openai/v1"
+        os.environ["OPENAI_API_BASE"] = f"{RUNPOD_API_BASE}/{os.getenv('RUNPOD_ENDPOINT_ID_GEMMA')}/openai/v1"
 
         try:
-            browser_options = {}
-            if self.browser_endpoints:
-                endpoint = self.browser_endpoints[0]
-                logger.info(f"Подключаюсь к удаленному браузеру по эндпоинту: {endpoint}")
-                
-                # Magnitude ожидает HTTP-адрес для CDP, а не WebSocket URL.
-                # Мы просто берем хост и порт из вашего эндпоинта.
-                parsed_url = urllib.parse.urlparse(endpoint)
-                
-                # Получаем порт из WebSocket URL, который отдает браузер
-                response = requests.get(endpoint)
-                ws_url = response.json().get("webSocketDebuggerUrl")
-                ws_port = urllib.parse.urlparse(ws_url).port
-
-                cdp_address = f"http://{parsed_url.hostname}:{ws_port}"
-                logger.info(f"Использую CDP адрес: {cdp_address}")
-                browser_options["cdp"] = cdp_address
-            else:
-                logger.info("Эндпоинты не предоставлены, Magnitude запустит свой браузер.")
-
-            agent = BrowserAgent(browser=browser_options)
-            agent.goto(self.goal)
+            for attempt in range(1, ENDPOINT_CONNECT_ATTEMPTS + 1):
+                try:
+                    self._execute_on(endpoint)
+                    break
+                except BrowserConnectError as e:
+                    if endpoint is None:
+                        raise
+                    logger.warning(f"Задача {self.task_id}: {e} (попытка {attempt})")
+                    endpoint_scheduler.report_failure(endpoint)
+                    endpoint_scheduler.release(self.task_id, endpoint)
+                    candidates.remove(endpoint)
+                    endpoint = None
+                    if attempt == ENDPOINT_CONNECT_ATTEMPTS or not candidates:
+                        raise
+                    endpoint = endpoint_scheduler.acquire(self.task_id, candidates)
             
             final_result = f"Magnitude успешно выполнил цель: {self.goal}"
             logger.info(final_result)
             self.update_task_status("completed", result=final_result)
 
+        except TaskCancelledError:
+            logger.info(f"Задача {self.task_id} остановлена, агент Magnitude завершает работу.")
+        except NoEndpointAvailableError as e:
+            # Эндпоинт упал посреди задачи, а остальные заняты: возвращаем задачу в очередь, воркер ее отложит
+            if self.update_task_status("queued", status_reason=str(e)):
+                raise
         except Exception as e:
             error_message = f"Ошибка во время выполнения Magnitude: {e}"
             logger.error(error_message)
             self.update_task_status("error", status_reason=str(e))
-    
-    def update_task_status(self, status: str, status_reason: str = None, result: str = None):
-        """Обновляет статус задачи в Redis."""
-        task_json = redis_client.get(f"task:{self.task_id}")
-        if not task_json:
-            logger.warning(f"Не удалось найти задачу {self.task_id} в Redis для обновления статуса.")
+        finally:
+            if endpoint is not None:
+                endpoint_scheduler.release(self.task_id, endpoint)
+
+    @contextmanager
+    def _keep_lease(self, endpoint: Optional[str]):
+        """Продлевает аренду эндпоинта в фоновом потоке, пока задача на нем выполняется."""
+        if endpoint is None:
+            yield
             return
-        
-        task_data = json.loads(task_json)
-        task_data['status'] = status
-        if status_reason: task_data['status_reason'] = status_reason
-        if result: task_data['result'] = result
-        
-        redis_client.set(f"task:{self.task_id}", json.dumps(task_data)) 
\ No newline at end of file
+        stopped = threading.Event()
+
+        def renew():
+            while not stopped.wait(ENDPOINT_LEASE_TTL / 3):
+                try:
+                    endpoint_scheduler.renew(self.task_id, endpoint)
+                except redis.RedisError as e:
+                    logger.warning(f"Задача {self.task_id}: не удалось продлить аренду эндпоинта {endpoint}: {e}")
+
+        thread = threading.Thread(target=renew, name=f"lease-{self.task_id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def _execute_on(self, endpoint: Optional[str]):
+        # Сессия берется из пула процесса: CDP-адрес и подключение к браузеру переиспользуются между задачами
+        with self._keep_lease(endpoint), get_browser_pool().lease(endpoint) as session:
+            if endpoint is not None:
+                endpoint_scheduler.report_success(endpoint)
+            self.publish_step("browser_connected", endpoint=endpoint, cdp=session.cdp_address, reused=session.uses > 1)
+            if is_cancel_requested(redis_client, self.task_id):
+                raise TaskCancelledError(self.task_id)
+            # Magnitude выполняет цель одним блокирующим вызовом: при отмене поток-наблюдатель
+            # закрывает сессию, goto падает, а пул не вернет закрытую сессию в оборот
+            with watch_cancel(redis_client, self.task_id, session.close) as cancelled:
+                try:
+                    session.agent.goto(self.goal)
+                except Exception:
+                    if cancelled.is_set():
+                        raise TaskCancelledError(self.task_id)
+                    raise
+            if cancelled.is_set():
+                raise TaskCancelledError(self.task_id)
+            self.steps += 1
+            self.publish_step("goal_executed")
+
+    def publish_step(self, step: str, **data):
+        """Публикует событие о шаге агента в поток задачи."""
+        try:
+            publish_event(redis_client, self.task_id, "step", {"step": step, **data})
+        except redis.RedisError as e:
+            # События — вспомогательный канал, их потеря не должна ронять задачу
+            logger.warning(f"Не удалось опубликовать событие шага '{step}' задачи {self.task_id}: {e}")
+
+    def update_task_status(self, status: str, status_reason: str = None, result: str = None) -> bool:
+        """Обновляет статус задачи в Redis. Возвращает False, если задача уже не активна."""
+        fields = {"status": status}
+        if status_reason: fields['status_reason'] = status_reason
+        if result: fields['result'] = result
+
+        # Остановленную пользователем задачу агент не должен "воскрешать"
+        updated = task_store.update(self.task_id, expected_status=ACTIVE_STATUSES, **fields)
+        if updated is None:
+            logger.warning(f"Не удалось найти задачу {self.task_id} в Redis для обновления статуса.")
+        elif not updated:
+            logger.warning(f"Задача {self.task_id} уже завершена или остановлена, статус '{status}' не записан.")
+        if updated and status == "in_progress":
+            self.started_at = time.monotonic()
+        elif updated and status in ("completed", "error"):
+            record_task_finished(status, time.monotonic() - self.started_at if self.started_at else None, self.steps)
+        return bool(updated) 
\ No newline at end of file
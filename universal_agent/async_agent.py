@@ -0,0 +1,413 @@
+import os
+import time
+import asyncio
+import logging
+import redis
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from playwright.async_api import Page, Error as PlaywrightError
+from shared.llm_client import llm_client
+from shared.task_events import apublish_event
+from shared.metrics import record_task_finished
+from shared.tracing import span, bind_task
+from shared.task_cancel import TaskCancelledError
+from shared.endpoint_scheduler import NoEndpointAvailableError, ENDPOINT_LEASE_TTL
+from shared.task_checkpoints import make_checkpoint, perception_hash, CHECKPOINT_MAX_STEPS
+from universal_agent.agent import ACTIVE_STATUSES, ENDPOINT_CONNECT_ATTEMPTS
+from universal_agent.browser_pool import BrowserConnectError
+from universal_agent.perception import diff_perception, element_index, element_selector, PERCEPTION_FULL_SNAPSHOT_STEPS
+from universal_agent.pipeline import PipelinedStepExecutor
+from universal_agent.replay import ReplayPlan
+from universal_agent.runtime import AsyncAgentRuntime
+
+logger = logging.getLogger(__name__)
+
+# Максимум шагов "восприятие -> решение -> действие" на одну задачу
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "30"))
+# Таймаут одного действия в браузере (миллисекунды)
+AGENT_ACTION_TIMEOUT_MS = int(os.getenv("AGENT_ACTION_TIMEOUT_MS", "15000"))
+# После скольких неудачных действий подряд агент передает задачу оператору (0 — никогда)
+AGENT_MAX_FAILED_ACTIONS = int(os.getenv("AGENT_MAX_FAILED_ACTIONS", "3"))
+
+
+class TaskStoppedError(Exception):
+    """Задача перестала быть активной (например, остановлена пользователем) во время работы агента."""
+
+
+class HumanInterventionRequired(Exception):
+    """Агент не справляется сам: задача ждет действия оператора (POST /tasks/{id}/resume)."""
+
+    def __init__(self, reason: str, context: dict):
+        super().__init__(reason)
+        self.context = context
+
+
+def operator_step(action: dict) -> dict:
+    """
+    Действие оператора из ResumeTaskRequest: element_id в нем — CSS-селектор, а не номер
+    элемента снимка, поэтому он передается в браузер как есть (поле selector).
+    """
+    if "element_id" not in action or "selector" in action:
+        return dict(action)
+    step = {key: value for key, value in action.items() if key != "element_id"}
+    step["selector"] = action["element_id"]
+    return step
+
+
+def action_selector(action: dict) -> str:
+    """Селектор цели действия: selector от оператора как есть, element_id из снимка — через data-ornold-id."""
+    if "selector" in action:
+        return action["selector"]
+    return element_selector(action["element_id"])
+
+
+class UniversalAgent:
+    """
+    Агент асинхронного режима воркера: цикл восприятие -> решение LLM -> действие
+    в браузере через playwright. Все ожидания (LLM, браузер, Redis) — await, поэтому
+    сотни агентов делят один event loop процесса.
+    """
+
+    def __init__(
+        self,
+        runtime: AsyncAgentRuntime,
+        task_id: str,
+        goal: str,
+        browser_endpoints: Optional[List[str]] = None,
+        endpoint_group: Optional[str] = None,
+        operator_action: Optional[dict] = None,
+        tenant: Optional[str] = None
+    ):
+        self.runtime = runtime
+        self.task_id = task_id
+        self.goal = goal
+        self.browser_endpoints = browser_endpoints
+        self.endpoint_group = endpoint_group
+        # Клиент задачи: сценарии для повтора ищутся и сохраняются только в его пределах
+        self.tenant = tenant
+        # Действие оператора при возобновлении: выполняется первым шагом вместо запроса к LLM
+        self.operator_action = operator_action
+        self.started_at: Optional[float] = None
+        self.history: list[dict] = []
+        # Контрольные точки выполненных шагов (восстановленные и новые), см. shared/task_checkpoints.py
+        self.checkpoints: list[dict] = []
+        # Снимок страницы, который видела LLM в предыдущем запросе, и сколько запросов назад
+        # ей отправлялся полный снимок (см. _page_state)
+        self.last_perception: Optional[dict] = None
+        self.diffs_since_snapshot = 0
+        # Сохраненный сценарий с почти той же целью: его шаги выполняются без LLM, см. universal_agent/replay.py
+        self.replay_plan: Optional[ReplayPlan] = None
+        # Эндпоинт браузера текущей попытки и число неудачных действий подряд (для передачи оператору)
+        self.endpoint: Optional[str] = None
+        self.failed_actions = 0
+
+    async def run(self):
+        """
+        Выполняет цель. Если все эндпоинты задачи заняты, поднимает NoEndpointAvailableError
+        до перевода задачи в работу — воркер отложит ее.
+        """
+        bind_task(self.task_id)
+        logger.info(f"Агент {self.task_id} начинает работу над целью: '{self.goal}'")
+        scheduler = self.runtime.endpoint_scheduler
+        candidates = await scheduler.candidates(self.browser_endpoints, self.endpoint_group)
+        if (self.browser_endpoints or self.endpoint_group) and not candidates:
+            await self.update_task_status("error", status_reason=f"В группе '{self.endpoint_group}' нет эндпоинтов")
+            return
+        endpoint = await scheduler.acquire(self.task_id, candidates) if candidates else None
+        if not await self.update_task_status("in_progress"):
+            if endpoint is not None:
+                await scheduler.release(self.task_id, endpoint)
+            return
+
+        try:
+            await self._restore_checkpoints()
+            await self._find_replay_plan()
+            for attempt in range(1, ENDPOINT_CONNECT_ATTEMPTS + 1):
+                try:
+                    # Остановка задачи прерывает агента на текущем ожидании, а не только между шагами
+                    result = await self.runtime.cancellation.run(self.task_id, self._execute_on(endpoint))
+                    break
+                except BrowserConnectError as e:
+                    if endpoint is None:
+                        raise
+                    logger.warning(f"Задача {self.task_id}: {e} (попытка {attempt})")
+                    await scheduler.report_failure(endpoint)
+                    await scheduler.release(self.task_id, endpoint)
+                    candidates.remove(endpoint)
+                    endpoint = None
+                    if attempt == ENDPOINT_CONNECT_ATTEMPTS or not candidates:
+                        raise
+                    endpoint = await scheduler.acquire(self.task_id, candidates)
+
+            logger.info(f"Агент {self.task_id} достиг цели: {result}")
+            if await self.update_task_status("completed", result=result):
+                await self._record_scenario()
+
+        except (TaskStoppedError, TaskCancelledError):
+            logger.info(f"Задача {self.task_id} больше не активна, агент завершает работу.")
+        except HumanInterventionRequired as e:
+            # Контрольные точки сохраняются: после resume задача продолжит с действия оператора
+            logger.warning(f"Задача {self.task_id} передана оператору: {e}")
+            await self.update_task_status("human_intervention_required", status_reason=str(e), failed_action_context=e.context)
+        except NoEndpointAvailableError as e:
+            # Эндпоинт упал посреди задачи, а остальные заняты: возвращаем задачу в очередь,
+            # после повтора она продолжит с контрольной точки
+            if await self.update_task_status("queued", status_reason=str(e)):
+                raise
+        except Exception as e:
+            logger.error(f"Ошибка во время выполнения агента {self.task_id}: {e}")
+            await self.update_task_status("error", status_reason=str(e))
+        finally:
+            if endpoint is not None:
+                await scheduler.release(self.task_id, endpoint)
+
+    @asynccontextmanager
+    async def _keep_lease(self, endpoint: Optional[str]):
+        """Продлевает аренду эндпоинта фоновой задачей, пока агент на нем работает."""
+        if endpoint is None:
+            yield
+            return
+
+        async def renew():
+            while True:
+                await asyncio.sleep(ENDPOINT_LEASE_TTL / 3)
+                try:
+                    await self.runtime.endpoint_scheduler.renew(self.task_id, endpoint)
+                except redis.RedisError as e:
+                    logger.warning(f"Задача {self.task_id}: не удалось продлить аренду эндпоинта {endpoint}: {e}")
+
+        renewal = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            renewal.cancel()
+
+    async def _execute_on(self, endpoint: Optional[str]) -> str:
+        self.endpoint = endpoint
+        async with self._keep_lease(endpoint), self.runtime.browser_pool.lease(endpoint) as context:
+            if endpoint is not None:
+                await self.runtime.endpoint_scheduler.report_success(endpoint)
+            page = await context.new_page()
+            page.set_default_timeout(AGENT_ACTION_TIMEOUT_MS)
+            await self.publish_step("browser_connected", endpoint=endpoint)
+            if self.checkpoints:
+                await self._goto_checkpoint(page)
+            return await self._step_loop(page)
+
+    async def _restore_checkpoints(self):
+        """
+        Восстанавливает историю по контрольным точкам задачи (возобновление, перезапуск после
+        ошибки, повторная попытка на другом эндпоинте): оплаченные шаги LLM не повторяются.
+        """
+        try:
+            self.checkpoints = await self.runtime.checkpoint_store.load(self.task_id)
+        except redis.RedisError as e:
+            logger.warning(f"Задача {self.task_id}: не удалось загрузить контрольные точки, начинаю сначала: {e}")
+            return
+        self.history = [{"action": point["action"], "outcome": point["outcome"]} for point in self.checkpoints]
+        if self.checkpoints:
+            logger.info(f"Задача {self.task_id}: восстановлено шагов {len(self.checkpoints)}")
+            await self.publish_step("restored", steps=len(self.checkpoints), url=self.checkpoints[-1]["url"])
+
+    async def _goto_checkpoint(self, page: Page):
+        url = self.checkpoints[-1]["url"]
+        if not url or url == "about:blank":
+            return
+        try:
+            await page.goto(url, wait_until="domcontentloaded")
+        except PlaywrightError as e:
+            logger.warning(f"Задача {self.task_id}: не удалось вернуться на {url}: {e}")
+
+    async def _rewind(self, page_hash: str) -> bool:
+        """
+        Сверяет восстановленную страницу с контрольными точками. Если она совпадает со страницей,
+        на которой был выбран один из шагов, менявших страницу (например, после перезагрузки
+        пропал введенный текст), этот шаг и последующие выполняются заново.
+        """
+        for index in range(len(self.checkpoints) - 1, -1, -1):
+            point = self.checkpoints[index]
+            if point["perception_hash"] != page_hash:
+                continue
+            if point["outcome"] != "ok" or point["action"].get("action") not in ("browse", "click", "type"):
+                # Шаг не менял страницу: совпадение означает, что мы уже после него
+                return False
+            dropped = len(self.checkpoints) - index
+            self.checkpoints = self.checkpoints[:index]
+            self.history = self.history[:index]
+            try:
+                await self.runtime.checkpoint_store.truncate(self.task_id, index)
+            except redis.RedisError as e:
+                logger.warning(f"Задача {self.task_id}: не удалось обрезать контрольные точки: {e}")
+            logger.info(f"Задача {self.task_id}: страница совпала с шагом {point['step']}, повторяю шагов {dropped}")
+            await self.publish_step("rewound", to_step=point["step"], dropped=dropped)
+            return True
+        return False
+
+    async def _find_replay_plan(self):
+        self.replay_plan = await self.runtime.replay.find_plan(self.goal, tenant=self.tenant)
+        if self.replay_plan is not None:
+            plan = self.replay_plan
+            logger.info(
+                f"Задача {self.task_id}: повторяю сценарий '{plan.source_goal}' "
+                f"(шагов {len(plan.steps)}, сходство {plan.confidence:.2f})"
+            )
+            await self.publish_step(
+                "replay_plan", source_goal=plan.source_goal, confidence=round(plan.confidence, 3), steps=len(plan.steps)
+            )
+
+    async def _record_scenario(self):
+        plan = self.replay_plan
+        if plan is not None:
+            logger.info(f"Задача {self.task_id}: повторено шагов {plan.replayed}, решений LLM {plan.fallbacks}")
+            await self.publish_step("replay", replayed=plan.replayed, llm=plan.fallbacks)
+        await self.runtime.replay.record(self.goal, self.checkpoints, plan, tenant=self.tenant)
+
+    def _next_step(self) -> int:
+        # Нумерация продолжается с последнего сохраненного шага
+        return self.checkpoints[-1]["step"] + 1 if self.checkpoints else 1
+
+    async def _step_loop(self, page: Page) -> str:
+        pipeline = PipelinedStepExecutor(page, self.goal)
+        restored = bool(self.checkpoints)
+        try:
+            for _ in range(AGENT_MAX_STEPS):
+                step = self._next_step()
+                with span("agent.step", step=step) as step_span:
+                    snapshot = await pipeline.perceive()
+                    page_hash = perception_hash(snapshot)
+                    if restored:
+                        restored = False
+                        if await self._rewind(page_hash):
+                            step = self._next_step()
+                            step_span.set_attribute("step", step)
+                    if self.operator_action is not None:
+                        action, self.operator_action = operator_step(self.operator_action), None
+                        prompt_report, source = {}, "operator"
+                    elif self.replay_plan is not None and (action := self.replay_plan.next_action(page_hash)) is not None:
+                        prompt_report, source = {}, "replay"
+                    else:
+                        source = "llm"
+                        perception = self._page_state(snapshot)
+                        action = await pipeline.decide(
+                            lambda: llm_client.aget_next_action_universal(self.goal, self.history, perception), snapshot
+                        )
+                        prompt_report = llm_client.last_prompt_report() or {}
+                    if action.get("action") == "finish":
+                        await pipeline.drain()
+                        return action.get("result") or action.get("reasoning") or "Цель достигнута"
+
+                    outcome = await pipeline.act(self._perform(page, action))
+                    self.history.append({"action": action, "outcome": outcome})
+                    checkpoint = make_checkpoint(step, action, outcome, page.url, page_hash)
+                    self.checkpoints = [*self.checkpoints[-(CHECKPOINT_MAX_STEPS - 1):], checkpoint]
+                    await pipeline.defer(self.record_step(checkpoint, prompt_report, pipeline.timing(), source))
+                    self._check_failures(step, action, outcome, page.url)
+                    # Отдаем управление другим агентам между шагами
+                    await asyncio.sleep(0)
+            await pipeline.drain()
+            raise RuntimeError(f"Цель не достигнута за {AGENT_MAX_STEPS} шагов")
+        finally:
+            await pipeline.abort()
+            logger.info(f"Задача {self.task_id}: конвейер шагов {pipeline.stats}")
+
+    def _page_state(self, perception: dict) -> dict:
+        """
+        Состояние страницы для промпта: полный снимок в первом запросе к LLM и затем раз в
+        PERCEPTION_FULL_SNAPSHOT_STEPS запросов, между ними — дифф к странице из предыдущего
+        запроса и компактный список всех элементов (без него LLM не видела бы неизмененные
+        элементы и не могла бы на них нажать). Полный снимок отправляется и тогда, когда дифф
+        слишком велик (например, после перехода на другую страницу). Шаги без LLM (повтор
+        сценария, действие оператора) дифф не сбрасывают: он считается от того, что LLM видела последним.
+        """
+        previous, self.last_perception = self.last_perception, perception
+        if previous is not None and self.diffs_since_snapshot + 1 < PERCEPTION_FULL_SNAPSHOT_STEPS:
+            changes = diff_perception(previous, perception)
+            if changes is not None:
+                self.diffs_since_snapshot += 1
+                return {"changes": changes, "elements": element_index(perception)}
+        self.diffs_since_snapshot = 0
+        return perception
+
+    def _check_failures(self, step: int, action: dict, outcome: str, url: str):
+        """Передает задачу оператору после AGENT_MAX_FAILED_ACTIONS неудачных действий подряд."""
+        self.failed_actions = 0 if outcome == "ok" else self.failed_actions + 1
+        if not AGENT_MAX_FAILED_ACTIONS or self.failed_actions < AGENT_MAX_FAILED_ACTIONS:
+            return
+        raise HumanInterventionRequired(
+            f"Не удалось выполнить {self.failed_actions} действий подряд, нужна помощь оператора",
+            {"browser_endpoint_url": self.endpoint, "url": url, "step": step, "failed_action": action, "error": outcome}
+        )
+
+    async def _perform(self, page: Page, action: dict) -> str:
+        """Выполняет действие. Ошибка браузера не роняет задачу, а возвращается LLM как результат шага."""
+        action_type = action.get("action")
+        try:
+            if action_type == "browse":
+                await page.goto(action["url"], wait_until="domcontentloaded")
+            elif action_type == "click":
+                await page.click(action_selector(action))
+            elif action_type == "type":
+                await page.fill(action_selector(action), action.get("text", ""))
+            return "ok"
+        except (PlaywrightError, KeyError) as e:
+            logger.warning(f"Задача {self.task_id}: действие {action_type} не выполнено: {e}")
+            return f"Ошибка: {e}"
+
+    async def record_step(
+        self, checkpoint: dict, prompt_report: Optional[dict] = None, timing: Optional[dict] = None, source: str = "llm"
+    ):
+        """
+        Учитывает шаг в задаче, сохраняет его контрольную точку и публикует событие.
+        Если задача уже не в работе — останавливает агента.
+        """
+        updated = await self.runtime.task_store.update(
+            self.task_id, expected_status="in_progress", incr={"steps_completed": 1}
+        )
+        if not updated:
+            raise TaskStoppedError(self.task_id)
+        try:
+            await self.runtime.checkpoint_store.append(self.task_id, checkpoint)
+        except redis.RedisError as e:
+            # Без точки задача просто повторит этот шаг при возобновлении
+            logger.warning(f"Не удалось сохранить контрольную точку шага {checkpoint['step']} задачи {self.task_id}: {e}")
+        prompt_report = prompt_report or {}
+        await self.publish_step(
+            "action", number=checkpoint["step"], action=checkpoint["action"], outcome=checkpoint["outcome"], source=source,
+            prompt_tokens=prompt_report.get("tokens"), prompt_tokens_saved=prompt_report.get("saved_tokens"),
+            timing=timing
+        )
+
+    async def publish_step(self, step: str, **data):
+        """Публикует событие о шаге агента в поток задачи."""
+        try:
+            await apublish_event(self.runtime.redis, self.task_id, "step", {"step": step, **data})
+        except redis.RedisError as e:
+            # События — вспомогательный канал, их потеря не должна ронять задачу
+            logger.warning(f"Не удалось опубликовать событие шага '{step}' задачи {self.task_id}: {e}")
+
+    async def update_task_status(
+        self, status: str, status_reason: str = None, result: str = None, failed_action_context: dict = None
+    ) -> bool:
+        """Обновляет статус задачи в Redis. Возвращает False, если задача уже не активна."""
+        fields = {"status": status}
+        if status_reason: fields['status_reason'] = status_reason
+        if result: fields['result'] = result
+        if failed_action_context: fields['failed_action_context'] = failed_action_context
+
+        # Остановленную пользователем задачу агент не должен "воскрешать"
+        updated = await self.runtime.task_store.update(self.task_id, expected_status=ACTIVE_STATUSES, **fields)
+        if updated is None:
+            logger.warning(f"Не удалось найти задачу {self.task_id} в Redis для обновления статуса.")
+        elif not updated:
+            logger.warning(f"Задача {self.task_id} уже завершена или остановлена, статус '{status}' не записан.")
+        if updated and status == "in_progress":
+            self.started_at = time.monotonic()
+        elif updated and status in ("completed", "error"):
+            record_task_finished(status, time.monotonic() - self.started_at if self.started_at else None, len(self.history))
+        if updated and status == "completed":
+            # Завершенную задачу не возобновляют: ее точки больше не нужны
+            try:
+                await self.runtime.checkpoint_store.clear(self.task_id)
+            except redis.RedisError as e:
+                logger.warning(f"Не удалось удалить контрольные точки задачи {self.task_id} (истекут сами): {e}")
+        return bool(updated)
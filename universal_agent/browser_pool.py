@@ -0,0 +1,412 @@
+from playwright.async_api import async_playwright, Browser, BrowserContext
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import itertools
+import urllib.parse
+import requests
+from websockets.sync.client import connect as ws_connect
+from websockets.exceptions import WebSocketException
+from contextlib import contextmanager, asynccontextmanager
+from typing import Callable, Optional
+from shared.metrics import observe, BROWSER_CONNECT_SECONDS
+from shared.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Сколько держать разрешенный CDP-адрес эндпоинта (секунды)
+BROWSER_CDP_CACHE_TTL = float(os.getenv("BROWSER_CDP_CACHE_TTL", "300"))
+# Сколько простаивающих сессий держать на один эндпоинт
+BROWSER_POOL_MAX_IDLE = int(os.getenv("BROWSER_POOL_MAX_IDLE", "2"))
+# Через сколько секунд простоя сессия закрывается
+BROWSER_POOL_IDLE_TTL = float(os.getenv("BROWSER_POOL_IDLE_TTL", "600"))
+# После скольких задач сессия пересоздается (защита от утечек состояния браузера)
+BROWSER_POOL_MAX_USES = int(os.getenv("BROWSER_POOL_MAX_USES", "50"))
+BROWSER_HEALTH_TIMEOUT = float(os.getenv("BROWSER_HEALTH_TIMEOUT", "2"))
+
+# Ключ пула для браузера, который Magnitude запускает сам (эндпоинт не передан)
+LOCAL_BROWSER = "local"
+
+
+class BrowserConnectError(RuntimeError):
+    """Не удалось подключиться к браузеру эндпоинта."""
+
+
+class CDPResolver:
+    """
+    Кэш CDP-адресов эндпоинтов.
+    Magnitude ожидает HTTP-адрес для CDP, а не WebSocket URL: хост берем из эндпоинта,
+    порт — из webSocketDebuggerUrl, который отдает браузер.
+    """
+
+    def __init__(self, ttl: float = BROWSER_CDP_CACHE_TTL):
+        self.ttl = ttl
+        self._http = requests.Session()
+        self._cache: dict[str, tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, endpoint: str) -> str:
+        with self._lock:
+            cached = self._cache.get(endpoint)
+        if cached and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+
+        response = self._http.get(endpoint, timeout=BROWSER_HEALTH_TIMEOUT * 5)
+        response.raise_for_status()
+        ws_url = response.json().get("webSocketDebuggerUrl")
+        ws_port = urllib.parse.urlparse(ws_url).port
+        cdp_address = f"http://{urllib.parse.urlparse(endpoint).hostname}:{ws_port}"
+
+        with self._lock:
+            self._cache[endpoint] = (cdp_address, time.monotonic())
+        return cdp_address
+
+    def invalidate(self, endpoint: str):
+        with self._lock:
+            self._cache.pop(endpoint, None)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self._http.get(url, timeout=BROWSER_HEALTH_TIMEOUT, **kwargs)
+
+    def page_ids(self, cdp_address: str) -> list[str]:
+        return [target["id"] for target in self.get(f"{cdp_address}/json/list").json() if target.get("type") == "page"]
+
+
+class CDPError(RuntimeError):
+    """Браузер вернул ошибку на команду CDP."""
+
+
+def cdp_call(
+    cdp_address: str,
+    target_id: str,
+    commands: list[tuple[str, dict]],
+    timeout: float = BROWSER_HEALTH_TIMEOUT * 5
+) -> list[dict]:
+    """
+    Выполняет команды CDP во вкладке target_id по ее WebSocket-каналу и возвращает их результаты.
+    Адрес собираем из cdp_address, а не из webSocketDebuggerUrl: браузер указывает в нем
+    свой внутренний хост.
+    """
+    host = urllib.parse.urlparse(cdp_address).netloc
+    ids = itertools.count(1)
+    results = []
+    with ws_connect(f"ws://{host}/devtools/page/{target_id}", open_timeout=timeout, max_size=None) as ws:
+        for method, params in commands:
+            command_id = next(ids)
+            ws.send(json.dumps({"id": command_id, "method": method, "params": params}))
+            while True:
+                message = json.loads(ws.recv(timeout=timeout))
+                # Пропускаем события вкладки, ждем ответ на свою команду
+                if message.get("id") == command_id:
+                    break
+            if "error" in message:
+                raise CDPError(f"{method}: {message['error'].get('message')}")
+            results.append(message.get("result", {}))
+    return results
+
+
+class BrowserSession:
+    """Подключенный к браузеру агент Magnitude и служебная информация о нем."""
+
+    def __init__(self, endpoint: str, cdp_address: Optional[str], agent, target_id: Optional[str] = None):
+        self.endpoint = endpoint
+        self.cdp_address = cdp_address
+        self.agent = agent
+        # Вкладка, к которой привязан агент (ID цели CDP)
+        self.target_id = target_id
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+
+    def close(self):
+        close = getattr(self.agent, "close", None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии браузерной сессии {self.endpoint}: {e}")
+
+
+def _magnitude_agent(browser_options: dict):
+    # magnitude нужен только пулу обычного воркера: асинхронный агент (AsyncBrowserPool) работает без него
+    from magnitude import BrowserAgent
+    return BrowserAgent(browser=browser_options)
+
+
+class BrowserSessionPool:
+    """
+    Пул готовых браузерных сессий процесса воркера с ключом по эндпоинту.
+
+    Задача берет сессию в аренду (lease) и возвращает ее по завершении: сессия проходит
+    проверку здоровья при выдаче и сброс состояния при возврате. Сессии, упавшие во время
+    задачи, не прошедшие проверку, простаивающие дольше idle_ttl или отработавшие max_uses
+    задач, закрываются.
+    """
+
+    def __init__(
+        self,
+        agent_factory: Callable[[dict], object] | None = None,
+        max_idle_per_endpoint: int = BROWSER_POOL_MAX_IDLE,
+        idle_ttl: float = BROWSER_POOL_IDLE_TTL,
+        max_uses: int = BROWSER_POOL_MAX_USES
+    ):
+        self.agent_factory = agent_factory or _magnitude_agent
+        self.max_idle_per_endpoint = max_idle_per_endpoint
+        self.idle_ttl = idle_ttl
+        self.max_uses = max_uses
+        self.resolver = CDPResolver()
+        self._idle: dict[str, list[BrowserSession]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"created": 0, "reused": 0, "evicted": 0}
+
+    @contextmanager
+    def lease(self, endpoint: Optional[str] = None):
+        """Выдает сессию для эндпоинта (или для локального браузера) на время задачи."""
+        session = self._acquire(endpoint or LOCAL_BROWSER)
+        try:
+            yield session
+        except Exception:
+            # Состояние браузера после ошибки неизвестно — такую сессию не переиспользуем
+            self._evict(session, "ошибка во время задачи")
+            raise
+        else:
+            self._release(session)
+
+    def _acquire(self, endpoint: str) -> BrowserSession:
+        self._sweep()
+        while True:
+            with self._lock:
+                idle = self._idle.get(endpoint)
+                session = idle.pop() if idle else None
+            if session is None:
+                break
+            if self._is_healthy(session):
+                session.uses += 1
+                session.last_used = time.monotonic()
+                self.stats["reused"] += 1
+                logger.info(f"Переиспользую браузерную сессию для {endpoint} (задача №{session.uses})")
+                return session
+            self._evict(session, "не прошла проверку здоровья")
+            self.resolver.invalidate(endpoint)
+
+        try:
+            with span("browser.connect", endpoint=endpoint), observe(BROWSER_CONNECT_SECONDS, pool="magnitude"):
+                return self._create(endpoint)
+        except Exception as e:
+            self.resolver.invalidate(endpoint)
+            raise BrowserConnectError(f"Не удалось подключиться к браузеру {endpoint}: {e}") from e
+
+    def _create(self, endpoint: str) -> BrowserSession:
+        browser_options = {}
+        cdp_address = None
+        if endpoint != LOCAL_BROWSER:
+            logger.info(f"Подключаюсь к удаленному браузеру по эндпоинту: {endpoint}")
+            cdp_address = self.resolver.resolve(endpoint)
+            logger.info(f"Использую CDP адрес: {cdp_address}")
+            browser_options["cdp"] = cdp_address
+        else:
+            logger.info("Эндпоинты не предоставлены, Magnitude запустит свой браузер.")
+
+        existing = set(self.resolver.page_ids(cdp_address)) if cdp_address else set()
+        session = BrowserSession(endpoint, cdp_address, self.agent_factory(browser_options))
+        if cdp_address:
+            session.target_id = self._agent_target(cdp_address, existing)
+        session.uses = 1
+        self.stats["created"] += 1
+        return session
+
+    def _release(self, session: BrowserSession):
+        if session.uses >= self.max_uses:
+            self._evict(session, f"отработала {session.uses} задач")
+            return
+        if not self._reset(session):
+            self._evict(session, "не удалось сбросить состояние")
+            return
+
+        session.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(session.endpoint, [])
+            if len(idle) < self.max_idle_per_endpoint:
+                idle.append(session)
+                return
+        self._evict(session, "пул эндпоинта заполнен")
+
+    def _is_healthy(self, session: BrowserSession) -> bool:
+        if session.cdp_address is None:
+            # Локальный браузер принадлежит Magnitude, его состояние проверить нечем
+            return True
+        try:
+            return self.resolver.get(f"{session.cdp_address}/json/version").ok
+        except requests.RequestException:
+            return False
+
+    def _agent_target(self, cdp_address: str, existing: set[str]) -> Optional[str]:
+        """
+        Вкладка агента: новая вкладка, открытая при его подключении, или единственная вкладка
+        браузера. Если ее не определить однозначно, сессия не переиспользуется.
+        """
+        try:
+            pages = self.resolver.page_ids(cdp_address)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning(f"Не удалось получить список вкладок {cdp_address}: {e}")
+            return None
+        opened = [page_id for page_id in pages if page_id not in existing]
+        if len(opened) == 1:
+            return opened[0]
+        return pages[0] if len(pages) == 1 else None
+
+    def _reset(self, session: BrowserSession) -> bool:
+        """
+        Возвращает браузер к исходному виду между задачами: закрывает вкладки и всплывающие
+        окна, открытые задачей, а во вкладке агента удаляет cookies, хранилища и кэш посещенных
+        сайтов и открывает пустую страницу (HTTP-методы CDP /json/* и команды CDP вкладки).
+        """
+        if session.cdp_address is None:
+            return True
+        if session.target_id is None:
+            logger.warning(f"Вкладка агента сессии {session.endpoint} неизвестна, сбросить состояние нельзя")
+            return False
+        try:
+            targets = [target for target in self.resolver.get(f"{session.cdp_address}/json/list").json()
+                       if target.get("type") == "page"]
+            if session.target_id not in {target["id"] for target in targets}:
+                logger.warning(f"Вкладка агента сессии {session.endpoint} закрыта")
+                return False
+            # Хранилища чистятся по источникам: собираем все сайты из истории вкладки агента и открытых окон
+            history, = cdp_call(session.cdp_address, session.target_id, [("Page.getNavigationHistory", {})])
+            urls = [entry["url"] for entry in history.get("entries", [])] + [target.get("url", "") for target in targets]
+            origins = set()
+            for url in map(urllib.parse.urlparse, urls):
+                if url.scheme in ("http", "https"):
+                    origins.add(f"{url.scheme}://{url.netloc}")
+            for target in targets:
+                if target["id"] != session.target_id:
+                    self.resolver.get(f"{session.cdp_address}/json/close/{target['id']}").raise_for_status()
+
+            cdp_call(session.cdp_address, session.target_id, [
+                ("Page.navigate", {"url": "about:blank"}),
+                ("Network.clearBrowserCookies", {}),
+                ("Network.clearBrowserCache", {}),
+                *[("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"}) for origin in sorted(origins)]
+            ])
+            return True
+        except (requests.RequestException, ValueError, KeyError, OSError, WebSocketException, CDPError) as e:
+            logger.warning(f"Не удалось сбросить браузерную сессию {session.endpoint}: {e}")
+            return False
+
+    def _sweep(self):
+        """Закрывает сессии, простаивающие дольше idle_ttl."""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for endpoint, idle in self._idle.items():
+                expired.extend(session for session in idle if now - session.last_used > self.idle_ttl)
+                idle[:] = [session for session in idle if now - session.last_used <= self.idle_ttl]
+        for session in expired:
+            self._evict(session, "простаивала слишком долго")
+
+    def _evict(self, session: BrowserSession, reason: str):
+        logger.info(f"Закрываю браузерную сессию {session.endpoint}: {reason}")
+        self.stats["evicted"] += 1
+        session.close()
+
+    def close_all(self):
+        with self._lock:
+            sessions = [session for idle in self._idle.values() for session in idle]
+            self._idle.clear()
+        for session in sessions:
+            self._evict(session, "завершение процесса")
+
+
+
+class AsyncBrowserPool:
+    """
+    Браузеры для асинхронных агентов: одно playwright-подключение по CDP на эндпоинт,
+    общее для всех агентов процесса. Каждая задача получает в аренду собственный
+    контекст браузера (свои cookies и вкладки), который закрывается при возврате —
+    это и есть сброс состояния. Разорванное подключение переустанавливается при следующей аренде.
+    """
+
+    def __init__(self):
+        self.resolver = CDPResolver()
+        self._playwright = None
+        self._browsers: dict[str, Browser] = {}
+        self._connect_locks: dict[str, asyncio.Lock] = {}
+        self.stats = {"connected": 0, "leases": 0, "disconnected": 0}
+
+    async def _connect(self, endpoint: str) -> Browser:
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        if endpoint == LOCAL_BROWSER:
+            logger.info("Эндпоинты не предоставлены, запускаю локальный браузер.")
+            return await self._playwright.chromium.launch()
+        # Разрешение адреса кэшируется, блокирующий запрос уходит из event loop только при промахе
+        cdp_address = await asyncio.to_thread(self.resolver.resolve, endpoint)
+        logger.info(f"Подключаюсь к браузеру {endpoint} по CDP: {cdp_address}")
+        return await self._playwright.chromium.connect_over_cdp(cdp_address)
+
+    async def _get_browser(self, endpoint: str) -> Browser:
+        browser = self._browsers.get(endpoint)
+        if browser is not None and browser.is_connected():
+            return browser
+        # Одновременные аренды одного эндпоинта ждут единственное подключение
+        async with self._connect_locks.setdefault(endpoint, asyncio.Lock()):
+            browser = self._browsers.get(endpoint)
+            if browser is None or not browser.is_connected():
+                with span("browser.connect", endpoint=endpoint), observe(BROWSER_CONNECT_SECONDS, pool="playwright"):
+                    browser = await self._connect(endpoint)
+                self._browsers[endpoint] = browser
+                self.stats["connected"] += 1
+        return browser
+
+    @asynccontextmanager
+    async def lease(self, endpoint: Optional[str] = None):
+        """Выдает новый контекст браузера эндпоинта на время задачи."""
+        endpoint = endpoint or LOCAL_BROWSER
+        try:
+            browser = await self._get_browser(endpoint)
+            context: BrowserContext = await browser.new_context()
+        except Exception as e:
+            self.resolver.invalidate(endpoint)
+            self._browsers.pop(endpoint, None)
+            raise BrowserConnectError(f"Не удалось подключиться к браузеру {endpoint}: {e}") from e
+
+        self.stats["leases"] += 1
+        try:
+            yield context
+        finally:
+            try:
+                await context.close()
+            except Exception as e:
+                logger.warning(f"Не удалось закрыть контекст браузера {endpoint}: {e}")
+            if not browser.is_connected():
+                self.stats["disconnected"] += 1
+                self._browsers.pop(endpoint, None)
+
+    async def close_all(self):
+        browsers = list(self._browsers.values())
+        self._browsers.clear()
+        for browser in browsers:
+            try:
+                await browser.close()
+            except Exception as e:
+                logger.warning(f"Ошибка при закрытии браузера: {e}")
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+_pool: Optional[BrowserSessionPool] = None
+_pool_pid: Optional[int] = None
+
+
+def get_browser_pool() -> BrowserSessionPool:
+    """Свой пул для каждого процесса: prefork-процессы Celery форкаются уже после импорта."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = BrowserSessionPool()
+        _pool_pid = os.getpid()
+    return _pool
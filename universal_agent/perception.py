@@ -0,0 +1,168 @@
+import os
+import json
+import logging
+from playwright.async_api import Page
+
+logger = logging.getLogger(__name__)
+
+# Сколько интерактивных элементов и символов видимого текста отдавать LLM
+PERCEPTION_MAX_ELEMENTS = int(os.getenv("PERCEPTION_MAX_ELEMENTS", "150"))
+PERCEPTION_TEXT_LIMIT = int(os.getenv("PERCEPTION_TEXT_LIMIT", "2000"))
+# Если дифф больше этой доли полного снимка, агент отправляет новый снимок целиком
+PERCEPTION_DIFF_MAX_RATIO = float(os.getenv("PERCEPTION_DIFF_MAX_RATIO", "0.3"))
+# Раз в сколько запросов к LLM отправлять полный снимок страницы, между ними — только дифф
+# к предыдущему запросу (1 — всегда полный снимок)
+PERCEPTION_FULL_SNAPSHOT_STEPS = int(os.getenv("PERCEPTION_FULL_SNAPSHOT_STEPS", "5"))
+# Длина подписи элемента в компактном списке элементов, который отправляется вместе с диффом
+PERCEPTION_INDEX_TEXT_LIMIT = int(os.getenv("PERCEPTION_INDEX_TEXT_LIMIT", "40"))
+
+# Версия документа: случайный токен документа и счетчик изменений DOM и ввода (MutationObserver
+# и события input/change). Собственные изменения скриптов агента (разметка, подсказки prefetch)
+# из счета исключаются: перед ними учитываются накопленные записи, после — сбрасываются.
+_VERSION_JS = """
+window.__ornoldVersionOf = window.__ornoldVersionOf || (() => {
+    if (!window.__ornoldObserver) {
+        window.__ornoldDoc = Math.random().toString(36).slice(2);
+        window.__ornoldVersion = 0;
+        const bump = () => { window.__ornoldVersion++; };
+        window.__ornoldObserver = new MutationObserver(bump);
+        window.__ornoldObserver.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+        document.addEventListener('input', bump, true);
+        document.addEventListener('change', bump, true);
+    }
+    if (window.__ornoldObserver.takeRecords().length) window.__ornoldVersion++;
+    return window.__ornoldDoc + ':' + window.__ornoldVersion;
+});
+"""
+
+# Размечает видимые интерактивные элементы атрибутом data-ornold-id (ID стабильны в рамках
+# документа) и возвращает их краткое описание вместе с видимым текстом страницы и версией документа.
+_MARK_ELEMENTS_JS = """
+([maxElements, textLimit]) => {
+""" + _VERSION_JS + """
+    const version = window.__ornoldVersionOf();
+    const selector = 'a, button, input, textarea, select, [role=button], [role=link], [role=checkbox], [role=tab], [onclick], [contenteditable=true]';
+    let nextId = window.__ornoldNextId || 1;
+    const elements = [];
+    for (const el of document.querySelectorAll(selector)) {
+        if (elements.length >= maxElements) break;
+        const rect = el.getBoundingClientRect();
+        const style = window.getComputedStyle(el);
+        if (rect.width === 0 || rect.height === 0 || style.visibility === 'hidden' || style.display === 'none') continue;
+        if (!el.hasAttribute('data-ornold-id')) el.setAttribute('data-ornold-id', String(nextId++));
+        const label = el.innerText || el.value || el.getAttribute('aria-label') || el.getAttribute('placeholder') || el.getAttribute('title') || '';
+        const item = {id: el.getAttribute('data-ornold-id'), tag: el.tagName.toLowerCase(), text: label.trim().slice(0, 100)};
+        for (const attr of ['type', 'role', 'href', 'name']) {
+            const value = el.getAttribute(attr);
+            if (value) item[attr] = value.slice(0, 200);
+        }
+        elements.push(item);
+    }
+    window.__ornoldNextId = nextId;
+    window.__ornoldObserver.takeRecords();
+    const text = document.body ? document.body.innerText.slice(0, textLimit) : '';
+    return {elements, text, version, title: document.title};
+}
+"""
+
+_PAGE_VERSION_JS = "() => {" + _VERSION_JS + " return window.__ornoldVersionOf(); }"
+
+# Подсказывает браузеру заранее загрузить адреса (<link rel=prefetch>), не меняя версию документа
+_PREFETCH_LINKS_JS = """
+(urls) => {
+""" + _VERSION_JS + """
+    window.__ornoldVersionOf();
+    for (const url of urls) {
+        const link = document.createElement('link');
+        link.rel = 'prefetch';
+        link.href = url;
+        document.head.appendChild(link);
+    }
+    window.__ornoldObserver.takeRecords();
+}
+"""
+
+
+def element_selector(element_id: str) -> str:
+    return f'[data-ornold-id="{element_id}"]'
+
+
+async def perceive(page: Page) -> dict:
+    """Снимок состояния страницы для промпта get_next_action_universal."""
+    perception, _ = await perceive_versioned(page)
+    return perception
+
+
+async def perceive_versioned(page: Page) -> tuple[dict, str]:
+    """Снимок страницы и версия документа, для которой он снят (см. page_version)."""
+    marked = await page.evaluate(_MARK_ELEMENTS_JS, [PERCEPTION_MAX_ELEMENTS, PERCEPTION_TEXT_LIMIT])
+    perception = {
+        "url": page.url,
+        "title": marked["title"],
+        "elements": marked["elements"],
+        "text": marked["text"]
+    }
+    return perception, f"{page.url}#{marked['version']}"
+
+
+async def page_version(page: Page) -> str:
+    """
+    Дешевая проверка (один вызов в страницу): совпадение с версией снимка означает,
+    что с момента снимка DOM не менялся и ввода не было — снимок можно переиспользовать.
+    """
+    return f"{page.url}#{await page.evaluate(_PAGE_VERSION_JS)}"
+
+
+async def prefetch_links(page: Page, urls: list[str]):
+    """Просит браузер заранее загрузить вероятные адреса следующего перехода."""
+    if urls:
+        await page.evaluate(_PREFETCH_LINKS_JS, urls)
+
+
+def element_index(perception: dict, text_limit: int = PERCEPTION_INDEX_TEXT_LIMIT) -> list[str]:
+    """
+    Компактный список всех интерактивных элементов страницы: "id тег: подпись".
+    Отправляется вместе с диффом: LLM не помнит прошлые снимки, и без списка
+    неизмененные элементы пропали бы из ее поля зрения.
+    """
+    index = []
+    for element in perception["elements"]:
+        label = element.get("text") or element.get("name") or element.get("type") or ""
+        label = " ".join(label.split())[:text_limit]
+        index.append(f"{element['id']} {element.get('tag', '')}: {label}" if label else f"{element['id']} {element.get('tag', '')}")
+    return index
+
+
+def diff_perception(base: dict, current: dict, max_ratio: float = PERCEPTION_DIFF_MAX_RATIO) -> dict | None:
+    """
+    Структурный дифф снимка current относительно base: смена URL и заголовка, добавленные,
+    удаленные и измененные интерактивные элементы, появившиеся и исчезнувшие строки текста.
+    Возвращает None, если дифф больше max_ratio от полного снимка (например, после перехода
+    на другую страницу, где data-ornold-id начинаются заново) — тогда выгоднее снимок целиком.
+    """
+    base_elements = {element["id"]: element for element in base["elements"]}
+    current_elements = {element["id"]: element for element in current["elements"]}
+
+    diff = {}
+    if current["url"] != base["url"]:
+        diff["url"] = current["url"]
+    if current["title"] != base["title"]:
+        diff["title"] = current["title"]
+    added = [element for id_, element in current_elements.items() if id_ not in base_elements]
+    changed = [element for id_, element in current_elements.items() if id_ in base_elements and base_elements[id_] != element]
+    removed = [id_ for id_ in base_elements if id_ not in current_elements]
+    if added: diff["added"] = added
+    if changed: diff["changed"] = changed
+    if removed: diff["removed"] = removed
+
+    base_lines = set(base["text"].splitlines())
+    current_lines = set(current["text"].splitlines())
+    text_added = [line for line in current["text"].splitlines() if line.strip() and line not in base_lines]
+    text_removed = [line for line in base["text"].splitlines() if line.strip() and line not in current_lines]
+    if text_added: diff["text_added"] = text_added
+    if text_removed: diff["text_removed"] = text_removed
+
+    size = len(json.dumps(diff, ensure_ascii=False))
+    if size > max_ratio * len(json.dumps(current, ensure_ascii=False)):
+        return None
+    return diff
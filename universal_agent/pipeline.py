@@ -0,0 +1,234 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import urllib.parse
+from typing import Awaitable, Callable, Coroutine, Optional
+from playwright.async_api import Page, Error as PlaywrightError
+from universal_agent.perception import perceive_versioned, page_version, prefetch_links
+
+logger = logging.getLogger(__name__)
+
+# Перекрывать ли ожидание LLM работой браузера и учет шага — захватом следующего снимка
+AGENT_PIPELINE_ENABLED = os.getenv("AGENT_PIPELINE_ENABLED", "true").lower() == "true"
+# Сколько ссылок, похожих на цель, браузер загружает заранее, пока LLM думает (0 — не загружать).
+# Загрузка идет GET-запросами в сессии пользователя, поэтому по умолчанию выключена
+PIPELINE_WARM_LINKS = int(os.getenv("PIPELINE_WARM_LINKS", "0"))
+# Ссылки, которые нельзя загружать заранее: GET по ним может выйти из аккаунта или что-то удалить
+PIPELINE_WARM_EXCLUDE = re.compile(
+    os.getenv("PIPELINE_WARM_EXCLUDE", r"log-?out|log-?off|sign-?out|exit|delete|remove|destroy|unsubscribe|cancel|revoke|deactivate"),
+    re.IGNORECASE
+)
+# Сколько ждать успокоения сети перед повторным снимком во время запроса к LLM (миллисекунды)
+PIPELINE_SETTLE_TIMEOUT_MS = int(os.getenv("PIPELINE_SETTLE_TIMEOUT_MS", "2000"))
+
+
+def _ms(seconds: float) -> int:
+    return int(seconds * 1000)
+
+
+def likely_targets(goal: str, perception: dict, limit: int = PIPELINE_WARM_LINKS) -> list[str]:
+    """
+    Ссылки текущей страницы, текст или адрес которых пересекается со словами цели. Берутся
+    только ссылки того же источника (схема, хост, порт), чей адрес не похож на действие
+    (выход, удаление, отписка — см. PIPELINE_WARM_EXCLUDE).
+    """
+    # Грубая основа слова: "корзину" и "Корзина" должны совпасть
+    words = {word[:5] for word in re.findall(r"\w{3,}", goal.lower())}
+    origin = urllib.parse.urlparse(perception["url"])
+    scored = []
+    for element in perception["elements"]:
+        href = element.get("href")
+        if not href or href.startswith(("#", "javascript:", "mailto:", "tel:")):
+            continue
+        url = urllib.parse.urljoin(perception["url"], href)
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme not in ("http", "https") or url == perception["url"]:
+            continue
+        if (parsed.scheme, parsed.netloc) != (origin.scheme, origin.netloc):
+            continue
+        if PIPELINE_WARM_EXCLUDE.search(urllib.parse.unquote(f"{parsed.path}?{parsed.query}")):
+            continue
+        text = f"{element.get('text', '')} {href}".lower()
+        score = sum(1 for word in words if word in text)
+        if score:
+            scored.append((score, url))
+    scored.sort(key=lambda item: -item[0])
+    return list(dict.fromkeys(url for _, url in scored))[:limit]
+
+
+class PipelinedStepExecutor:
+    """
+    Конвейер шагов агента "восприятие -> решение LLM -> действие -> учет шага".
+
+    Пока LLM выбирает действие, браузер не простаивает: заранее загружает похожие на цель
+    ссылки и, дождавшись успокоения сети, снимает свежий снимок страницы (prefetch). Снимок
+    помечен версией документа; на следующем шаге одна дешевая проверка версии решает,
+    годится ли он (действие ничего не изменило — think, неудачный клик) или устарел
+    и выбрасывается. Учет шага (Redis и событие) идет параллельно со снимком следующего шага.
+
+    Для каждого шага собираются тайминги этапов и overlap_saved_ms — сколько работы
+    выполнено в тени других этапов, то есть насколько шаг короче последовательного.
+    """
+
+    def __init__(self, page: Page, goal: str, enabled: bool = AGENT_PIPELINE_ENABLED, warm_links: int = PIPELINE_WARM_LINKS):
+        self.page = page
+        self.goal = goal
+        self.enabled = enabled
+        self.warm_links = warm_links
+        self.stats = {"prefetch_hits": 0, "prefetch_stale": 0, "overlap_saved_ms": 0}
+        self._snapshot: Optional[tuple[dict, str]] = None
+        # Сколько длился последний снимок — столько экономит каждое попадание prefetch
+        self._capture_time = 0.0
+        self._prefetch: Optional[asyncio.Task] = None
+        self._warmed: set[str] = set()
+        self._pending: Optional[Coroutine] = None
+        self._timing: dict = {}
+
+    async def _timed(self, coro: Awaitable) -> tuple[object, float]:
+        started = time.monotonic()
+        result = await coro
+        return result, time.monotonic() - started
+
+    async def _overlap(self, primary: Awaitable, background: Optional[Awaitable]) -> tuple[object, float]:
+        """
+        Выполняет primary вместе с background (если он есть) и возвращает результат primary.
+        Экономия — время фоновой работы, уложившееся в тень primary.
+        """
+        if background is None:
+            return await primary, 0.0
+        started = time.monotonic()
+        (result, primary_time), (_, background_time) = await asyncio.gather(self._timed(primary), self._timed(background))
+        wall = time.monotonic() - started
+        return result, max(primary_time + background_time - wall, 0.0)
+
+    async def perceive(self) -> dict:
+        """
+        Снимок для нового шага: сначала дожидается учета предыдущего шага (параллельно
+        с восприятием), затем берет prefetch, если версия документа не изменилась.
+        """
+        self._timing = {}
+        started = time.monotonic()
+        pending, self._pending = self._pending, None
+        perception, saved = await self._overlap(self._current_snapshot(), pending)
+        self._timing["perceive_ms"] = _ms(time.monotonic() - started)
+        self._timing["overlap_saved_ms"] = _ms(saved)
+        return perception
+
+    async def _current_snapshot(self) -> dict:
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            try:
+                snapshot = await prefetch
+                if snapshot is not None:
+                    self._snapshot = snapshot
+            except (asyncio.CancelledError, PlaywrightError):
+                pass
+
+        # Адрес страницы известен без вызова в браузер: после перехода снимок заведомо устарел
+        if self.enabled and self._snapshot is not None and self._snapshot[0]["url"] != self.page.url:
+            self.stats["prefetch_stale"] += 1
+            self._timing["prefetch"] = "stale"
+        elif self.enabled and self._snapshot is not None:
+            try:
+                version, probe_time = await self._timed(page_version(self.page))
+                if version == self._snapshot[1]:
+                    self.stats["prefetch_hits"] += 1
+                    self._timing["prefetch"] = "hit"
+                    self._timing["prefetch_saved_ms"] = _ms(max(self._capture_time - probe_time, 0.0))
+                    return self._snapshot[0]
+            except PlaywrightError:
+                pass
+            self.stats["prefetch_stale"] += 1
+            self._timing["prefetch"] = "stale"
+
+        self._snapshot = await self._capture()
+        return self._snapshot[0]
+
+    async def _capture(self) -> tuple[dict, str]:
+        snapshot, self._capture_time = await self._timed(perceive_versioned(self.page))
+        return snapshot
+
+    async def decide(self, decide: Callable[[], Awaitable[dict]], perception: dict) -> dict:
+        """Запрашивает действие у LLM; тем временем браузер готовит следующий шаг."""
+        started = time.monotonic()
+        if self.enabled:
+            self._prefetch = asyncio.create_task(self._prefetch_next(perception))
+        action = await decide()
+        self._timing["llm_ms"] = _ms(time.monotonic() - started)
+        return action
+
+    async def _prefetch_next(self, perception: dict) -> Optional[tuple[dict, str]]:
+        """Прогрев вероятных переходов и снимок страницы после успокоения сети."""
+        work_started = time.monotonic()
+        targets = likely_targets(self.goal, perception, self.warm_links) if self.warm_links else []
+        targets = [url for url in targets if url not in self._warmed]
+        await prefetch_links(self.page, targets)
+        self._warmed.update(targets)
+        try:
+            await self.page.wait_for_load_state("networkidle", timeout=PIPELINE_SETTLE_TIMEOUT_MS)
+        except PlaywrightError:
+            pass
+        if self._snapshot is not None and await page_version(self.page) == self._snapshot[1]:
+            # Пока LLM думала, страница не менялась — текущий снимок и есть следующий
+            return None
+        snapshot = await self._capture()
+        logger.debug(
+            f"Prefetch снимка: {_ms(self._capture_time)} мс "
+            f"(всего {_ms(time.monotonic() - work_started)} мс, прогрето ссылок: {len(targets)})"
+        )
+        return snapshot
+
+    async def act(self, perform: Awaitable[str]) -> str:
+        # Prefetch, не успевший за время решения LLM, после действия уже не нужен
+        if self._prefetch is not None and not self._prefetch.done():
+            self._prefetch.cancel()
+            self._prefetch = None
+        started = time.monotonic()
+        outcome = await perform
+        self._timing["action_ms"] = _ms(time.monotonic() - started)
+        return outcome
+
+    async def defer(self, bookkeeping: Coroutine):
+        """Откладывает учет шага: он выполнится вместе со снимком следующего шага."""
+        if self.enabled:
+            self._pending = bookkeeping
+        else:
+            await bookkeeping
+
+    def timing(self) -> dict:
+        """Тайминги текущего шага (perceive_ms, llm_ms, action_ms, overlap_saved_ms, prefetch)."""
+        timing = dict(self._timing)
+        timing["overlap_saved_ms"] = timing.get("overlap_saved_ms", 0) + timing.pop("prefetch_saved_ms", 0)
+        self.stats["overlap_saved_ms"] += timing["overlap_saved_ms"]
+        return timing
+
+    async def drain(self):
+        """Завершает отложенный учет шага и фоновый prefetch (в конце задачи или при ошибке)."""
+        pending, self._pending = self._pending, None
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            prefetch.cancel()
+            try:
+                await prefetch
+            except (asyncio.CancelledError, PlaywrightError):
+                pass
+        if pending is not None:
+            await pending
+
+    async def abort(self):
+        """
+        Останавливает prefetch без ожидания (задача завершилась ошибкой или уже дождалась drain),
+        но учет последнего шага выполняет: иначе шаг пропал бы из чекпоинтов и событий.
+        Ошибка учета только логируется, чтобы не заслонить исходную ошибку задачи.
+        """
+        if self._prefetch is not None:
+            self._prefetch.cancel()
+            self._prefetch = None
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            try:
+                await pending
+            except Exception as e:
+                logger.warning(f"Не удалось записать последний шаг: {e}")
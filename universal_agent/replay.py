@@ -0,0 +1,207 @@
+import os
+import re
+import json
+import time
+import asyncio
+import difflib
+import logging
+from typing import Optional
+from shared.memory import rag_memory_instance
+from shared.metrics import REPLAY_LOOKUPS, REPLAY_STEPS
+from shared.services import LazyService
+
+logger = logging.getLogger(__name__)
+
+# Повторять ли сохраненные успешные сценарии без обращения к LLM
+REPLAY_ENABLED = os.getenv("REPLAY_ENABLED", "false").lower() == "true"
+# Минимальное сходство текста цели с целью сохраненного сценария (0..1), чтобы повторять его шаги
+REPLAY_MIN_CONFIDENCE = float(os.getenv("REPLAY_MIN_CONFIDENCE", "0.95"))
+# Сколько ближайших по смыслу сценариев сравнивать с целью
+REPLAY_CANDIDATES = int(os.getenv("REPLAY_CANDIDATES", "3"))
+# Пауза в поиске сценариев после сбоя памяти (секунды): задачи не ждут недоступную ChromaDB
+REPLAY_RETRY_SECONDS = float(os.getenv("REPLAY_RETRY_SECONDS", "60"))
+
+# Действия, которые записываются в сценарий: шаги без изменения страницы повторять незачем
+REPLAY_ACTIONS = ("browse", "click", "type")
+
+
+def normalize_goal(goal: str) -> str:
+    return re.sub(r"\s+", " ", goal).strip().lower()
+
+
+def goal_confidence(goal: str, candidate: str) -> float:
+    """
+    Сходство целей по тексту. Расстояние эмбеддингов годится только для отбора кандидатов:
+    документ сценария — это цель вместе с шагами, и "найти товар A" и "найти товар B" для
+    него почти одинаковы, а повторять чужие шаги нельзя. По той же причине цели с разными
+    числами (номер заказа, количество, дата) не считаются похожими.
+    """
+    goal, candidate = normalize_goal(goal), normalize_goal(candidate)
+    if re.findall(r"\d+", goal) != re.findall(r"\d+", candidate):
+        return 0.0
+    return difflib.SequenceMatcher(None, goal, candidate).ratio()
+
+
+def replay_steps(checkpoints: list[dict]) -> list[dict]:
+    """Шаги для сохранения в сценарий: удачные действия, менявшие страницу, с отпечатком страницы до действия."""
+    return [
+        {"action": {k: v for k, v in point["action"].items() if k != "reasoning"}, "perception_hash": point["perception_hash"]}
+        for point in checkpoints
+        if point["outcome"] == "ok" and point["action"].get("action") in REPLAY_ACTIONS
+    ]
+
+
+class ReplayPlan:
+    """
+    Шаги сохраненного сценария для одной задачи. Действие повторяется, только если текущая
+    страница совпадает с той, на которой оно было выбрано; иначе решает LLM, а план ждет,
+    пока агент не окажется на одной из следующих записанных страниц.
+    """
+
+    def __init__(self, goal: str, source_goal: str, confidence: float, steps: list[dict], counters: Optional[dict] = None):
+        self.goal = goal
+        self.source_goal = source_goal
+        self.confidence = confidence
+        self.steps = steps
+        self.exact = normalize_goal(goal) == normalize_goal(source_goal)
+        self.cursor = 0
+        self.replayed = 0
+        self.fallbacks = 0
+        # Счетчики движка, общие для задач процесса
+        self.counters = counters if counters is not None else {}
+
+    def _allowed(self, action: dict) -> bool:
+        # Введенный текст обычно и есть отличие похожих целей: его повторяем, только если он есть в цели
+        if action.get("action") != "type" or self.exact:
+            return True
+        return normalize_goal(str(action.get("text", ""))) in normalize_goal(self.goal)
+
+    def next_action(self, page_hash: str) -> Optional[dict]:
+        """Действие сценария для страницы с этим отпечатком или None, если решать должна LLM."""
+        for index in range(self.cursor, len(self.steps)):
+            step = self.steps[index]
+            if step["perception_hash"] == page_hash and self._allowed(step["action"]):
+                self.cursor = index + 1
+                self.replayed += 1
+                self.counters["steps_replayed"] = self.counters.get("steps_replayed", 0) + 1
+                REPLAY_STEPS.labels(source="replay").inc()
+                return dict(step["action"])
+        self.fallbacks += 1
+        self.counters["steps_fallback"] = self.counters.get("steps_fallback", 0) + 1
+        REPLAY_STEPS.labels(source="llm").inc()
+        return None
+
+    @property
+    def complete(self) -> bool:
+        """Все шаги сценария повторены без единого обращения к LLM, кроме завершающего."""
+        return self.cursor == len(self.steps) and self.fallbacks <= 1
+
+
+class ReplayEngine:
+    """
+    Повтор успешных сценариев из RAG-памяти. Завершенная задача сохраняет свои шаги вместе
+    с отпечатками страниц (shared/task_checkpoints.py); новая задача с почти такой же целью
+    выполняет эти шаги без запросов к LLM, пока страницы совпадают с записанными. Итоговое
+    решение (finish с результатом) всегда принимает LLM.
+
+    Память — вспомогательный канал: при ее сбое задача выполняется обычным путем,
+    а поиск сценариев приостанавливается на REPLAY_RETRY_SECONDS.
+    """
+
+    def __init__(
+        self,
+        memory=rag_memory_instance,
+        enabled: bool = REPLAY_ENABLED,
+        min_confidence: float = REPLAY_MIN_CONFIDENCE,
+        candidates: int = REPLAY_CANDIDATES
+    ):
+        self.memory = memory
+        self.enabled = enabled
+        self.min_confidence = min_confidence
+        self.candidates = candidates
+        self.counters = {"lookups": 0, "hits": 0, "errors": 0, "steps_replayed": 0, "steps_fallback": 0, "recorded": 0}
+        self._paused_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._paused_until
+
+    async def _memory(self):
+        if isinstance(self.memory, LazyService) and not self.memory.initialized:
+            # Подключение к ChromaDB блокирующее: создаем клиент вне event loop агентов
+            await asyncio.to_thread(self.memory.get)
+        return self.memory
+
+    def _pause(self, e: Exception):
+        self.counters["errors"] += 1
+        self._paused_until = time.monotonic() + REPLAY_RETRY_SECONDS
+        logger.warning(f"Память сценариев недоступна, повтор отключен на {REPLAY_RETRY_SECONDS:g} с: {e}")
+
+    def _best(self, goal: str, metadatas: list) -> Optional[tuple[float, dict]]:
+        matches = []
+        for metadata in metadatas:
+            if metadata and metadata.get("replay"):
+                confidence = goal_confidence(goal, metadata.get("goal", ""))
+                if confidence >= self.min_confidence:
+                    matches.append((confidence, metadata))
+        # Из одинаково похожих берется самый свежий сценарий: его отпечатки страниц актуальнее
+        return max(matches, key=lambda match: (match[0], match[1].get("replay_at", 0)), default=None)
+
+    async def find_plan(self, goal: str, tenant: Optional[str] = None) -> Optional[ReplayPlan]:
+        """
+        Ищет сохраненный сценарий клиента tenant с почти той же целью: сначала точное совпадение
+        цели (фильтр по метаданным, без эмбеддинга), затем ближайшие по смыслу сценарии.
+        Сценарии других клиентов не повторяются: их шаги могут содержать чужие данные.
+        """
+        if not self.available:
+            return None
+        self.counters["lookups"] += 1
+        try:
+            memory = await self._memory()
+            exact = await memory.get_scenarios_by_goal(goal, tenant=tenant)
+            best = self._best(goal, exact.get("metadatas") or [])
+            if best is None:
+                results = await memory.search_similar_scenarios(goal, n_results=self.candidates, tenant=tenant)
+                best = self._best(goal, (results.get("metadatas") or [[]])[0])
+        except Exception as e:
+            REPLAY_LOOKUPS.labels(result="error").inc()
+            self._pause(e)
+            return None
+
+        if best is None:
+            REPLAY_LOOKUPS.labels(result="miss").inc()
+            return None
+        confidence, metadata = best
+        try:
+            steps = json.loads(metadata["replay"])
+        except json.JSONDecodeError:
+            logger.warning(f"Поврежденные шаги повтора у сценария '{metadata.get('goal')}'")
+            REPLAY_LOOKUPS.labels(result="miss").inc()
+            return None
+        self.counters["hits"] += 1
+        REPLAY_LOOKUPS.labels(result="hit").inc()
+        return ReplayPlan(goal, metadata.get("goal", ""), confidence, steps, self.counters)
+
+    async def record(
+        self, goal: str, checkpoints: list[dict], plan: Optional[ReplayPlan] = None, tenant: Optional[str] = None
+    ):
+        """Сохраняет шаги завершенной задачи как сценарий для повтора клиентом tenant."""
+        steps = replay_steps(checkpoints)
+        # Полностью повторенный сценарий той же цели уже сохранен и актуален
+        if not self.available or not steps or (plan is not None and plan.exact and plan.complete):
+            return
+        try:
+            memory = await self._memory()
+            await memory.add_successful_scenario(goal, [step["action"] for step in steps], replay=steps, tenant=tenant)
+            self.counters["recorded"] += 1
+        except Exception as e:
+            self._pause(e)
+
+    def stats(self) -> dict:
+        """Доля задач, нашедших сценарий, и сколько обращений к LLM сэкономил повтор."""
+        lookups = self.counters["lookups"]
+        return {
+            **self.counters,
+            "hit_rate": round(self.counters["hits"] / lookups, 3) if lookups else 0.0,
+            "llm_calls_avoided": self.counters["steps_replayed"]
+        }
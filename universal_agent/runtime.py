@@ -0,0 +1,92 @@
+import os
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Callable, Optional
+import redis.asyncio as aioredis
+from shared.task_store import AsyncTaskStore
+from shared.endpoint_scheduler import AsyncEndpointScheduler
+from shared.task_cancel import CancellationWatcher
+from shared.task_checkpoints import CheckpointStore
+from universal_agent.browser_pool import AsyncBrowserPool
+from universal_agent.replay import ReplayEngine
+from shared.tracing import trace_context, in_trace_context
+from shared.config import REDIS_HOST, REDIS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Сколько агентов одновременно выполняется в одном процессе асинхронного воркера
+AGENT_CONCURRENCY = int(os.getenv("AGENT_CONCURRENCY", "100"))
+
+
+class AsyncAgentRuntime:
+    """
+    Среда асинхронного режима воркера: один event loop в отдельном потоке процесса,
+    на котором агенты выполняются как корутины, и общие для них ресурсы
+    (пул соединений Redis, хранилище задач, планировщик эндпоинтов, браузеры).
+
+    Задачи Celery (пул потоков) передают агента в loop и ждут его завершения. Число
+    одновременно работающих агентов ограничивает concurrency пула Celery (max_agents потоков).
+    """
+
+    def __init__(self, max_agents: int = AGENT_CONCURRENCY):
+        self.max_agents = max_agents
+        self.redis = aioredis.Redis(
+            connection_pool=aioredis.BlockingConnectionPool(
+                host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True, max_connections=max(max_agents, 10)
+            )
+        )
+        self.task_store = AsyncTaskStore(self.redis)
+        self.endpoint_scheduler = AsyncEndpointScheduler(self.redis)
+        self.browser_pool = AsyncBrowserPool()
+        self.cancellation = CancellationWatcher(self.redis)
+        self.checkpoint_store = CheckpointStore(self.redis)
+        self.replay = ReplayEngine()
+        self.stats = {"running": 0, "finished": 0}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="agent-runtime", daemon=True)
+        self._thread.start()
+        logger.info(f"Асинхронная среда агентов запущена: до {max_agents} агентов в процессе")
+
+    async def _run_agent(self, agent_factory: Callable[[], Awaitable]):
+        self.stats["running"] += 1
+        try:
+            return await agent_factory()
+        finally:
+            self.stats["running"] -= 1
+            self.stats["finished"] += 1
+
+    def run(self, agent_factory: Callable[[], Awaitable]):
+        """Выполняет корутину агента в loop среды. Блокирует вызывающий поток до ее завершения."""
+        # Корутина в loop среды получает привязку вызывающего потока Celery (worker_id для спанов)
+        coro = in_trace_context(self._run_agent(agent_factory), trace_context())
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def shutdown(self):
+        future = asyncio.run_coroutine_threadsafe(self._close(), self._loop)
+        try:
+            future.result(timeout=30)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _close(self):
+        await self.cancellation.close()
+        await self.browser_pool.close_all()
+        await self.redis.aclose()
+
+
+_runtime: Optional[AsyncAgentRuntime] = None
+
+
+def enable_runtime(max_agents: int = AGENT_CONCURRENCY) -> AsyncAgentRuntime:
+    """Включает асинхронный режим в текущем процессе (вызывается из async_worker.py)."""
+    global _runtime
+    if _runtime is None:
+        _runtime = AsyncAgentRuntime(max_agents)
+    return _runtime
+
+
+def get_runtime() -> Optional[AsyncAgentRuntime]:
+    """Среда асинхронного режима или None, если процесс работает в обычном prefork-режиме."""
+    return _runtime
@@ -1,27 +1,114 @@
 import shared.logging_config
-from celery import Celery
-from universal_agent.agent import MagnitudeAgent # Импортируем нового агента
+from celery.signals import worker_init, worker_process_shutdown, worker_shutdown
+from universal_agent.agent import MagnitudeAgent, task_store, ACTIVE_STATUSES # Импортируем нового агента
+from universal_agent.async_agent import UniversalAgent
+from universal_agent.browser_pool import get_browser_pool
+from universal_agent.runtime import get_runtime
+from shared.task_events import publish_event
+from shared.endpoint_scheduler import NoEndpointAvailableError
+from shared.task_cancel import acknowledge_cancel
+from shared.metrics import start_exporter, mark_process_dead, TASK_QUEUE_WAIT_SECONDS
+from shared.tracing import bind_task, span
+from shared.celery_app import celery_app, RUN_AGENT_TASK, DEFAULT_PRIORITY, DEFAULT_AGENT
 import os
+import time
+import socket
+import redis
+from shared.config import REDIS_HOST, REDIS_PORT
 
-# Получаем хост Redis из переменной окружения
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
 
-# Настраиваем Celery
-celery_app = Celery(
-    'tasks',
-    broker=f'redis://{REDIS_HOST}:6379/0',
-    backend=f'redis://{REDIS_HOST}:6379/0'
-)
+# Через сколько секунд повторить задачу, если все ее эндпоинты заняты
+ENDPOINT_RETRY_DELAY = int(os.getenv("ENDPOINT_RETRY_DELAY", "15"))
+# Сколько раз откладывать такую задачу, прежде чем завершить ее с ошибкой (по умолчанию — час ожидания)
+ENDPOINT_MAX_RETRIES = int(os.getenv("ENDPOINT_MAX_RETRIES", "240"))
 
-@celery_app.task(name="worker.run_agent_task")
-def run_agent_task(task_id: str, goal: str, initial_browser_endpoints: list = None):
+def get_worker_id() -> str:
+    # PID берем в момент выполнения: prefork-процессы форкаются уже после импорта
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    # Экспортер в главном процессе; метрики prefork-процессов он видит через PROMETHEUS_MULTIPROC_DIR
+    start_exporter()
+
+@worker_process_shutdown.connect
+def close_browser_sessions(pid=None, **kwargs):
+    # Закрываем прогретые браузерные сессии процесса вместе с ним
+    get_browser_pool().close_all()
+    mark_process_dead(pid or os.getpid())
+
+@worker_shutdown.connect
+def close_agent_runtime(**kwargs):
+    runtime = get_runtime()
+    if runtime is not None:
+        runtime.shutdown()
+
+@celery_app.task(name=RUN_AGENT_TASK, bind=True, max_retries=None)
+def run_agent_task(
+    self,
+    task_id: str,
+    goal: str,
+    initial_browser_endpoints: list = None,
+    endpoint_group: str = None,
+    priority: str = None,
+    tenant: str = None,
+    enqueued_at: float = None,
+    operator_action: dict = None,
+    agent: str = DEFAULT_AGENT
+):
     """
-    Celery-задача, которая инициализирует и запускает Magnitude агента.
+    Celery-задача, которая инициализирует и запускает агента, выбранного при создании задачи.
+    Агент universal выполняется корутиной в общем event loop асинхронного воркера
+    (async_worker.py), агент magnitude занимает процесс обычного воркера целиком.
+    Каждый режим слушает только очереди своего агента.
     """
-    agent = MagnitudeAgent(
-        task_id=task_id, 
-        goal=goal,
-        browser_endpoints=initial_browser_endpoints
-    )
-    agent.run()
-    return f"Агент Magnitude завершил работу над задачей {task_id}." 
\ No newline at end of file
+    worker_id = get_worker_id()
+    # task_id и worker_id попадают в спаны и строки логов всего, что выполняется для задачи
+    bind_task(task_id, worker_id)
+    priority = priority or DEFAULT_PRIORITY
+    # Ожидание в очереди считаем только для первой попытки: повторы откладываются намеренно
+    if enqueued_at is not None and not self.request.retries:
+        TASK_QUEUE_WAIT_SECONDS.labels(priority=priority).observe(max(time.time() - enqueued_at, 0))
+    publish_event(redis_client, task_id, "step", {"step": "picked_up", "worker_id": worker_id})
+    runtime = get_runtime()
+    if (agent == "universal") != (runtime is not None):
+        # Задача попала не в свою очередь: подменять агента нельзя
+        mode = "асинхронном" if runtime is not None else "обычном"
+        reason = f"Агент '{agent}' не выполняется в {mode} режиме воркера"
+        task_store.update(task_id, expected_status=ACTIVE_STATUSES, status="error", status_reason=reason)
+        acknowledge_cancel(redis_client, task_id)
+        return reason
+    with span("task.run", mode=agent, priority=priority):
+        try:
+            if agent == "universal":
+                runtime.run(lambda: UniversalAgent(
+                    runtime,
+                    task_id=task_id,
+                    goal=goal,
+                    browser_endpoints=initial_browser_endpoints,
+                    endpoint_group=endpoint_group,
+                    operator_action=operator_action,
+                    tenant=tenant
+                ).run())
+            else:
+                agent = MagnitudeAgent(
+                    task_id=task_id, 
+                    goal=goal,
+                    browser_endpoints=initial_browser_endpoints,
+                    endpoint_group=endpoint_group,
+                    operator_action=operator_action
+                )
+                agent.run()
+        except NoEndpointAvailableError as e:
+            if self.request.retries >= ENDPOINT_MAX_RETRIES:
+                reason = f"Не дождались свободного эндпоинта за {self.request.retries * ENDPOINT_RETRY_DELAY} с: {e}"
+                task_store.update(task_id, expected_status=ACTIVE_STATUSES, status="error", status_reason=reason)
+                return f"Задача {task_id} не дождалась свободного эндпоинта."
+            # Слот воркера не держим: задача вернется в очередь и дождется свободного эндпоинта
+            publish_event(redis_client, task_id, "step", {"step": "waiting_for_endpoint", "reason": str(e)})
+            raise self.retry(countdown=ENDPOINT_RETRY_DELAY)
+        finally:
+            # Если задачу останавливали, подтверждаем, что воркер с ней закончил: процесс не будет убит
+            acknowledge_cancel(redis_client, task_id)
+    return f"Агент завершил работу над задачей {task_id}." 
\ No newline at end of file